@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+GitLab client latency benchmark
+Per-request latency of a new AsyncClient per call (the old behaviour) vs the pooled GitLabClient,
+against a local stub server
+
+Usage (from gitlab-code-review-agent/):
+    python scripts/bench_gitlab_client.py [--requests 200] [--tls] [--delay-ms 0]
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+MR = json.dumps({"iid": 1, "title": "Benchmark", "sha": "a" * 40}).encode()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with a small merge request (keep-alive enabled)"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are separate writes; don't wait for delayed ACKs
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(MR)))
+        self.end_headers()
+        self.wfile.write(MR)
+
+
+def start_stub(tls: bool, delay_ms: float) -> str:
+    """Start the stub server in a thread, return its base URL"""
+    _StubHandler.delay = delay_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    scheme = "http"
+    if tls:
+        # Self-signed certificate, trusted by httpx through SSL_CERT_FILE
+        cert_dir = tempfile.mkdtemp()
+        cert, key = os.path.join(cert_dir, "cert.pem"), os.path.join(cert_dir, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1",
+             "-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True, capture_output=True
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        os.environ["SSL_CERT_FILE"] = cert
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+
+async def bench_unpooled(url: str, requests: int) -> List[float]:
+    """A fresh AsyncClient for every request (new TCP + TLS handshake each time)"""
+    import httpx
+
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.get(f"{url}/api/v4/projects/1/merge_requests/1")
+            response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def bench_pooled(requests: int) -> List[float]:
+    """The shared GitLabClient (connections reused across requests)"""
+    from src.gitlab_client import GitLabClient
+
+    gitlab = GitLabClient()
+    await gitlab.start()
+    latencies = []
+    try:
+        for _ in range(requests):
+            started = time.perf_counter()
+            await gitlab.get_merge_request(1, 1)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await gitlab.close()
+    return latencies
+
+
+def report(name: str, latencies: List[float]) -> float:
+    """Print latency percentiles in ms, return the mean"""
+    ordered = sorted(latencies)
+    mean = statistics.mean(ordered) * 1000
+    p50 = ordered[len(ordered) // 2] * 1000
+    p95 = ordered[int(len(ordered) * 0.95) - 1] * 1000
+    print(f"{name:<10} mean {mean:7.2f} ms   p50 {p50:7.2f} ms   p95 {p95:7.2f} ms")
+    return mean
+
+
+async def main(args: argparse.Namespace) -> None:
+    url = start_stub(args.tls, args.delay_ms)
+    os.environ.update({
+        "GITLAB_URL": url,
+        "GITLAB_TOKEN": "benchmark",
+        "ANTHROPIC_API_KEY": "benchmark",
+        "GITLAB_HTTP2": "false",
+        "LOG_LEVEL": "WARNING"
+    })
+
+    # Warm up imports and the server before timing
+    await bench_unpooled(url, 3)
+    await bench_pooled(3)
+
+    print(f"{args.requests} sequential GETs against {url}")
+    before = report("unpooled", await bench_unpooled(url, args.requests))
+    after = report("pooled", await bench_pooled(args.requests))
+    print(f"Pooled client is {before / after:.1f}x faster per request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per client (default: 200)")
+    parser.add_argument("--tls", action="store_true", help="Serve HTTPS with a self-signed certificate (needs openssl)")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Stub server latency per request")
+    asyncio.run(main(parser.parse_args()))
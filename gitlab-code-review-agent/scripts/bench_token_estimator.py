@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Token estimator benchmark
+Estimation speed on real diffs (git history), and error against actual token counts from
+the Anthropic count_tokens API and/or the monthly usage CSV logs
+
+Usage (from gitlab-code-review-agent/):
+    python scripts/bench_token_estimator.py [--repo ..] [--commits 300]
+    ANTHROPIC_API_KEY=... python scripts/bench_token_estimator.py --count-tokens 50
+    python scripts/bench_token_estimator.py --logs /app/data/tokens/token-logs
+
+The scale factor is calibrated on the first half of the samples and the error
+is measured on the second half.
+"""
+import os
+import sys
+import csv
+import time
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+from typing import List, Tuple
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+for _name in ("GITLAB_URL", "GITLAB_TOKEN", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(_name, "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from src.config import settings
+from src.token_estimator import TokenEstimator
+
+# (raw estimate, actual input tokens, characters)
+Sample = Tuple[int, int, int]
+
+
+def load_diffs(repo: Path, commits: int) -> List[str]:
+    """Patches of the last commits of a git repository, one string per commit"""
+    output = subprocess.run(
+        ["git", "-C", str(repo), "log", "-p", "--no-color", f"-n{commits}", "--format=%x00%H"],
+        check=True, capture_output=True, text=True, errors="replace"
+    ).stdout
+    return [patch for patch in output.split("\0") if "\ndiff --git" in patch]
+
+
+def bench_speed(estimator: TokenEstimator, diffs: List[str]) -> None:
+    """Time count_raw over every diff"""
+    characters = sum(len(diff) for diff in diffs)
+    started = time.perf_counter()
+    for diff in diffs:
+        estimator.count_raw(diff)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Speed: {len(diffs)} diffs, {characters / 1e6:.2f} MB in {elapsed * 1000:.1f} ms "
+        f"({characters / 1e6 / elapsed:.1f} MB/s, {elapsed / len(diffs) * 1e6:.0f} µs per diff)"
+    )
+
+
+async def count_tokens_samples(estimator: TokenEstimator, diffs: List[str], limit: int) -> List[Sample]:
+    """Actual prompt sizes of review prompts for the diffs, from the count_tokens API"""
+    import httpx
+    from src.claude_reviewer import reviewer, REVIEW_SYSTEM_PROMPT
+
+    samples = []
+    async with httpx.AsyncClient(headers=reviewer.headers, timeout=60.0) as client:
+        for diff in diffs[:limit]:
+            prompt = reviewer._build_review_prompt(diff, "Benchmark", "")
+            response = await client.post(f"{reviewer.api_url}/count_tokens", json={
+                "model": settings.anthropic_model,
+                "system": REVIEW_SYSTEM_PROMPT,
+                "messages": [{"role": "user", "content": prompt}]
+            })
+            response.raise_for_status()
+            raw = estimator.count_raw(REVIEW_SYSTEM_PROMPT) + estimator.count_raw(prompt)
+            characters = len(REVIEW_SYSTEM_PROMPT) + len(prompt)
+            samples.append((raw, response.json()["input_tokens"], characters))
+    return samples
+
+
+def log_samples(log_dir: Path) -> List[Sample]:
+    """Logged (estimate, actual) pairs from the monthly CSV logs, oldest first"""
+    samples = []
+    for csv_path in sorted(log_dir.glob("*.csv")):
+        with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                estimated = int(row.get("estimated_input_tokens") or 0)
+                actual = sum(
+                    int(row.get(column) or 0)
+                    for column in ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+                )
+                if estimated > 0 and actual > 0:
+                    samples.append((estimated, actual, 0))
+    return samples
+
+
+def report_error(name: str, samples: List[Sample]) -> None:
+    """Calibrate on the first half of the samples, print the error on the second half"""
+    if len(samples) < 2:
+        print(f"{name}: not enough samples ({len(samples)})")
+        return
+
+    half = len(samples) // 2
+    estimator = TokenEstimator()
+    estimator.scale = sum(actual for _, actual, _ in samples[:half]) / sum(raw for raw, _, _ in samples[:half])
+
+    def summarize(label: str, errors: List[float]) -> None:
+        errors = sorted(errors)
+        mean_abs = sum(abs(e) for e in errors) / len(errors)
+        p90 = sorted(abs(e) for e in errors)[int(len(errors) * 0.9) - 1]
+        bias = sum(errors) / len(errors)
+        print(f"  {label:<12} mean |error| {mean_abs:6.1%}   p90 |error| {p90:6.1%}   bias {bias:+6.1%}")
+
+    test = samples[half:]
+    print(f"{name}: scale {estimator.scale:.3f} from {half} samples, error on {len(test)}")
+    summarize("estimator", [(estimator.scale_raw(raw) - actual) / actual for raw, actual, _ in test])
+    if all(characters for _, _, characters in test):
+        summarize("chars / 4", [(characters / 4 - actual) / actual for _, actual, characters in test])
+
+
+async def main(args: argparse.Namespace) -> None:
+    estimator = TokenEstimator()
+    diffs = load_diffs(Path(args.repo), args.commits)
+    if not diffs:
+        sys.exit(f"No diffs found in {args.repo}")
+
+    bench_speed(estimator, diffs)
+    if args.count_tokens:
+        report_error("count_tokens API", await count_tokens_samples(estimator, diffs, args.count_tokens))
+    if args.logs:
+        report_error("Usage logs", log_samples(Path(args.logs)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repo", default=str(PROJECT_ROOT.parent), help="Git repository to take diffs from")
+    parser.add_argument("--commits", type=int, default=300, help="Commits to take diffs from (default: 300)")
+    parser.add_argument("--count-tokens", type=int, default=0, metavar="N",
+                        help="Measure error on N diffs with the count_tokens API (needs ANTHROPIC_API_KEY)")
+    parser.add_argument("--logs", help="token-logs directory to measure error against logged usage")
+    asyncio.run(main(parser.parse_args()))
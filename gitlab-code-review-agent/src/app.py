@@ -3,18 +3,41 @@
 Code Review Agent - Main Application
 FastAPI webhook listener for GitLab merge request events
 """
+import hmac
+import json
+import httpx
 import logging
 import asyncio
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
-from typing import Dict
-from datetime import datetime
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, Response
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from datetime import datetime, date, timedelta
 
 from src.config import settings
 from src.gitlab_client import GitLabClient
-from src.claude_reviewer import reviewer
-from src.token_tracker import tracker
-from src.exceptions import TokenBudgetExceeded
+from src.claude_reviewer import reviewer, PROMPT_VERSION, ProgressCallback
+from src.token_tracker import tracker, TokenReservation
+from src.usage_store import GROUP_BY_COLUMNS, HISTORY_GRANULARITIES
+from src.token_estimator import estimator
+from src.review_queue import review_queue, ReviewJob
+from src.review_context import ReviewContext
+from src.review_state import review_state
+from src.review_cache import review_cache, file_review_cache
+from src.diff_chunker import split_changes_into_chunks
+from src.diff_filter import diff_filter, FilterReport
+from src.review_note import ReviewProgressNote
+from src.message_batches import batch_store, BatchProcessor, BatchRequest, BATCH_RESERVATION_TTL
+from src.worker_pool import ReviewWorkerPool
+from src.rate_limiter import rate_limiter, review_rate_limits
+from src.shared_state import PROCESS_ID
+from src.exceptions import TokenBudgetExceeded, ReviewDeferred
+
+# Optional fast JSON decoder (falls back to the standard library)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -23,18 +46,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open connection pools and start the review workers; reverse on shutdown"""
+    await asyncio.to_thread(estimator.calibrate_from_logs, tracker.token_logs_dir)
+    await tracker.start()
+    await gitlab.start()
+    await reviewer.start()
+    await worker_pool.start()
+    await batch_processor.start()
+    yield
+    await batch_processor.stop()
+    await worker_pool.stop()
+    await reviewer.close()
+    await gitlab.close()
+    await tracker.close()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Code Review Agent",
     description="AI-powered code reviews for GitLab merge requests using Claude",
-    version="1.1.0"
+    version="1.1.0",
+    lifespan=lifespan
 )
 
 # Initialize GitLab client
 gitlab = GitLabClient()
 
-# Simple in-memory rate limiter
-review_timestamps = []
+# Heading and explanation of the MR comment per exhausted quota level
+QUOTA_EXHAUSTED_TEXT = {
+    "global": ("Daily Token Budget Exhausted", "The AI code review service has reached its daily token limit."),
+    "group": ("Group Token Quota Exhausted", "This project's group has used its daily token quota."),
+    "project": (
+        "Project Token Quota Exhausted",
+        "This project has used its daily token quota; other projects are still reviewed."
+    ),
+    "user": (
+        "User Token Quota Exhausted",
+        "The merge request author has used their daily token quota in this project."
+    )
+}
 
 
 @app.get("/health")
@@ -64,21 +117,188 @@ async def budget_status():
     }
 
 
+@app.get("/budget/quotas")
+async def budget_quotas(
+    project_id: Optional[int] = None,
+    project_name: Optional[str] = None,
+    username: Optional[str] = None
+):
+    """
+    Today's usage and remaining tokens at each quota level
+    
+    Args:
+        project_id: Show the quotas a review in this project counts against
+        project_name: Project path (selects the group quota)
+        username: Also show this user's quota within the project
+    """
+    if not settings.token_budget_enabled:
+        return {"enabled": False, "message": "Token budget tracking is disabled"}
+    
+    quotas = await tracker.get_quota_status(project_id, project_name, username)
+    return {
+        "enabled": True,
+        "date": datetime.utcnow().date().isoformat(),
+        "quotas": quotas
+    }
+
+
+@app.get("/budget/history")
+async def budget_history(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    granularity: str = "day",
+    project_id: Optional[int] = None,
+    username: Optional[str] = None,
+    model: Optional[str] = None
+):
+    """
+    Token usage per day or month over a date range
+    
+    Args:
+        start: First day (YYYY-MM-DD, defaults to 30 days before end)
+        end: Last day (YYYY-MM-DD, defaults to today)
+        granularity: 'day' or 'month'
+        project_id / username / model: Optional filters
+    """
+    if not settings.token_budget_enabled:
+        return {"enabled": False, "message": "Token budget tracking is disabled"}
+    if granularity not in HISTORY_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(HISTORY_GRANULARITIES)}")
+    start, end = usage_range(start, end)
+    
+    buckets = await tracker.usage_history(start, end, granularity, project_id, username, model)
+    return {
+        "enabled": True,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "granularity": granularity,
+        "buckets": buckets
+    }
+
+
+@app.get("/budget/breakdown")
+async def budget_breakdown(
+    group_by: str = "project",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    project_id: Optional[int] = None,
+    username: Optional[str] = None,
+    model: Optional[str] = None
+):
+    """
+    Token usage per project, user or model over a date range
+    
+    Args:
+        group_by: 'project', 'user' or 'model'
+        start: First day (YYYY-MM-DD, defaults to 30 days before end)
+        end: Last day (YYYY-MM-DD, defaults to today)
+        project_id / username / model: Optional filters
+    """
+    if not settings.token_budget_enabled:
+        return {"enabled": False, "message": "Token budget tracking is disabled"}
+    if group_by not in GROUP_BY_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(GROUP_BY_COLUMNS)}")
+    start, end = usage_range(start, end)
+    
+    groups = await tracker.usage_breakdown(start, end, group_by, project_id, username, model)
+    return {
+        "enabled": True,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "group_by": group_by,
+        "total_tokens": sum(group["total_tokens"] for group in groups),
+        "request_count": sum(group["request_count"] for group in groups),
+        "groups": groups
+    }
+
+
+def usage_range(start: Optional[date], end: Optional[date]) -> Tuple[date, date]:
+    """Fill in the default usage query range (last 30 days) and validate it"""
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=30)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+
+@app.get("/budget/export")
+async def budget_export(month: Optional[str] = None):
+    """
+    Download a month's token usage log as Excel-friendly CSV
+    
+    Args:
+        month: Month to export (YYYY-MM, defaults to the current month)
+    """
+    month = month or datetime.utcnow().strftime('%Y-%m')
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    
+    content = await tracker.export_csv(month)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"No token usage recorded in {month}")
+    return Response(
+        content=content,
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{month}.csv"'}
+    )
+
+
+@app.get("/queue/status")
+async def queue_status():
+    """
+    Get review queue status
+    
+    Returns job counts by status, per-project queue depths and Message Batch counts
+    """
+    stats = await review_queue.get_stats()
+    status = {
+        "workers": worker_pool.worker_count,
+        "jobs": stats,
+        "projects": review_queue.get_project_depths()
+    }
+    if settings.batch_review_enabled:
+        status["batches"] = await batch_store.get_stats()
+    return status
+
+
+@app.get("/cache/status")
+async def cache_status():
+    """
+    Get review cache status
+    
+    Returns entry count and hit/miss/eviction counters
+    """
+    if not settings.review_cache_enabled:
+        return {"enabled": False, "message": "Review cache is disabled"}
+    
+    return {
+        "enabled": True,
+        "stats": review_cache.get_stats()
+    }
+
+
 @app.post("/webhook/gitlab")
-async def gitlab_webhook(request: Request, background_tasks: BackgroundTasks):
+async def gitlab_webhook(request: Request):
     """
     GitLab webhook endpoint for merge request events
     """
     try:
-        # Parse webhook payload
-        payload = await request.json()
-        
-        # Validate webhook secret if configured
+        # Validate webhook secret if configured (before touching the body)
         if settings.gitlab_webhook_secret:
-            token = request.headers.get("X-Gitlab-Token")
-            if token != settings.gitlab_webhook_secret:
+            token = request.headers.get("X-Gitlab-Token", "")
+            if not hmac.compare_digest(token.encode(), settings.gitlab_webhook_secret.encode()):
                 raise HTTPException(status_code=401, detail="Invalid webhook secret")
         
+        # Ignore non-MR events by header, without reading the body
+        event_header = request.headers.get("X-Gitlab-Event")
+        if event_header is not None and event_header != "Merge Request Hook":
+            return {"status": "ignored", "reason": f"Not a merge request event: {event_header}"}
+        
+        # Parse webhook payload (size-capped)
+        payload = await read_webhook_payload(request)
+        
         # Extract event type
         event_type = payload.get("object_kind")
         
@@ -86,118 +306,361 @@ async def gitlab_webhook(request: Request, background_tasks: BackgroundTasks):
             return {"status": "ignored", "reason": f"Not a merge request event: {event_type}"}
         
         # Extract MR details
-        mr = payload.get("object_attributes", {})
-        project = payload.get("project", {})
+        mr = payload.get("object_attributes") or {}
+        project = payload.get("project") or {}
+        if not isinstance(mr, dict) or not isinstance(project, dict):
+            raise HTTPException(status_code=400, detail="Invalid merge request event")
         
         project_id = project.get("id")
         mr_iid = mr.get("iid")
         action = mr.get("action")
         
+        # Both are NOT NULL in the queue; reject instead of failing on insert
+        if not is_valid_id(project_id) or not is_valid_id(mr_iid):
+            raise HTTPException(
+                status_code=400,
+                detail="Merge request event needs integer project.id and object_attributes.iid"
+            )
+        
         logger.info(f"Received MR event: project={project_id}, MR={mr_iid}, action={action}")
         
         # Check if we should review (based on labels)
         labels = [label.get("title") for label in payload.get("labels", [])]
         
-        if settings.gitlab_trigger_label not in labels:
+        trigger_labels = (
+            settings.gitlab_trigger_label, settings.gitlab_full_review_label, settings.gitlab_batch_review_label
+        )
+        if not any(label in labels for label in trigger_labels):
             return {
                 "status": "skipped",
                 "reason": f"Label '{settings.gitlab_trigger_label}' not present"
             }
         
-        # Process review in background
-        background_tasks.add_task(process_code_review, project_id, mr_iid)
+        head_sha = (mr.get("last_commit") or {}).get("id")
+        
+        if await worker_pool.is_reviewing(project_id, mr_iid, head_sha):
+            return {"status": "skipped", "reason": "Review already in progress for this commit"}
+        
+        # Queue review for the worker pool (persisted, survives restarts).
+        # Pending jobs for the same MR collapse into one.
+        job_id, coalesced = await review_queue.enqueue(
+            project_id, mr_iid, head_sha, build_job_payload(payload)
+        )
+        
+        # A review of an older head is now wasted work
+        worker_pool.supersede(project_id, mr_iid, head_sha)
         
-        return {"status": "accepted", "message": "Review queued"}
+        return {
+            "status": "accepted",
+            "message": "Review coalesced with pending job" if coalesced else "Review queued",
+            "job_id": job_id
+        }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def process_code_review(project_id: int, mr_iid: int):
+async def read_webhook_payload(request: Request) -> Dict:
+    """
+    Read and decode the webhook body, enforcing WEBHOOK_MAX_BODY_BYTES
+    
+    Raises:
+        HTTPException: 413 if the body is too large, 400 if it is not valid JSON
+    """
+    max_bytes = settings.webhook_max_body_bytes
+    
+    # Reject early on the declared size
+    content_length = request.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Payload too large (max {max_bytes} bytes)")
+    
+    # Enforce on the actual size too (chunked bodies have no Content-Length)
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Payload too large (max {max_bytes} bytes)")
+    
+    try:
+        payload = orjson.loads(body) if orjson else json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    return payload
+
+
+def is_valid_id(value) -> bool:
+    """Check that a GitLab ID from a webhook is a positive integer"""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def already_reviewed_note(head_sha: str) -> str:
+    """MR note for a review trigger without new commits (and no cached review to repost)"""
+    return (
+        f"ℹ️ Already reviewed at `{head_sha[:8]}`; no new commits since. "
+        f"Add `{settings.gitlab_full_review_label}` for a fresh full review."
+    )
+
+
+def build_job_payload(payload: Dict) -> Dict:
+    """Keep only the parts of the webhook payload a review job needs"""
+    return {
+        "object_attributes": payload.get("object_attributes", {}),
+        "project": payload.get("project", {}),
+        "user": payload.get("user", {}),
+        "labels": payload.get("labels", [])
+    }
+
+
+async def process_review_job(job: ReviewJob):
+    """
+    Worker pool handler for a queued review job
+    
+    Raises:
+        ReviewDeferred: If a rate limit applies or the token budget is held by
+            reviews in progress (the job is rescheduled, not rejected)
+    """
+    if settings.rate_limit_enabled:
+        author = ReviewContext.from_payload(job.project_id, job.mr_iid, job.payload).username
+        decision = await rate_limiter.acquire(review_rate_limits(job.project_id, job.mr_iid, author))
+        if not decision.allowed:
+            raise ReviewDeferred(decision.retry_after, f"rate limit '{decision.key}' reached")
+    
+    await process_code_review(
+        job.project_id, job.mr_iid, job.payload,
+        final_attempt=job.attempts >= review_queue.max_attempts
+    )
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Check whether an error is worth retrying (GitLab/Anthropic 5xx or 429, timeouts, dropped connections)"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+async def process_code_review(
+    project_id: int,
+    mr_iid: int,
+    payload: Optional[Dict] = None,
+    final_attempt: bool = True
+):
     """
     Process code review for a merge request
     
     Args:
         project_id: GitLab project ID
         mr_iid: Merge request IID
+        payload: Trimmed webhook payload (title, description, project path, head SHA)
+        final_attempt: False if the queue will retry the job; transient errors are
+            then re-raised instead of being reported on the MR
+    
+    Raises:
+        httpx.HTTPError: Transient GitLab/Anthropic error while attempts remain
+        ReviewDeferred: If the token budget is held by reviews in progress
     """
     try:
         logger.info(f"Starting code review for MR {mr_iid} in project {project_id}")
         
-        # Check rate limit
-        if settings.rate_limit_enabled:
-            if not check_rate_limit():
-                error_msg = "⚠️ Rate limit exceeded. Please try again later."
-                await gitlab.post_merge_request_comment(project_id, mr_iid, error_msg)
-                return
-        
-        # Fetch MR details and changes
-        mr_details = await gitlab.get_merge_request(project_id, mr_iid)
-        mr_changes = await gitlab.get_merge_request_changes(project_id, mr_iid)
-        
-        mr_title = mr_details.get("title", "")
-        mr_description = mr_details.get("description", "")
-        
-        # Extract author information for token tracking
-        author = mr_details.get("author", {})
-        username = author.get("username", "unknown")
-        
-        # Extract project name from web_url or use project_id as fallback
-        project_web_url = mr_details.get("web_url", "")
-        if project_web_url and "/merge_requests/" in project_web_url:
-            # Extract project path from URL (e.g., "root/python-test-app")
-            before_mr = project_web_url.split("/merge_requests/")[0]
-            path_segments = before_mr.strip("/").split("/")
-            if len(path_segments) >= 2:
-                project_name = "/".join(path_segments[-2:])
+        # Context comes from the webhook payload; only the diff needs fetching.
+        # Anything the payload lacks (e.g. the author when someone else added
+        # the label) is fetched concurrently with the diff.
+        context = ReviewContext.from_payload(project_id, mr_iid, payload)
+        details_task = None
+        if context.needs_merge_request_details():
+            details_task = asyncio.create_task(gitlab.get_merge_request(project_id, mr_iid))
+        
+        already_reviewed = None
+        try:
+            # Incremental review: only what was pushed since the last review
+            last_reviewed = None
+            if settings.incremental_review_enabled and not context.full_review_requested:
+                if context.head_sha is None and details_task:
+                    context.update_from_merge_request(await details_task)
+                last_reviewed = await review_state.get_last_reviewed(project_id, mr_iid)
+            
+            if last_reviewed and last_reviewed == context.head_sha:
+                # Label re-applied or webhook redelivered without a new push: repost
+                # the cached review of the full diff if there is one, else say so
+                logger.info(f"MR {mr_iid} already reviewed at {last_reviewed[:8]}, no new commits")
+                if not settings.review_cache_enabled:
+                    if details_task:
+                        details_task.cancel()
+                    await gitlab.post_merge_request_comment(project_id, mr_iid, already_reviewed_note(last_reviewed))
+                    return
+                already_reviewed, last_reviewed = last_reviewed, None
+            
+            if last_reviewed and context.head_sha and not await gitlab.is_ancestor(
+                context.commit_project_id, last_reviewed, context.head_sha
+            ):
+                # Force-push or rebase: the compare range would not be what changed
+                logger.info(
+                    f"Last reviewed commit {last_reviewed[:8]} is not an ancestor of "
+                    f"{context.head_sha[:8]} in MR {mr_iid}, reviewing the full diff"
+                )
+                last_reviewed = None
+            
+            review_scope = None
+            if last_reviewed and context.head_sha:
+                review_scope = (
+                    f"Only the commits pushed since the last AI review "
+                    f"({last_reviewed[:8]} → {context.head_sha[:8]}); earlier changes were already reviewed."
+                )
+                changes = gitlab.iter_compare_diffs(
+                    context.commit_project_id, last_reviewed, context.head_sha
+                )
             else:
-                project_name = str(project_id)
-        else:
-            project_name = str(project_id)
+                changes = gitlab.iter_merge_request_diffs(project_id, mr_iid)
+            
+            filter_report = FilterReport()
+            try:
+                file_changes, diff, diff_lines = await collect_review_diff(changes, project_id, filter_report)
+            except httpx.HTTPStatusError as e:
+                if review_scope is None or e.response.status_code != 404:
+                    raise
+                logger.info(f"Compare from {last_reviewed[:8]} not found for MR {mr_iid}, reviewing the full diff")
+                last_reviewed = review_scope = None
+                filter_report = FilterReport()
+                file_changes, diff, diff_lines = await collect_review_diff(
+                    gitlab.iter_merge_request_diffs(project_id, mr_iid), project_id, filter_report
+                )
+        except BaseException:
+            if details_task:
+                details_task.cancel()
+            raise
         
-        # Format diff for review
-        diff = gitlab.format_diff_for_review(mr_changes)
+        if details_task:
+            context.update_from_merge_request(await details_task)
         
-        # Check diff size
-        diff_lines = len(diff.split("\n"))
-        if diff_lines > settings.max_diff_size_lines:
-            error_msg = f"⚠️ Diff too large ({diff_lines} lines). Maximum is {settings.max_diff_size_lines} lines."
+        # Check diff size (large diffs are reviewed in chunks when enabled)
+        diff_tokens = estimator.estimate(diff)
+        oversized = diff_lines > settings.max_diff_size_lines or diff_tokens > settings.max_diff_tokens
+        if oversized and not settings.chunked_review_enabled:
+            error_msg = (
+                f"⚠️ Diff too large ({diff_lines:,} lines, ~{diff_tokens:,} tokens). "
+                f"Maximum is {settings.max_diff_size_lines:,} lines / {settings.max_diff_tokens:,} tokens."
+            )
             await gitlab.post_merge_request_comment(project_id, mr_iid, error_msg)
             return
         
+        if filter_report.skipped:
+            logger.info(
+                f"Skipped {len(filter_report.skipped)} file(s) from MR {mr_iid} "
+                f"(~{filter_report.tokens_saved:,} tokens saved)"
+            )
+        
         if not diff.strip():
-            await gitlab.post_merge_request_comment(
-                project_id, mr_iid, 
-                "ℹ️ No code changes detected to review."
+            message = (
+                "ℹ️ No new code changes since the last review." if review_scope
+                else "ℹ️ No code changes detected to review."
             )
+            if filter_report.skipped:
+                message += f"\n\n{filter_report.format_note()}"
+            await gitlab.post_merge_request_comment(project_id, mr_iid, message)
+            await review_state.mark_reviewed(project_id, mr_iid, context.head_sha)
             return
         
-        # Get AI review from Claude (with budget check and token tracking)
-        logger.info(f"Requesting review from Claude for MR {mr_iid}")
-        review = await reviewer.review_code(
-            diff, mr_title, mr_description,
-            project_id, project_name, mr_iid, username
+        scope_note = (
+            f"Incremental review of changes since `{last_reviewed[:8]}` "
+            f"(add `{settings.gitlab_full_review_label}` for a full review)"
+            if review_scope else None
         )
+        filter_note = filter_report.format_note()
+        
+        # Identical diff reviewed before (label re-added, content-neutral rebase)?
+        cache_key = None
+        review = None
+        if settings.review_cache_enabled:
+            cache_key = review_cache.make_key(diff, PROMPT_VERSION, reviewer.model, reviewer.max_tokens)
+            review = await review_cache.get(cache_key)
+        cache_hit = review is not None
+        
+        if already_reviewed and not cache_hit:
+            # Nothing was pushed since the last review; don't pay for the same review twice
+            await gitlab.post_merge_request_comment(project_id, mr_iid, already_reviewed_note(already_reviewed))
+            return
+        
+        # Low-priority reviews wait for the next Message Batch (results posted by the batch processor)
+        if not cache_hit and not oversized and settings.batch_review_enabled and context.low_priority:
+            await queue_batch_review(diff, context, review_scope, scope_note, filter_note, cache_key, payload)
+            return
+        
+        # Single-pass reviews stream into a placeholder note that is edited as tokens arrive
+        progress_note = None
+        if settings.anthropic_streaming and not cache_hit and not oversized:
+            progress_note = ReviewProgressNote(
+                gitlab, project_id, mr_iid,
+                render=lambda text: format_review_comment(text, scope_note, filter_note)
+            )
+            await progress_note.start()
+        
+        if cache_hit:
+            logger.info(f"Review cache hit for MR {mr_iid}; posting stored review (0 tokens)")
+        else:
+            # Get AI review from Claude (with budget check and token tracking)
+            logger.info(f"Requesting {'incremental' if review_scope else 'full'} review from Claude for MR {mr_iid}")
+            on_progress = progress_note.update if progress_note else None
+            try:
+                if oversized:
+                    review, complete = await review_large_diff(file_changes, context, review_scope)
+                elif settings.file_review_cache_enabled:
+                    review, complete = await review_with_file_cache(
+                        file_changes, context, review_scope, on_progress
+                    )
+                else:
+                    review = await reviewer.review_code(
+                        diff, context.mr_title, context.mr_description,
+                        project_id, context.project_name, mr_iid, context.author,
+                        review_scope=review_scope,
+                        on_progress=on_progress
+                    )
+                    complete = True
+            except BaseException:
+                # Budget/error comments are posted separately; don't leave a stuck placeholder
+                if progress_note:
+                    await progress_note.discard()
+                raise
+            
+            # Partial reviews are not cached so a retry can fill the gaps
+            if cache_key and complete:
+                await review_cache.put(cache_key, review, reviewer.model)
         
-        # Format and post review comment
-        comment = format_review_comment(review)
-        await gitlab.post_merge_request_comment(project_id, mr_iid, comment)
+        # Format and post review comment (replacing the progress note if there is one)
+        if cache_hit:
+            cache_note = "Reused from an earlier review of an identical diff"
+            scope_note = f"{scope_note} • {cache_note}" if scope_note else cache_note
+        comment = format_review_comment(review, scope_note, filter_note)
+        if progress_note:
+            await progress_note.publish(comment)
+        else:
+            await gitlab.post_merge_request_comment(project_id, mr_iid, comment)
+        await review_state.mark_reviewed(project_id, mr_iid, context.head_sha)
         
         logger.info(f"✅ Successfully completed review for MR {mr_iid}")
         
+    except ReviewDeferred:
+        # Budget held by reviews in progress; the worker pool reschedules the job
+        raise
+        
     except TokenBudgetExceeded as e:
         logger.warning(f"Token budget exhausted for MR {mr_iid}: {str(e)}")
         
-        # Post budget exhausted message to MR
-        budget_msg = f"""⚠️ **Daily Token Budget Exhausted**
+        # Post budget exhausted message to MR (naming the exhausted quota)
+        heading, explanation = QUOTA_EXHAUSTED_TEXT.get(e.quota, QUOTA_EXHAUSTED_TEXT["global"])
+        budget_msg = f"""⚠️ **{heading}**
 
 {str(e)}
 
-The AI code review service has reached its daily token limit. Reviews will automatically resume tomorrow.
+{explanation} Reviews will automatically resume tomorrow.
 
 **Budget Details:**
 - Check the budget status at: `GET /budget/status`
+- Check this project's quotas at: `GET /budget/quotas?project_id={project_id}`
 - Reviews will resume at midnight UTC
 
 **What you can do:**
@@ -211,6 +674,11 @@ The AI code review service has reached its daily token limit. Reviews will autom
         await gitlab.post_merge_request_comment(project_id, mr_iid, budget_msg)
         
     except Exception as e:
+        if not final_attempt and is_transient_error(e):
+            # The worker pool re-queues the job; only the last attempt reports on the MR
+            logger.warning(f"Transient error during code review of MR {mr_iid}, will retry: {str(e)}")
+            raise
+        
         logger.error(f"Error during code review: {str(e)}", exc_info=True)
         
         # Post error comment to MR
@@ -229,38 +697,320 @@ Please check the agent logs for details or contact support."""
             logger.error("Failed to post error comment to GitLab")
 
 
-def check_rate_limit() -> bool:
-    """Simple rate limiter check"""
-    global review_timestamps
+async def queue_batch_review(
+    diff: str,
+    context: ReviewContext,
+    review_scope: Optional[str],
+    scope_note: Optional[str],
+    filter_note: str,
+    cache_key: Optional[str],
+    payload: Optional[Dict]
+) -> None:
+    """
+    Add a low-priority review to the next Message Batch
+    
+    The prompt is built now (the diff is not fetched again); the batch
+    processor posts the review when the batch ends. Its worst-case tokens are
+    reserved now and held until the result is handled, so reviews queued
+    together can't overshoot the budget.
+    
+    Raises:
+        TokenBudgetExceeded: If today's budget or one of the MR's quotas can't cover the review
+    """
+    params, raw_estimate = reviewer.build_review_request(
+        diff, context.mr_title, context.mr_description, review_scope
+    )
+    
+    reservation = None
+    if settings.token_budget_enabled:
+        reservation, _, message, quota = await tracker.reserve(
+            estimator.scale_raw(raw_estimate) + reviewer.max_tokens,
+            context.project_id, context.project_name, context.author,
+            ttl=BATCH_RESERVATION_TTL
+        )
+        if reservation is None:
+            raise TokenBudgetExceeded(message, quota)
+    
+    request = BatchRequest(
+        custom_id=BatchRequest.new_custom_id(context.project_id, context.mr_iid),
+        project_id=context.project_id,
+        mr_iid=context.mr_iid,
+        head_sha=context.head_sha,
+        project_name=context.project_name,
+        username=context.author,
+        params=params,
+        raw_estimate=raw_estimate,
+        payload=payload or {},
+        scope_note=scope_note,
+        filter_note=filter_note,
+        cache_key=cache_key,
+        reservation_id=reservation.id if reservation else None,
+        reserved_tokens=reservation.tokens if reservation else 0,
+        reservation_owner=PROCESS_ID
+    )
+    
+    try:
+        note = await gitlab.post_merge_request_comment(
+            context.project_id, context.mr_iid,
+            "🕒 **AI code review queued** as a low-priority batch review. "
+            "The review will replace this note when it is ready (usually within an hour)."
+        )
+        request.note_id = note.get("id")
+    except Exception as e:
+        logger.warning(f"Failed to post batch queued note for MR {context.mr_iid}: {e}")
+    
+    try:
+        replaced = await batch_store.add(request)
+    except BaseException:
+        tracker.release(reservation)
+        raise
+    if replaced:
+        tracker.release(batch_reservation(replaced))
+        if replaced.note_id:
+            await delete_note_quietly(context.project_id, context.mr_iid, replaced.note_id)
+    logger.info(f"Review of MR {context.mr_iid} added to the next Message Batch ({request.custom_id})")
+
+
+async def handle_batch_result(request: BatchRequest, message: Optional[Dict], error: Optional[str]) -> None:
+    """
+    Post a batched review, or fall back to a standard queued review if it failed
+    
+    Args:
+        request: The batch request
+        message: Messages API response (None if the request failed)
+        error: Failure description (errored, expired, canceled)
+    
+    Usage is recorded last, after every step that can fail, so a handler
+    retried on the next poll does not count the review twice.
+    """
+    reservation = batch_reservation(request)
+    if message is None:
+        logger.warning(f"Batched review of MR {request.mr_iid} failed ({error}); re-queueing as a standard review")
+        tracker.release(reservation)
+        if request.note_id:
+            await delete_note_quietly(request.project_id, request.mr_iid, request.note_id)
+        await review_queue.enqueue(
+            request.project_id, request.mr_iid, request.head_sha,
+            {**request.payload, "batch_failed": True}
+        )
+        return
+    
+    review = message["content"][0]["text"]
+    if request.cache_key:
+        await review_cache.put(request.cache_key, review, reviewer.model)
+    
+    comment = format_review_comment(review, request.scope_note, request.filter_note)
+    posted = False
+    if request.note_id:
+        try:
+            await gitlab.update_merge_request_comment(request.project_id, request.mr_iid, request.note_id, comment)
+            posted = True
+        except Exception as e:
+            logger.warning(f"Failed to update batch queued note for MR {request.mr_iid}, posting a new one: {e}")
+    if not posted:
+        await gitlab.post_merge_request_comment(request.project_id, request.mr_iid, comment)
+    await review_state.mark_reviewed(request.project_id, request.mr_iid, request.head_sha)
+    
+    submitted = datetime.fromisoformat(request.created_at.rstrip("Z"))
+    await reviewer.record_batch_usage(
+        message.get("usage", {}), request.raw_estimate,
+        request.project_id, request.project_name, request.mr_iid, request.username,
+        duration_ms=int((datetime.utcnow() - submitted).total_seconds() * 1000),
+        reservation=reservation
+    )
+    logger.info(f"✅ Posted batched review for MR {request.mr_iid}")
+
+
+def batch_reservation(request: BatchRequest) -> Optional[TokenReservation]:
+    """Budget reservation still held for a batch request (None if there is none or it was lost)"""
+    if request.reservation_id is None:
+        return None
+    return tracker.resume(request.reservation_id, request.reserved_tokens, request.reservation_owner)
+
+
+async def delete_note_quietly(project_id: int, mr_iid: int, note_id: int) -> None:
+    """Delete a status note, logging (not raising) failures"""
+    try:
+        await gitlab.delete_merge_request_comment(project_id, mr_iid, note_id)
+    except Exception as e:
+        logger.warning(f"Failed to delete note {note_id} on MR {mr_iid}: {e}")
+
+
+async def collect_review_diff(
+    changes: AsyncIterator[Dict],
+    project_id: int,
+    filter_report: FilterReport
+) -> Tuple[List[Dict], str, int]:
+    """
+    Filter and format file diffs as they stream in from GitLab
+    
+    Without chunked review, stops consuming as soon as the diff exceeds
+    MAX_DIFF_SIZE_LINES (the review would be rejected anyway).
+    
+    Args:
+        changes: File diffs (MR diffs or compare API)
+        project_id: Project whose diff filter rules apply
+        filter_report: Collects the files skipped by the diff filter
+    
+    Returns:
+        (file_changes, formatted_diff, line_count)
+    """
+    file_changes = []
+    diff_parts = []
+    diff_lines = 0
+    
+    try:
+        async for change in changes:
+            part = gitlab.format_file_diff(change)
+            if not part or not diff_filter.filter_change(change, project_id, filter_report):
+                continue
+            file_changes.append(change)
+            diff_parts.append(part)
+            diff_lines += part.count("\n") + 1
+            if diff_lines > settings.max_diff_size_lines and not settings.chunked_review_enabled:
+                break
+    finally:
+        # Stop any page prefetches still in flight
+        await changes.aclose()
+    
+    return file_changes, "\n".join(diff_parts), diff_lines
+
+
+async def review_large_diff(
+    file_changes: List[Dict],
+    context: ReviewContext,
+    review_scope: Optional[str]
+) -> Tuple[str, bool]:
+    """
+    Review a diff above MAX_DIFF_SIZE_LINES in token-bounded chunks
     
-    now = datetime.utcnow().timestamp()
-    hour_ago = now - 3600
+    At most REVIEW_MAX_CHUNKS chunks are reviewed; files beyond that are
+    listed in the review as not covered.
     
-    # Remove old timestamps
-    review_timestamps = [ts for ts in review_timestamps if ts > hour_ago]
+    Returns:
+        (review, True if the whole diff was covered)
+    """
+    # CPU-bound for huge diffs - keep it off the event loop
+    chunks = await asyncio.to_thread(
+        split_changes_into_chunks, file_changes, gitlab.format_file_diff, settings.review_chunk_max_tokens
+    )
     
-    # Check limit
-    if len(review_timestamps) >= settings.max_reviews_per_hour:
-        logger.warning("Rate limit exceeded")
-        return False
+    skipped_files = []
+    if len(chunks) > settings.review_max_chunks:
+        reviewed_files = {f for chunk in chunks[:settings.review_max_chunks] for f in chunk.files}
+        for chunk in chunks[settings.review_max_chunks:]:
+            skipped_files.extend(f for f in chunk.files if f not in reviewed_files and f not in skipped_files)
+        logger.warning(
+            f"MR {context.mr_iid} needs {len(chunks)} chunks; reviewing the first {settings.review_max_chunks}"
+        )
+        chunks = chunks[:settings.review_max_chunks]
+    
+    review, complete = await reviewer.review_chunks(
+        chunks, context.mr_title, context.mr_description,
+        context.project_id, context.project_name, context.mr_iid, context.author,
+        review_scope=review_scope
+    )
     
-    # Add current timestamp
-    review_timestamps.append(now)
-    return True
+    if skipped_files:
+        review += (
+            f"\n\n⚠️ **Size limit:** Only the first {settings.review_max_chunks} parts were reviewed. "
+            f"Not covered: {', '.join(f'`{f}`' for f in skipped_files)}"
+        )
+    return review, complete and not skipped_files
 
 
-def format_review_comment(review: str) -> str:
+async def review_with_file_cache(
+    file_changes: List[Dict],
+    context: ReviewContext,
+    review_scope: Optional[str],
+    on_progress: Optional[ProgressCallback] = None
+) -> Tuple[str, bool]:
+    """
+    Review only files whose diff changed since their last review
+    
+    Findings are cached per file (keyed on the file's normalised diff, prompt
+    version, model and max_tokens); cached findings are merged back into the
+    posted review. on_progress receives the streamed review of the changed files.
+    
+    Returns:
+        (review, True if every file has findings)
+    """
+    paths = []
+    parts = {}
+    for change in file_changes:
+        path = change.get("new_path") or change.get("old_path")
+        if path not in parts:
+            paths.append(path)
+            parts[path] = gitlab.format_file_diff(change)
+    
+    keys = {
+        path: file_review_cache.make_key(parts[path], PROMPT_VERSION, reviewer.model, reviewer.max_tokens)
+        for path in paths
+    }
+    cached = {}
+    for path in paths:
+        findings = await file_review_cache.get(keys[path])
+        if findings is not None:
+            cached[path] = findings
+    
+    pending = [path for path in paths if path not in cached]
+    fresh: Dict[str, str] = {}
+    if pending:
+        scope = review_scope
+        if cached:
+            unchanged = f"{len(cached)} other file(s) are unchanged since their last review and are not shown."
+            scope = f"{review_scope} {unchanged}" if review_scope else unchanged
+        
+        summary, fresh = await reviewer.review_files(
+            "\n".join(parts[path] for path in pending), pending,
+            context.mr_title, context.mr_description,
+            context.project_id, context.project_name, context.mr_iid, context.author,
+            review_scope=scope,
+            on_progress=on_progress
+        )
+        for path, findings in fresh.items():
+            await file_review_cache.put(keys[path], findings, reviewer.model)
+    else:
+        summary = "No file changed since its last review; the findings below are from earlier reviews."
+    
+    logger.info(
+        f"MR {context.mr_iid}: {len(fresh)} file(s) reviewed, {len(cached)} from the per-file cache"
+    )
+    
+    sections = []
+    for path in paths:
+        if path in fresh:
+            sections.append(f"### File: {path}\n\n{fresh[path]}")
+        elif path in cached:
+            sections.append(f"### File: {path} *(unchanged, from an earlier review)*\n\n{cached[path]}")
+    
+    review = "\n\n".join([summary] + sections)
+    return review, len(fresh) + len(cached) == len(paths)
+
+
+def format_review_comment(
+    review: str,
+    scope_note: Optional[str] = None,
+    filter_note: Optional[str] = None
+) -> str:
     """Format the AI review into a nice GitLab comment"""
+    scope_line = f"*{scope_note}*\n\n" if scope_note else ""
+    filter_line = f"\n\n{filter_note}" if filter_note else ""
     
     return f"""## 🤖 AI Code Review (Claude Sonnet 4)
 
-{review}
+{scope_line}{review}{filter_line}
 
 ---
 *Generated by Code Review Agent • Powered by Anthropic Claude*
 """
 
 
+# Review worker pool and Message Batch processor (started/stopped by the app lifespan)
+worker_pool = ReviewWorkerPool(review_queue, process_review_job)
+batch_processor = BatchProcessor(batch_store, handle_batch_result)
+
+
 # Run the application
 if __name__ == "__main__":
     import uvicorn
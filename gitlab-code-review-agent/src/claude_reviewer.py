@@ -2,18 +2,33 @@
 """
 Claude-based code reviewer using Anthropic API
 """
+import re
+import json
+import time
 import httpx
 import logging
 import asyncio
-from typing import Dict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from datetime import datetime
 
 from src.config import settings
-from src.token_tracker import tracker, TokenUsage
-from src.exceptions import TokenBudgetExceeded
+from src.http_pool import create_http_client
+from src.diff_chunker import DiffChunk
+from src.token_tracker import tracker, TokenUsage, TokenReservation
+from src.token_estimator import estimator
+from src.exceptions import TokenBudgetExceeded, ReviewDeferred
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever the review/merge prompts change (invalidates cached reviews)
+PROMPT_VERSION = "3"
+
+# Per-file section headings requested by the per-file review prompt
+FILE_SECTION = re.compile(r"^### File: `?(.+?)`?\s*$", re.MULTILINE)
+
+# Receives the review text streamed so far
+ProgressCallback = Callable[[str], Awaitable[None]]
+
 
 class ClaudeReviewer:
     """Code reviewer using Claude Sonnet 4 via Anthropic API"""
@@ -23,13 +38,65 @@ class ClaudeReviewer:
         self.model = settings.anthropic_model
         self.max_tokens = settings.anthropic_max_tokens
         self.api_version = settings.anthropic_api_version
-        self.api_url = "https://api.anthropic.com/v1/messages"
+        self.base_url = settings.anthropic_base_url.rstrip('/')
+        self.api_url = f"{self.base_url}/v1/messages"
+        self.batches_url = f"{self.base_url}/v1/messages/batches"
         
         self.headers = {
             "x-api-key": self.api_key,
             "anthropic-version": self.api_version,
             "content-type": "application/json"
         }
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # Requests whose review was cancelled, left to finish so their usage is recorded
+        self._abandoned: Set[asyncio.Task] = set()
+    
+    async def start(self) -> None:
+        """Open the shared connection pool and pre-warm connections (app startup)"""
+        if self._client is None:
+            self._client = create_http_client(
+                "Anthropic",
+                headers=self.headers,
+                timeout=settings.review_timeout,
+                max_connections=settings.anthropic_max_connections,
+                max_keepalive_connections=settings.anthropic_max_connections,
+                keepalive_expiry=settings.http_keepalive_expiry,
+                http2=settings.anthropic_http2
+            )
+            await self._prewarm()
+    
+    async def close(self) -> None:
+        """Close the shared connection pool (app shutdown)"""
+        if self._abandoned:
+            # Their usage is billed; record it before the tracker closes
+            await asyncio.gather(*self._abandoned, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Get the shared client, opening it lazily outside the app lifespan"""
+        if self._client is None:
+            await self.start()
+        return self._client
+    
+    async def _prewarm(self) -> None:
+        """Establish connections ahead of the first review (TCP + TLS handshake)"""
+        count = settings.anthropic_prewarm_connections
+        if count <= 0:
+            return
+        
+        # Any response means the connection is open; the status code is irrelevant
+        results = await asyncio.gather(
+            *(self._client.head(self.base_url, timeout=5.0) for _ in range(count)),
+            return_exceptions=True
+        )
+        failures = [r for r in results if isinstance(r, Exception)]
+        if failures:
+            logger.warning(f"Anthropic connection pre-warm failed ({len(failures)}/{count}): {failures[0]}")
+        else:
+            logger.info(f"Pre-warmed {count} Anthropic connection(s)")
     
     async def review_code(
         self,
@@ -39,7 +106,9 @@ class ClaudeReviewer:
         project_id: int,
         project_name: str,
         mr_iid: int,
-        username: str
+        username: str,
+        review_scope: Optional[str] = None,
+        on_progress: Optional[ProgressCallback] = None
     ) -> str:
         """
         Review code changes using Claude with retry logic and token tracking
@@ -52,6 +121,8 @@ class ClaudeReviewer:
             project_name: GitLab project name
             mr_iid: Merge request IID
             username: User who created the MR
+            review_scope: Optional note on what the diff covers (e.g. incremental range)
+            on_progress: Called with the partial review while it streams (ANTHROPIC_STREAMING)
             
         Returns:
             AI-generated code review
@@ -59,92 +130,561 @@ class ClaudeReviewer:
         Raises:
             TokenBudgetExceeded: If daily token budget is exhausted
         """
-        # CHECK BUDGET BEFORE API CALL
+        prompt = self._build_review_prompt(diff, mr_title, mr_description, review_scope)
+        return await self._send_prompt(
+            REVIEW_SYSTEM_PROMPT, prompt, project_id, project_name, mr_iid, username,
+            on_progress=on_progress
+        )
+    
+    async def review_files(
+        self,
+        diff: str,
+        paths: List[str],
+        mr_title: str,
+        mr_description: str,
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        review_scope: Optional[str] = None,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> Tuple[str, Dict[str, str]]:
+        """
+        Review code changes with findings grouped per file (for per-file caching)
+        
+        Args:
+            diff: Formatted diff of the files to review
+            paths: File paths in the diff
+            (remaining args as for review_code)
+            
+        Returns:
+            (summary, {path: findings}); files Claude gave no section are missing
+            
+        Raises:
+            TokenBudgetExceeded: If daily token budget is exhausted
+        """
+        prompt = self._build_review_prompt(diff, mr_title, mr_description, review_scope)
+        review = await self._send_prompt(
+            PER_FILE_REVIEW_SYSTEM_PROMPT, prompt, project_id, project_name, mr_iid, username,
+            on_progress=on_progress
+        )
+        
+        sections: Dict[str, str] = {}
+        headings = list(FILE_SECTION.finditer(review))
+        summary = review[:headings[0].start()].strip() if headings else review.strip()
+        for heading, following in zip(headings, headings[1:] + [None]):
+            path = heading.group(1).strip()
+            if path in paths:
+                end = following.start() if following else len(review)
+                sections[path] = review[heading.end():end].strip()
+        
+        return summary, sections
+    
+    async def review_chunks(
+        self,
+        chunks: List[DiffChunk],
+        mr_title: str,
+        mr_description: str,
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        review_scope: Optional[str] = None
+    ) -> Tuple[str, bool]:
+        """
+        Map-reduce review for diffs too large for one request
+        
+        Chunks are reviewed concurrently (at most REVIEW_CHUNK_CONCURRENCY at a
+        time), then a final pass merges the partial reviews into one. If some
+        chunks fail with an API or network error, the merged review covers the
+        rest and lists what was missed. Any other error (e.g. a chunk's budget
+        reservation being refused or deferred) cancels the remaining chunks and
+        is raised, so the job is rejected or re-queued as a whole.
+        
+        Args:
+            chunks: Token-bounded slices of the MR diff
+            (remaining args as for review_code)
+            
+        Returns:
+            (merged AI-generated code review, True if every chunk and the merge succeeded)
+            
+        Raises:
+            TokenBudgetExceeded: If a chunk's reservation can't be covered
+            ReviewDeferred: If a chunk (or the merge pass) must wait for reservations in progress
+            httpx.HTTPError: If every chunk failed
+        """
+        semaphore = asyncio.Semaphore(settings.review_chunk_concurrency)
+        total = len(chunks)
+        
+        async def review_chunk(index: int, chunk: DiffChunk) -> str:
+            async with semaphore:
+                chunk_scope = f"Part {index + 1} of {total} of a large merge request (other parts are reviewed separately)."
+                if review_scope:
+                    chunk_scope = f"{review_scope} {chunk_scope}"
+                return await self.review_code(
+                    chunk.text, mr_title, mr_description,
+                    project_id, project_name, mr_iid, username,
+                    review_scope=chunk_scope
+                )
+        
+        logger.info(f"Reviewing MR {mr_iid} in {total} chunks (concurrency {settings.review_chunk_concurrency})")
+        tasks = [asyncio.create_task(review_chunk(i, chunk)) for i, chunk in enumerate(chunks)]
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    error = task.exception()
+                    if error is not None and not isinstance(error, httpx.HTTPError):
+                        raise error
+        finally:
+            # Stop chunks still waiting or running once the review as a whole has failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        
+        partials = []
+        failed_files = []
+        errors = []
+        for i, (chunk, task) in enumerate(zip(chunks, tasks)):
+            result = task.exception() or task.result()
+            if isinstance(result, BaseException):
+                logger.error(f"Chunk {i + 1}/{total} for MR {mr_iid} failed: {result}")
+                failed_files.extend(f for f in chunk.files if f not in failed_files)
+                errors.append(result)
+            else:
+                partials.append((i, result))
+        
+        if not partials:
+            raise errors[0]
+        
+        # Reduce: merge partial reviews into one (fall back to the raw partials)
+        merge_failed = False
+        if len(partials) == 1:
+            merged = partials[0][1]
+        else:
+            merge_prompt = self._build_merge_prompt(partials, total, mr_title, mr_description)
+            try:
+                merged = await self._send_prompt(
+                    MERGE_SYSTEM_PROMPT, merge_prompt, project_id, project_name, mr_iid, username
+                )
+            except ReviewDeferred:
+                raise
+            except Exception as e:
+                logger.error(f"Merge pass for MR {mr_iid} failed, posting partial reviews: {e}")
+                merged = "\n\n".join(f"### Part {i + 1} of {total}\n\n{text}" for i, text in partials)
+                merge_failed = True
+        
+        if failed_files:
+            merged += (
+                f"\n\n⚠️ **Partial review:** {len(errors)} of {total} parts could not be reviewed. "
+                f"Files not fully covered: {', '.join(f'`{f}`' for f in failed_files)}"
+            )
+        return merged, not errors and not merge_failed
+    
+    async def _send_prompt(
+        self,
+        system: str,
+        prompt: str,
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> str:
+        """
+        Send one prompt to Claude with budget reservation, retries and token tracking
+        
+        Args:
+            system: Static instructions (sent as a cacheable system prompt)
+            prompt: Per-MR content (user message)
+            on_progress: Stream the response, calling this with the text so far
+            
+        Returns:
+            Response text
+            
+        Raises:
+            TokenBudgetExceeded: If the budget (or a group/project/user quota) can't cover
+                this prompt's reservation
+            ReviewDeferred: If it could once the reservations of reviews in progress settle
+        """
+        # RESERVE BUDGET BEFORE API CALL (estimated prompt + worst-case output)
+        raw_estimate = estimator.count_raw(system) + estimator.count_raw(prompt)
+        reservation = None
         if settings.token_budget_enabled:
-            allowed, tokens_used, message = await tracker.check_budget()
-            if not allowed:
-                logger.warning(f"Token budget exhausted for MR {mr_iid}: {message}")
-                raise TokenBudgetExceeded(message)
+            reservation, tokens_used, message, quota = await tracker.reserve(
+                estimator.scale_raw(raw_estimate) + self.max_tokens,
+                project_id, project_name, username
+            )
+            if reservation is None:
+                logger.warning(f"Token budget insufficient for MR {mr_iid}: {message}")
+                raise TokenBudgetExceeded(message, quota)
             
-            if tokens_used >= settings.token_warning_threshold:
+            if tokens_used >= tracker.warning_threshold:
                 logger.warning(f"Token budget warning for MR {mr_iid}: {message}")
         
+        abandoned = False
+        
+        async def forward_progress(text: str) -> None:
+            if not abandoned:
+                await on_progress(text)
+        
+        task = asyncio.create_task(self._settle_prompt(
+            system, prompt, raw_estimate, reservation,
+            project_id, project_name, mr_iid, username,
+            forward_progress if on_progress is not None else None
+        ))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                # The request in flight is billed whether or not anyone reads the
+                # answer: let it finish (without retries or progress updates) so
+                # its actual usage is recorded, and discard the review
+                abandoned = True
+                self._abandoned.add(task)
+                task.add_done_callback(self._abandon_done)
+                logger.info(f"Review request for MR {mr_iid} cancelled; recording its usage once it completes")
+            raise
+    
+    async def _settle_prompt(
+        self,
+        system: str,
+        prompt: str,
+        raw_estimate: int,
+        reservation: Optional[TokenReservation],
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> str:
+        """Run _post_prompt and free the reservation if it did not commit it"""
+        try:
+            return await self._post_prompt(
+                system, prompt, raw_estimate, reservation,
+                project_id, project_name, mr_iid, username, on_progress
+            )
+        finally:
+            # No-op once committed; frees the tokens if the request failed
+            tracker.release(reservation)
+    
+    def _abandon_done(self, task: asyncio.Task) -> None:
+        """Forget a finished abandoned request (its result is discarded)"""
+        self._abandoned.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Abandoned review request failed: {task.exception()}")
+    
+    def _may_retry(self, attempt: int) -> bool:
+        """Check whether a failed attempt may be retried (not for abandoned requests)"""
+        return attempt < settings.max_retries - 1 and asyncio.current_task() not in self._abandoned
+    
+    async def _post_prompt(
+        self,
+        system: str,
+        prompt: str,
+        raw_estimate: int,
+        reservation: Optional[TokenReservation],
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> str:
+        """Call the Messages API with retries and commit the reservation on success"""
         # Record start time for duration tracking
         start_time = datetime.utcnow()
         
-        prompt = self._build_review_prompt(diff, mr_title, mr_description)
+        payload = self._build_payload(system, prompt)
         
-        payload = {
-            "model": self.model,
-            "max_tokens": self.max_tokens,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        }
+        stream = settings.anthropic_streaming and on_progress is not None
+        logger.info(
+            f"Sending review request to Claude ({self.model}) for MR {mr_iid}"
+            f"{' (streaming)' if stream else ''}"
+        )
         
-        logger.info(f"Sending review request to Claude ({self.model}) for MR {mr_iid}")
+        client = await self._get_client()
         
         for attempt in range(settings.max_retries):
             try:
-                async with httpx.AsyncClient(timeout=settings.review_timeout) as client:
-                    response = await client.post(
-                        self.api_url,
-                        headers=self.headers,
-                        json=payload
+                ttft_ms = 0
+                tokens_per_second = 0.0
+                if stream:
+                    review_text, usage_data, ttft_ms, tokens_per_second = await self._stream_message(
+                        client, payload, on_progress
                     )
+                    logger.info(
+                        f"Streamed review from Claude ({len(review_text)} chars, "
+                        f"first token after {ttft_ms} ms, {tokens_per_second:.1f} tokens/s)"
+                    )
+                else:
+                    response = await client.post(self.api_url, json=payload)
                     response.raise_for_status()
                     
                     result = response.json()
                     review_text = result["content"][0]["text"]
+                    usage_data = result.get("usage", {})
                     
                     logger.info(f"Received review from Claude ({len(review_text)} chars)")
+                
+                # RECORD TOKEN USAGE (only on successful response)
+                if settings.token_budget_enabled:
+                    duration_ms = int((datetime.utcnow() - start_time).total_seconds() * 1000)
                     
-                    # RECORD TOKEN USAGE (only on successful response)
-                    if settings.token_budget_enabled:
-                        duration_ms = int((datetime.utcnow() - start_time).total_seconds() * 1000)
-                        usage_data = result.get("usage", {})
-                        
-                        if usage_data:
-                            await tracker.record_usage(TokenUsage(
-                                project_id=project_id,
-                                project_name=project_name,
-                                mr_iid=mr_iid,
-                                username=username,
-                                input_tokens=usage_data.get("input_tokens", 0),
-                                output_tokens=usage_data.get("output_tokens", 0),
-                                total_tokens=(
-                                    usage_data.get("input_tokens", 0) + 
-                                    usage_data.get("output_tokens", 0)
-                                ),
-                                model=self.model,
-                                duration_ms=duration_ms
-                            ))
-                    
-                    return review_text
-                    
+                    if usage_data:
+                        usage = self._build_usage(
+                            usage_data, raw_estimate, project_id, project_name, mr_iid, username, duration_ms
+                        )
+                        usage.time_to_first_token_ms = ttft_ms
+                        usage.output_tokens_per_second = tokens_per_second
+                        await tracker.commit(reservation, usage)
+                
+                return review_text
+                
             except httpx.HTTPStatusError as e:
                 logger.error(f"Anthropic API error (attempt {attempt + 1}/{settings.max_retries}): {e.response.status_code} - {e.response.text}")
-                if attempt < settings.max_retries - 1 and e.response.status_code >= 500:
+                if self._may_retry(attempt) and e.response.status_code >= 500:
                     delay = self._calculate_retry_delay(attempt)
                     logger.info(f"Retrying in {delay:.1f} seconds...")
                     await asyncio.sleep(delay)
+                    if not self._may_retry(attempt):
+                        raise
                 else:
                     raise
             except (httpx.TimeoutException, httpx.NetworkError, httpx.ConnectError) as e:
                 logger.error(f"Network/timeout error (attempt {attempt + 1}/{settings.max_retries}): {str(e)}")
-                if attempt < settings.max_retries - 1:
+                if self._may_retry(attempt):
                     delay = self._calculate_retry_delay(attempt)
                     logger.info(f"Retrying in {delay:.1f} seconds...")
                     await asyncio.sleep(delay)
+                    if not self._may_retry(attempt):
+                        raise
                 else:
                     raise
             except Exception as e:
                 logger.error(f"Error calling Anthropic API: {str(e)}")
                 raise
     
+    async def _stream_message(
+        self,
+        client: httpx.AsyncClient,
+        payload: Dict,
+        on_progress: ProgressCallback
+    ) -> Tuple[str, Dict, int, float]:
+        """
+        Call the Messages API with server-sent events
+        
+        Args:
+            client: Shared Anthropic client
+            payload: Request body (without "stream")
+            on_progress: Called with the text so far, at most every REVIEW_STREAM_UPDATE_INTERVAL seconds
+            
+        Returns:
+            (review text, usage, time to first token in ms, output tokens per second)
+            
+        Raises:
+            httpx.HTTPStatusError: On an error status or an error event in the stream
+        """
+        started = time.monotonic()
+        first_token_at = None
+        last_progress = 0.0
+        parts: List[str] = []
+        usage: Dict = {}
+        
+        async with client.stream("POST", self.api_url, json={**payload, "stream": True}) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                response.raise_for_status()
+            
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                event_type = event.get("type")
+                
+                if event_type == "message_start":
+                    usage.update(event.get("message", {}).get("usage", {}))
+                elif event_type == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if not text:
+                        continue
+                    now = time.monotonic()
+                    if first_token_at is None:
+                        first_token_at = now
+                    parts.append(text)
+                    if now - last_progress >= settings.review_stream_update_interval:
+                        last_progress = now
+                        await on_progress("".join(parts))
+                elif event_type == "message_delta":
+                    # Cumulative output token count
+                    usage.update(event.get("usage", {}))
+                elif event_type == "error":
+                    # Mid-stream errors (e.g. overloaded) arrive after a 200 status
+                    error = event.get("error", {})
+                    status = 529 if error.get("type") == "overloaded_error" else 500
+                    raise httpx.HTTPStatusError(
+                        f"Stream error: {error.get('type')} - {error.get('message')}",
+                        request=response.request,
+                        response=httpx.Response(status, text=json.dumps(event), request=response.request)
+                    )
+        
+        finished = time.monotonic()
+        ttft_ms = int(((first_token_at or finished) - started) * 1000)
+        generation_seconds = finished - (first_token_at or finished)
+        output_tokens = usage.get("output_tokens", 0)
+        tokens_per_second = output_tokens / generation_seconds if generation_seconds > 0 else 0.0
+        return "".join(parts), usage, ttft_ms, tokens_per_second
+    
+    def build_review_request(
+        self,
+        diff: str,
+        mr_title: str,
+        mr_description: str,
+        review_scope: Optional[str] = None
+    ) -> Tuple[Dict, int]:
+        """
+        Build Messages API params for a review without sending them (for Message Batches)
+        
+        Returns:
+            (request params, raw prompt token estimate for record_batch_usage)
+        """
+        prompt = self._build_review_prompt(diff, mr_title, mr_description, review_scope)
+        raw_estimate = estimator.count_raw(REVIEW_SYSTEM_PROMPT) + estimator.count_raw(prompt)
+        return self._build_payload(REVIEW_SYSTEM_PROMPT, prompt), raw_estimate
+    
+    async def create_batch(self, requests: List[Dict]) -> Dict:
+        """
+        Submit a Message Batch
+        
+        Args:
+            requests: [{"custom_id": ..., "params": build_review_request() params}, ...]
+            
+        Returns:
+            Message Batch object (id, processing_status, ...)
+        """
+        logger.info(f"Submitting Message Batch with {len(requests)} review(s)")
+        response = await self._api_request("POST", self.batches_url, {"requests": requests})
+        return response.json()
+    
+    async def get_batch(self, batch_id: str) -> Dict:
+        """Get a Message Batch's processing status (results_url is set once it has ended)"""
+        response = await self._api_request("GET", f"{self.batches_url}/{batch_id}")
+        return response.json()
+    
+    async def get_batch_results(self, results_url: str) -> List[Dict]:
+        """
+        Download the results of an ended Message Batch
+        
+        Returns:
+            [{"custom_id": ..., "result": {"type": "succeeded" | "errored" | ..., ...}}, ...]
+        """
+        response = await self._api_request("GET", results_url)
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    
+    async def record_batch_usage(
+        self,
+        usage_data: Dict,
+        raw_estimate: int,
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        duration_ms: int,
+        reservation: Optional[TokenReservation] = None
+    ) -> None:
+        """Record a batched review's usage at batch pricing, swapping out its reservation"""
+        if not settings.token_budget_enabled or not usage_data:
+            tracker.release(reservation)
+            return
+        usage = self._build_usage(usage_data, raw_estimate, project_id, project_name, mr_iid, username, duration_ms)
+        usage.pricing_tier = "batch"
+        await tracker.commit(reservation, usage)
+    
+    async def _api_request(self, method: str, url: str, body: Optional[Dict] = None) -> httpx.Response:
+        """Call an Anthropic endpoint with the usual retries (5xx and network errors)"""
+        client = await self._get_client()
+        
+        for attempt in range(settings.max_retries):
+            try:
+                response = await client.request(method, url, json=body)
+                response.raise_for_status()
+                return response
+            except httpx.HTTPStatusError as e:
+                logger.error(f"Anthropic API error (attempt {attempt + 1}/{settings.max_retries}): {e.response.status_code} - {e.response.text}")
+                if attempt < settings.max_retries - 1 and e.response.status_code >= 500:
+                    delay = self._calculate_retry_delay(attempt)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
+                else:
+                    raise
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.ConnectError) as e:
+                logger.error(f"Network/timeout error (attempt {attempt + 1}/{settings.max_retries}): {str(e)}")
+                if attempt < settings.max_retries - 1:
+                    delay = self._calculate_retry_delay(attempt)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
+                else:
+                    raise
+    
+    def _build_usage(
+        self,
+        usage_data: Dict,
+        raw_estimate: int,
+        project_id: int,
+        project_name: str,
+        mr_iid: int,
+        username: str,
+        duration_ms: int
+    ) -> TokenUsage:
+        """TokenUsage from an API usage object (also refines the token estimator)"""
+        input_tokens = usage_data.get("input_tokens", 0)
+        output_tokens = usage_data.get("output_tokens", 0)
+        # input_tokens excludes the prompt-cache part of the prompt
+        cache_creation = usage_data.get("cache_creation_input_tokens") or 0
+        cache_read = usage_data.get("cache_read_input_tokens") or 0
+        estimator.observe(raw_estimate, input_tokens + cache_creation + cache_read)
+        return TokenUsage(
+            project_id=project_id,
+            project_name=project_name,
+            mr_iid=mr_iid,
+            username=username,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=input_tokens + cache_creation + cache_read + output_tokens,
+            model=self.model,
+            duration_ms=duration_ms,
+            estimated_input_tokens=raw_estimate,
+            cache_creation_input_tokens=cache_creation,
+            cache_read_input_tokens=cache_read
+        )
+    
+    def _build_payload(self, system: str, prompt: str) -> Dict:
+        """Messages API request body"""
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "system": self._build_system(system),
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        }
+    
+    def _build_system(self, system: str) -> List[Dict]:
+        """
+        System prompt blocks, marked as a prompt-cache breakpoint when enabled
+        
+        Anthropic only caches prefixes of at least 1024 tokens (2048 for Haiku);
+        the built-in instructions are shorter, so ANTHROPIC_PROMPT_CACHING is off
+        by default and only pays off with longer instructions.
+        """
+        block = {"type": "text", "text": system}
+        if settings.anthropic_prompt_caching:
+            block["cache_control"] = {"type": "ephemeral"}
+        return [block]
+    
     def _calculate_retry_delay(self, attempt: int) -> float:
         """
         Calculate exponential backoff delay
@@ -158,16 +698,43 @@ class ClaudeReviewer:
         delay = settings.retry_initial_delay * (settings.retry_backoff_factor ** attempt)
         return min(delay, settings.retry_max_delay)
     
-    def _build_review_prompt(self, diff: str, mr_title: str, mr_description: str) -> str:
-        """Build the prompt for Claude code review"""
+    def _build_merge_prompt(
+        self,
+        partials: List[Tuple[int, str]],
+        total: int,
+        mr_title: str,
+        mr_description: str
+    ) -> str:
+        """Build the per-MR part of the reduce prompt (instructions are in MERGE_SYSTEM_PROMPT)"""
+        sections = "\n\n".join(f"### Part {i + 1} of {total}\n\n{text}" for i, text in partials)
         
-        return f"""You are an expert code reviewer. Please review the following code changes from a merge request.
+        return f"""This merge request was reviewed in {total} parts.
 
 **Merge Request:** {mr_title}
 **Description:** {mr_description or "No description provided"}
 
+**Partial Reviews:**
+{sections}"""
+    
+    def _build_review_prompt(
+        self,
+        diff: str,
+        mr_title: str,
+        mr_description: str,
+        review_scope: Optional[str] = None
+    ) -> str:
+        """Build the per-MR part of the review prompt (instructions are in the system prompt)"""
+        scope_line = f"**Review Scope:** {review_scope}\n" if review_scope else ""
+        
+        return f"""**Merge Request:** {mr_title}
+**Description:** {mr_description or "No description provided"}
+{scope_line}
 **Code Changes:**
-{diff}
+{diff}"""
+
+
+# Static instructions sent as the (cacheable) system prompt
+REVIEW_INSTRUCTIONS = """You are an expert code reviewer. The user message contains the code changes from a merge request.
 
 Please provide a thorough code review focusing on:
 
@@ -179,12 +746,35 @@ Please provide a thorough code review focusing on:
 
 Format your review as:
 - Start with a brief summary
-- List specific issues with severity (🔴 Critical, ⚠️ Warning, ℹ️ Info)
+{issues_format}
 - Provide actionable recommendations
 - Be constructive and helpful
 
 Keep the review concise but thorough."""
 
+REVIEW_SYSTEM_PROMPT = REVIEW_INSTRUCTIONS.format(
+    issues_format="- List specific issues with severity (🔴 Critical, ⚠️ Warning, ℹ️ Info)"
+)
+
+PER_FILE_REVIEW_SYSTEM_PROMPT = REVIEW_INSTRUCTIONS.format(
+    issues_format=(
+        "- Then one section per changed file, headed exactly `### File: <path>`, "
+        "listing its issues with severity (🔴 Critical, ⚠️ Warning, ℹ️ Info) "
+        "or \"No issues found.\"\n"
+        "- Keep every finding inside its file's section"
+    )
+)
+
+MERGE_SYSTEM_PROMPT = """You are an expert code reviewer. A large merge request was reviewed in parts; combine the partial reviews in the user message into a single review.
+
+Merge them into one review:
+- Start with a brief summary of the whole merge request
+- Remove duplicate findings and keep the most specific version
+- List issues with severity (🔴 Critical, ⚠️ Warning, ℹ️ Info), most severe first
+- Keep file names and actionable recommendations
+
+Do not mention that the review was split into parts."""
+
 
 # Global reviewer instance
 reviewer = ClaudeReviewer()
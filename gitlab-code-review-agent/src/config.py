@@ -5,7 +5,7 @@ Loads and validates environment variables
 """
 from pydantic_settings import BaseSettings
 from pydantic import Field
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class Settings(BaseSettings):
@@ -16,6 +16,20 @@ class Settings(BaseSettings):
     gitlab_token: str = Field(..., description="GitLab API token")
     gitlab_webhook_secret: Optional[str] = Field(None, description="Webhook secret for validation")
     gitlab_trigger_label: str = Field(default="ai-review", description="Label to trigger reviews")
+    gitlab_full_review_label: str = Field(
+        default="ai-review-full",
+        description="Label to trigger a full (non-incremental) review"
+    )
+    gitlab_batch_review_label: str = Field(
+        default="ai-review-batch",
+        description="Label to trigger a low-priority review (sent via Message Batches when enabled)"
+    )
+    webhook_max_body_bytes: int = Field(default=2_000_000, description="Maximum accepted webhook body size in bytes")
+    gitlab_max_connections: int = Field(default=20, description="Maximum open connections to GitLab")
+    gitlab_max_keepalive_connections: int = Field(default=10, description="Idle GitLab connections kept alive")
+    gitlab_http2: bool = Field(default=False, description="Use HTTP/2 for GitLab API calls")
+    gitlab_diff_page_size: int = Field(default=50, description="File diffs per page from the MR diffs API (max 100)")
+    gitlab_diff_pages_in_flight: int = Field(default=3, description="Maximum diff pages fetched concurrently")
     
     # ===== Anthropic Configuration =====
     anthropic_api_key: str = Field(..., description="Anthropic API key")
@@ -31,19 +45,129 @@ class Settings(BaseSettings):
         default="2023-06-01",
         description="Anthropic API version"
     )
+    anthropic_base_url: str = Field(
+        default="https://api.anthropic.com",
+        description="Anthropic API base URL"
+    )
+    anthropic_max_connections: int = Field(default=10, description="Maximum pooled connections to Anthropic")
+    anthropic_http2: bool = Field(default=True, description="Use HTTP/2 for Anthropic API calls")
+    anthropic_prompt_caching: bool = Field(
+        default=False,
+        description="Mark the static review instructions for Anthropic prompt caching (only cached from 1024 tokens)"
+    )
+    anthropic_prewarm_connections: int = Field(
+        default=2,
+        description="Connections to open to Anthropic at startup (0 disables)"
+    )
+    anthropic_streaming: bool = Field(
+        default=True,
+        description="Stream single-pass reviews into a progressively updated MR note"
+    )
+    review_stream_update_interval: float = Field(
+        default=2.0,
+        description="Minimum seconds between edits of the in-progress review note"
+    )
     
     # ===== Application Configuration =====
     app_host: str = Field(default="0.0.0.0", description="Application host")
     app_port: int = Field(default=8000, description="Application port")
     log_level: str = Field(default="INFO", description="Logging level")
+    http_keepalive_expiry: float = Field(default=60.0, description="Seconds idle pooled connections stay open")
     
     # ===== Rate Limiting =====
     rate_limit_enabled: bool = Field(default=True, description="Enable rate limiting")
-    max_reviews_per_hour: int = Field(default=50, description="Maximum reviews per hour")
+    max_reviews_per_hour: float = Field(default=50, description="Sustained global review rate (per hour)")
+    rate_limit_burst: int = Field(default=10, description="Reviews allowed back to back before the global rate applies")
+    rate_limit_project_per_hour: float = Field(default=0, description="Sustained reviews per hour per project (0 = off)")
+    rate_limit_project_burst: int = Field(default=5, description="Burst allowance per project")
+    rate_limit_author_per_hour: float = Field(default=0, description="Sustained reviews per hour per MR author (0 = off)")
+    rate_limit_author_burst: int = Field(default=3, description="Burst allowance per MR author")
+    rate_limit_mr_per_hour: float = Field(default=0, description="Sustained reviews per hour per merge request (0 = off)")
+    rate_limit_mr_burst: int = Field(default=2, description="Burst allowance per merge request")
     
     # ===== Review Configuration =====
     review_timeout: int = Field(default=120, description="Review timeout in seconds")
     max_diff_size_lines: int = Field(default=10000, description="Maximum diff size in lines")
+    max_diff_tokens: int = Field(default=100000, description="Maximum diff size in estimated tokens")
+    chunked_review_enabled: bool = Field(
+        default=True,
+        description="Review diffs above max_diff_size_lines / max_diff_tokens in chunks instead of rejecting them"
+    )
+    review_chunk_max_tokens: int = Field(default=30000, description="Estimated token budget per review chunk")
+    review_chunk_concurrency: int = Field(default=3, description="Chunks reviewed concurrently per MR")
+    review_max_chunks: int = Field(default=20, description="Maximum chunks reviewed per MR")
+    incremental_review_enabled: bool = Field(
+        default=True,
+        description="Review only commits pushed since the last review of an MR"
+    )
+    review_cache_enabled: bool = Field(default=True, description="Reuse stored reviews for identical diffs")
+    review_cache_dir: str = Field(default="/app/data/review-cache", description="Directory for cached reviews")
+    review_cache_ttl_hours: float = Field(default=168, description="Cached review lifetime (hours)")
+    review_cache_max_entries: int = Field(default=1000, description="Maximum cached reviews (least recently used evicted)")
+    file_review_cache_enabled: bool = Field(
+        default=True,
+        description="Cache findings per file so re-reviews only send files whose diff changed"
+    )
+    file_review_cache_max_entries: int = Field(default=20000, description="Maximum cached per-file findings")
+    diff_compaction_enabled: bool = Field(
+        default=False,
+        description="Compact diffs before review (terse headers, trimmed context, collapsed whitespace-only hunks)"
+    )
+    diff_context_radius: int = Field(default=3, description="Context lines kept around each change when compacting")
+    diff_filter_enabled: bool = Field(default=True, description="Skip lock, vendored and generated files")
+    diff_filter_exclude: List[str] = Field(
+        default_factory=lambda: [
+            "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json",
+            "poetry.lock", "Pipfile.lock", "uv.lock", "Cargo.lock", "Gemfile.lock",
+            "composer.lock", "go.sum", "packages.lock.json",
+            "*.min.js", "*.min.css", "*.map", "*.snap", "*.pb.go", "*_pb2.py",
+            "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*",
+            "third_party/*", "*/third_party/*", "*/__snapshots__/*"
+        ],
+        description="Global diff filter rules as JSON (globs, 're:' regexes, '!' to re-include)"
+    )
+    diff_filter_project_exclude: Dict[int, List[str]] = Field(
+        default_factory=dict,
+        description="Per-project diff filter rules as JSON, e.g. {\"42\": [\"docs/*\"]}"
+    )
+    diff_filter_detect_generated: bool = Field(
+        default=True,
+        description="Skip files with generated-code headers or minified content"
+    )
+    diff_filter_max_line_length: int = Field(
+        default=1000,
+        description="Added lines longer than this mark a file as minified"
+    )
+    
+    # ===== Review Queue Configuration =====
+    review_queue_db_path: str = Field(
+        default="/app/data/queue/review-queue.db",
+        description="SQLite database for the durable review job queue"
+    )
+    review_worker_count: int = Field(default=4, description="Review concurrency (worker count) per process")
+    review_job_max_attempts: int = Field(default=3, description="Maximum attempts per queued review job")
+    review_project_weights: Dict[int, float] = Field(
+        default_factory=dict,
+        description="Per-project scheduling weights as JSON, e.g. {\"42\": 2.0}"
+    )
+    review_default_project_weight: float = Field(default=1.0, description="Scheduling weight for unlisted projects")
+    shared_state_backend: str = Field(
+        default="memory",
+        description="Budget/rate limit/dedup state: 'memory' (single process) or 'sqlite' (shared by uvicorn --workers N)"
+    )
+
+    # ===== Message Batches Configuration =====
+    batch_review_enabled: bool = Field(
+        default=False,
+        description="Send low-priority reviews through the Anthropic Message Batches API"
+    )
+    batch_review_drafts: bool = Field(default=True, description="Treat reviews of draft MRs as low priority")
+    batch_max_requests: int = Field(default=100, description="Submit a batch once this many reviews are collected")
+    batch_max_wait_seconds: float = Field(
+        default=300.0,
+        description="Submit a batch once its oldest review has waited this long"
+    )
+    batch_poll_interval: float = Field(default=60.0, description="Seconds between batch submission/result polls")
     
     # ===== Retry Configuration =====
     max_retries: int = Field(default=3, description="Maximum number of retry attempts")
@@ -55,9 +179,27 @@ class Settings(BaseSettings):
     token_budget_enabled: bool = Field(default=True, description="Enable token budget tracking and enforcement")
     token_daily_limit: int = Field(default=1000000, description="Maximum tokens per day across all projects")
     token_warning_threshold: int = Field(default=800000, description="Warning threshold (tokens)")
+    token_group_daily_limits: Dict[str, int] = Field(
+        default_factory=dict,
+        description="Daily token quotas per GitLab group path as JSON, e.g. {\"backend\": 300000}"
+    )
+    token_project_daily_limits: Dict[int, int] = Field(
+        default_factory=dict,
+        description="Daily token quotas per project as JSON, e.g. {\"42\": 200000}"
+    )
+    token_default_project_daily_limit: int = Field(default=0, description="Daily quota for unlisted projects (0 = none)")
+    token_project_user_daily_limits: Dict[int, int] = Field(
+        default_factory=dict,
+        description="Per-user daily token quotas within a project as JSON, e.g. {\"42\": 50000}"
+    )
+    token_default_user_daily_limit: int = Field(default=0, description="Per-user daily quota within unlisted projects (0 = none)")
     token_data_dir: str = Field(default="/app/data/tokens", description="Directory for token tracking data")
+    token_store_backend: str = Field(default="sqlite", description="Usage store backend: 'sqlite' (indexed) or 'files' (CSV/JSON only)")
+    token_db_path: Optional[str] = Field(default=None, description="SQLite usage database (default: <token_data_dir>/usage.db)")
     token_summary_retention_days: int = Field(default=90, description="Daily summary retention (days)")
     token_log_retention_days: int = Field(default=365, description="Monthly log retention (days)")
+    token_flush_interval: float = Field(default=5.0, description="Seconds between token log/summary flushes")
+    token_flush_max_events: int = Field(default=50, description="Flush early once this many usage events are pending")
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Diff chunking for large merge requests
+Splits file diffs along file and hunk boundaries into token-bounded chunks
+"""
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from src.token_estimator import estimator
+
+logger = logging.getLogger(__name__)
+
+HUNK_HEADER = re.compile(r"^@@ ", re.MULTILINE)
+
+
+@dataclass
+class DiffChunk:
+    """A slice of the MR diff small enough for one Claude request"""
+    text: str
+    files: List[str] = field(default_factory=list)
+    tokens: int = 0
+
+
+def estimate_tokens(text: str) -> int:
+    """Token estimate for chunk sizing (calibrated offline estimator)"""
+    return estimator.estimate(text)
+
+
+def split_changes_into_chunks(
+    changes: List[Dict],
+    format_file_diff: Callable[[Dict], str],
+    max_tokens: int
+) -> List[DiffChunk]:
+    """
+    Pack file diffs into chunks of at most max_tokens (estimated)
+
+    Whole files are kept together when they fit; larger files are split at
+    hunk boundaries, and single hunks that are still too large at line
+    boundaries.
+
+    Args:
+        changes: File diffs from GitLab (non-empty 'diff')
+        format_file_diff: Formatter producing the per-file text sent to Claude
+        max_tokens: Token budget per chunk
+
+    Returns:
+        Chunks in original file order
+    """
+    chunks: List[DiffChunk] = []
+    current = DiffChunk(text="")
+
+    def flush():
+        nonlocal current
+        if current.text:
+            chunks.append(current)
+        current = DiffChunk(text="")
+
+    for change in changes:
+        path = change.get("new_path") or change.get("old_path")
+        for piece in _split_change(change, format_file_diff, max_tokens):
+            tokens = estimate_tokens(piece)
+            if current.tokens + tokens > max_tokens:
+                flush()
+            current.text += piece + "\n"
+            current.tokens += tokens
+            if path not in current.files:
+                current.files.append(path)
+
+    flush()
+    logger.info(f"Split diff into {len(chunks)} chunk(s) of ≤{max_tokens:,} tokens")
+    return chunks
+
+
+def _split_change(change: Dict, format_file_diff: Callable[[Dict], str], max_tokens: int) -> List[str]:
+    """Format one file diff, splitting it into hunk groups if it is too large"""
+    formatted = format_file_diff(change)
+    if estimate_tokens(formatted) <= max_tokens:
+        return [formatted]
+
+    # Each hunk is counted once; groups are sized on the running sum (linear in the diff size)
+    pieces = []
+    group, group_raw = [], 0
+    for hunk, hunk_raw in _split_hunks(change.get("diff", ""), max_tokens):
+        if group and estimator.scale_raw(group_raw + hunk_raw) > max_tokens:
+            pieces.append(format_file_diff({**change, "diff": "".join(group)}))
+            group, group_raw = [], 0
+        group.append(hunk)
+        group_raw += hunk_raw
+    if group:
+        pieces.append(format_file_diff({**change, "diff": "".join(group)}))
+    return pieces
+
+
+def _split_hunks(diff: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """
+    Split a unified diff into hunks (and oversized hunks into line runs)
+
+    Returns:
+        (text, raw token count) per hunk or line run
+    """
+    starts = [m.start() for m in HUNK_HEADER.finditer(diff)] or [0]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(diff))
+
+    hunks = []
+    for begin, end in zip(starts, starts[1:]):
+        hunk = diff[begin:end]
+        hunk_raw = estimator.count_raw(hunk)
+        if estimator.scale_raw(hunk_raw) <= max_tokens:
+            hunks.append((hunk, hunk_raw))
+            continue
+
+        # A single huge hunk - fall back to line boundaries
+        run, run_raw = [], 0
+        for line in hunk.splitlines(keepends=True):
+            line_raw = estimator.count_raw(line)
+            if run and estimator.scale_raw(run_raw + line_raw) > max_tokens:
+                hunks.append(("".join(run), run_raw))
+                run, run_raw = [], 0
+            run.append(line)
+            run_raw += line_raw
+        if run:
+            hunks.append(("".join(run), run_raw))
+    return hunks
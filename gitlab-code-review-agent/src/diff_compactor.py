@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Token-minimising diff compaction
+Trims context, collapses whitespace-only hunks and shortens per-file headers
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@(.*)$")
+WHITESPACE_RUN = re.compile(r"\s+")
+
+# Whitespace-only hunks are never collapsed on indentation changes in these files
+INDENTATION_SENSITIVE_SUFFIXES = (
+    ".py", ".pyi", ".pyx", ".yaml", ".yml", ".mk", ".coffee", ".sass", ".pug", ".haml"
+)
+INDENTATION_SENSITIVE_NAMES = {"Makefile", "GNUmakefile", "makefile", "Snakefile"}
+
+
+def format_compact_file_diff(change: Dict, context_radius: int) -> str:
+    """
+    Format a single file diff for Claude with as few tokens as possible
+
+    - One-line header (`## path`, with new/deleted/renamed tags) instead of a fenced block
+    - Context lines further than context_radius from a change are dropped
+      (hunks are re-split with correct line numbers)
+    - Hunks that only change whitespace are collapsed to their header
+      (indentation counts in indentation-sensitive files)
+    - Pure renames/moves become a single header line
+
+    Args:
+        change: File diff from the /changes, /diffs or compare API
+        context_radius: Context lines kept around each changed line
+
+    Returns:
+        Compacted diff text, or "" if there is nothing to review
+    """
+    old_path = change.get("old_path")
+    new_path = change.get("new_path") or old_path
+    diff = change.get("diff", "")
+
+    if change.get("renamed_file") and old_path != new_path:
+        header = f"## {old_path} → {new_path} (renamed)"
+        if not diff.strip():
+            return f"{header[:-1]}, content unchanged)\n"
+    elif change.get("new_file"):
+        header = f"## {new_path} (new)"
+    elif change.get("deleted_file"):
+        header = f"## {new_path} (deleted)"
+    else:
+        header = f"## {new_path}"
+
+    if not diff:
+        return ""
+
+    hunks = []
+    for old_start, new_start, section, lines in _parse_hunks(diff):
+        if old_start is None:
+            # Continuation of a hunk split by the chunker - positions unknown, keep as is
+            hunks.extend(lines)
+            continue
+        if _whitespace_only(lines, new_path):
+            hunks.append(f"@@ -{old_start} +{new_start} @@{section} (whitespace-only changes)")
+            continue
+        hunks.extend(_trim_context(old_start, new_start, section, lines, context_radius))
+
+    if not hunks:
+        return f"{header}\n" if change.get("renamed_file") else ""
+    return header + "\n" + "\n".join(hunks) + "\n"
+
+
+def _parse_hunks(diff: str) -> List[Tuple[Optional[int], Optional[int], str, List[str]]]:
+    """
+    Split a unified diff into (old_start, new_start, section, lines) hunks
+
+    Lines before the first hunk header form a hunk with no start positions.
+    """
+    hunks = []
+    current = None
+
+    for line in diff.split("\n"):
+        match = HUNK_HEADER.match(line)
+        if match:
+            current = (int(match.group(1)), int(match.group(2)), match.group(3), [])
+            hunks.append(current)
+        else:
+            if current is None:
+                current = (None, None, "", [])
+                hunks.append(current)
+            current[3].append(line)
+
+    # Drop the empty string after a trailing newline
+    for hunk in hunks:
+        if hunk[3] and hunk[3][-1] == "":
+            hunk[3].pop()
+    return [hunk for hunk in hunks if hunk[0] is not None or hunk[3]]
+
+
+def _whitespace_only(lines: List[str], path: str) -> bool:
+    """
+    True if every removed line pairs with an added line differing only in whitespace
+
+    Lines are compared one by one with trailing whitespace dropped and runs of
+    intra-line whitespace collapsed (whitespace is never removed entirely, so
+    "a b" → "ab" is a change). Leading indentation is ignored, except in
+    indentation-sensitive files where re-indenting changes meaning.
+    """
+    removed = [line[1:] for line in lines if line.startswith("-")]
+    added = [line[1:] for line in lines if line.startswith("+")]
+    if not removed or len(removed) != len(added):
+        return False
+
+    keep_indent = _indentation_sensitive(path)
+
+    def normalise(line: str) -> str:
+        body = line.strip()
+        indent = line[:len(line) - len(line.lstrip())] if keep_indent else ""
+        return indent + WHITESPACE_RUN.sub(" ", body)
+
+    return all(normalise(old) == normalise(new) for old, new in zip(removed, added))
+
+
+def _indentation_sensitive(path: str) -> bool:
+    """Files where leading whitespace is syntax (Python, YAML, Makefiles, ...)"""
+    name = path.rsplit("/", 1)[-1]
+    return name in INDENTATION_SENSITIVE_NAMES or name.lower().endswith(INDENTATION_SENSITIVE_SUFFIXES)
+
+
+def _trim_context(
+    old_start: int,
+    new_start: int,
+    section: str,
+    lines: List[str],
+    radius: int
+) -> List[str]:
+    """Drop context beyond radius, re-splitting the hunk where context was dropped"""
+    changed = [i for i, line in enumerate(lines) if line[:1] in ("+", "-")]
+    if not changed:
+        return []
+
+    keep = [False] * len(lines)
+    for i in changed:
+        for j in range(max(0, i - radius), min(len(lines), i + radius + 1)):
+            keep[j] = True
+    # "\ No newline at end of file" belongs to the line before it
+    for i, line in enumerate(lines):
+        if line.startswith("\\") and i > 0:
+            keep[i] = keep[i - 1]
+
+    result = []
+    old_line, new_line = old_start, new_start
+    block: List[str] = []
+    block_start = None
+
+    def flush():
+        if block:
+            result.append(f"@@ -{block_start[0]} +{block_start[1]} @@{section}")
+            result.extend(block)
+
+    for i, line in enumerate(lines):
+        if keep[i]:
+            if not block:
+                block_start = (old_line, new_line)
+            block.append(line)
+        elif block:
+            flush()
+            block = []
+            # Only the first sub-hunk keeps the enclosing function name
+            section = ""
+
+        prefix = line[:1]
+        if prefix == "-":
+            old_line += 1
+        elif prefix == "+":
+            new_line += 1
+        elif prefix != "\\":
+            old_line += 1
+            new_line += 1
+
+    flush()
+    return result
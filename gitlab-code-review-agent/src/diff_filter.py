@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Diff filtering before review
+Drops lock files, vendored code and generated/minified files so they don't cost tokens
+"""
+import re
+import fnmatch
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from src.config import settings
+from src.token_estimator import estimator
+
+logger = logging.getLogger(__name__)
+
+# Header comments that tools put in the files they generate (case-sensitive,
+# comment-prefixed only, so prose like "do not edit this by hand" doesn't match)
+GENERATED_MARKERS = re.compile(
+    r"^\s*(?:#|//|/\*|\*)\s*(@generated\b|Code generated .* DO NOT EDIT)"
+)
+
+# A new-side hunk starting at line 1 is where generated-file headers live
+HEADER_HUNK = re.compile(r"^@@ -\d+(?:,\d+)? \+1(?:,\d+)? @@", re.MULTILINE)
+
+HEADER_LINES = 10              # Lines of the file header scanned for markers
+MINIFIED_AVG_LINE_LENGTH = 200  # Average added-line length that suggests minified code
+MINIFIED_MIN_LINES = 5          # ... over at least this many added lines
+
+MAX_LISTED_FILES = 20          # Skipped files named in the review comment
+
+
+@dataclass
+class SkippedFile:
+    """A file left out of the review, and why"""
+    path: str
+    reason: str
+    tokens: int
+
+
+@dataclass
+class FilterReport:
+    """Files skipped for one review"""
+    skipped: List[SkippedFile] = field(default_factory=list)
+
+    @property
+    def tokens_saved(self) -> int:
+        """Estimated tokens not sent to Claude"""
+        return sum(f.tokens for f in self.skipped)
+
+    def format_note(self) -> str:
+        """Markdown note for the review comment ('' if nothing was skipped)"""
+        if not self.skipped:
+            return ""
+
+        listed = [f"`{f.path}` ({f.reason})" for f in self.skipped[:MAX_LISTED_FILES]]
+        if len(self.skipped) > MAX_LISTED_FILES:
+            listed.append(f"and {len(self.skipped) - MAX_LISTED_FILES} more")
+
+        return (
+            f"ℹ️ **Skipped {len(self.skipped)} file(s)** (~{self.tokens_saved:,} tokens): "
+            f"{', '.join(listed)}"
+        )
+
+
+class DiffFilter:
+    """
+    Decide which file diffs are worth sending to Claude
+
+    Rules are glob patterns matched against the file path (`*` also matches
+    `/`; globs without a `/` match the file name in any directory), or
+    regular expressions when prefixed with `re:`. A rule prefixed
+    with `!` re-includes matching files. Global rules apply first, then the
+    project's; the last matching rule wins. Files not excluded by a rule are
+    checked for generated-file markers and minified content.
+    """
+
+    def __init__(
+        self,
+        exclude: Optional[List[str]] = None,
+        project_exclude: Optional[Dict[int, List[str]]] = None,
+        detect_generated: Optional[bool] = None,
+        max_line_length: Optional[int] = None
+    ):
+        self.exclude = exclude if exclude is not None else settings.diff_filter_exclude
+        self.project_exclude = (
+            project_exclude if project_exclude is not None else settings.diff_filter_project_exclude
+        )
+        self.detect_generated = (
+            detect_generated if detect_generated is not None else settings.diff_filter_detect_generated
+        )
+        self.max_line_length = max_line_length or settings.diff_filter_max_line_length
+        self._compiled: Dict[Optional[int], List[Tuple[str, bool, Pattern]]] = {}
+
+    def check(self, change: Dict, project_id: Optional[int] = None) -> Optional[str]:
+        """
+        Check whether a file diff should be skipped
+
+        Args:
+            change: File diff from GitLab
+            project_id: Project whose rules apply (global rules only if None)
+
+        Returns:
+            Reason for skipping, or None to review the file
+        """
+        path = change.get("new_path") or change.get("old_path") or ""
+
+        matched = None
+        for rule in self._rules(project_id):
+            if rule[2].search(path):
+                matched = rule
+
+        if matched:
+            pattern, include, _ = matched
+            # Explicitly included files skip the generated-file heuristics too
+            return None if include else f"matches `{pattern}`"
+
+        if self.detect_generated:
+            return self._detect_generated(change.get("diff", ""))
+        return None
+
+    def _detect_generated(self, diff: str) -> Optional[str]:
+        """Spot generated or minified files from the diff content"""
+        header = HEADER_HUNK.search(diff)
+        if header:
+            body = diff[header.end():].split("\n", HEADER_LINES + 1)[1:HEADER_LINES + 1]
+            for line in body:
+                if line.startswith("-"):
+                    continue
+                marker = GENERATED_MARKERS.match(line[1:])
+                if marker:
+                    return f"generated, `{marker.group(1)}` header"
+
+        added = [line for line in diff.split("\n") if line.startswith("+") and not line.startswith("+++")]
+        if not added:
+            return None
+
+        longest = max(len(line) for line in added)
+        if longest > self.max_line_length:
+            return f"minified, {longest:,}-char line"
+
+        if len(added) >= MINIFIED_MIN_LINES:
+            average = sum(len(line) for line in added) / len(added)
+            if average > MINIFIED_AVG_LINE_LENGTH:
+                return f"minified, {average:,.0f}-char average line"
+        return None
+
+    def _rules(self, project_id: Optional[int]) -> List[Tuple[str, bool, Pattern]]:
+        """Compiled global + project rules (cached per project)"""
+        if project_id not in self._compiled:
+            rules = list(self.exclude) + list(self.project_exclude.get(project_id, []))
+            compiled = []
+            for rule in rules:
+                include = rule.startswith("!")
+                pattern = rule[1:] if include else rule
+                try:
+                    if pattern.startswith("re:"):
+                        regex = re.compile(pattern[3:])
+                    elif "/" in pattern:
+                        # Path globs match the whole path
+                        regex = re.compile("^" + fnmatch.translate(pattern))
+                    else:
+                        # File name globs match in any directory
+                        regex = re.compile(r"(?:^|/)" + fnmatch.translate(pattern))
+                except re.error as e:
+                    logger.warning(f"Ignoring invalid diff filter rule {rule!r}: {e}")
+                    continue
+                compiled.append((pattern, include, regex))
+            self._compiled[project_id] = compiled
+        return self._compiled[project_id]
+
+    def filter_change(self, change: Dict, project_id: Optional[int], report: FilterReport) -> bool:
+        """
+        Check a file diff and record it in the report if skipped
+
+        Returns:
+            True if the file should be reviewed
+        """
+        if not settings.diff_filter_enabled:
+            return True
+
+        reason = self.check(change, project_id)
+        if reason is None:
+            return True
+
+        path = change.get("new_path") or change.get("old_path") or ""
+        report.skipped.append(SkippedFile(
+            path=path,
+            reason=reason,
+            tokens=estimator.estimate(change.get("diff", ""))
+        ))
+        logger.debug(f"Skipping {path} from review: {reason}")
+        return False
+
+
+# Global diff filter instance
+diff_filter = DiffFilter()
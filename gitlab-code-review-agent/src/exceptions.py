@@ -5,8 +5,20 @@ Custom exceptions for the Code Review Agent
 
 
 class TokenBudgetExceeded(Exception):
-    """Raised when daily token budget is exhausted"""
-    pass
+    """Raised when daily token budget (or a group/project/user quota) is exhausted"""
+    
+    def __init__(self, message: str, quota: str = "global"):
+        super().__init__(message)
+        self.quota = quota  # Exhausted level: global, group, project or user
+
+
+class ReviewDeferred(Exception):
+    """Raised when a queued review must wait (e.g. rate limited) and should be rescheduled"""
+    
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(f"{reason} (retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+        self.reason = reason
 
 
 class ReviewError(Exception):
@@ -5,15 +5,18 @@ GitLab API client for fetching merge requests and posting comments
 import httpx
 import logging
 import asyncio
-from typing import Dict, List, Optional
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
 
 from src.config import settings
+from src.http_pool import create_http_client
+from src.diff_compactor import format_compact_file_diff
 
 logger = logging.getLogger(__name__)
 
 
 class GitLabClient:
-    """Client for GitLab API interactions"""
+    """Client for GitLab API interactions (one pooled connection per instance)"""
     
     def __init__(self):
         self.base_url = settings.gitlab_url.rstrip('/')
@@ -22,6 +25,32 @@ class GitLabClient:
             "PRIVATE-TOKEN": self.token,
             "Content-Type": "application/json"
         }
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self) -> None:
+        """Open the shared connection pool (called on app startup)"""
+        if self._client is None:
+            self._client = create_http_client(
+                "GitLab",
+                headers=self.headers,
+                timeout=30.0,
+                max_connections=settings.gitlab_max_connections,
+                max_keepalive_connections=settings.gitlab_max_keepalive_connections,
+                keepalive_expiry=settings.http_keepalive_expiry,
+                http2=settings.gitlab_http2
+            )
+    
+    async def close(self) -> None:
+        """Close the shared connection pool (called on app shutdown)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Get the shared client, opening it lazily outside the app lifespan"""
+        if self._client is None:
+            await self.start()
+        return self._client
     
     async def get_merge_request(self, project_id: int, mr_iid: int) -> Dict:
         """
@@ -51,6 +80,112 @@ class GitLabClient:
         url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/changes"
         return await self._request_with_retry("GET", url)
     
+    async def iter_merge_request_diffs(self, project_id: int, mr_iid: int) -> AsyncIterator[Dict]:
+        """
+        Stream file diffs page by page from the paginated MR diffs endpoint
+        
+        Pages are fetched ahead with at most GITLAB_DIFF_PAGES_IN_FLIGHT requests
+        outstanding and yielded in order, so memory stays bounded and callers can
+        start processing before the last page arrives. Falls back to /changes on
+        GitLab versions without the /diffs endpoint (< 15.7).
+        
+        Args:
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            
+        Yields:
+            File diff dicts (old_path, new_path, diff, new_file, renamed_file, deleted_file)
+        """
+        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/diffs"
+        per_page = settings.gitlab_diff_page_size
+        
+        try:
+            first = await self._send_with_retry("GET", url, params={"page": 1, "per_page": per_page})
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            logger.info("MR diffs endpoint not available, falling back to /changes")
+            changes = await self.get_merge_request_changes(project_id, mr_iid)
+            for change in changes.get("changes", []):
+                yield change
+            return
+        
+        for change in first.json():
+            yield change
+        
+        total_pages = int(first.headers.get("X-Total-Pages") or 0)
+        if not total_pages:
+            # GitLab omits totals for very large collections - follow X-Next-Page
+            next_page = first.headers.get("X-Next-Page")
+            while next_page:
+                response = await self._send_with_retry(
+                    "GET", url, params={"page": int(next_page), "per_page": per_page}
+                )
+                for change in response.json():
+                    yield change
+                next_page = response.headers.get("X-Next-Page")
+            return
+        
+        # Prefetch a bounded window of pages, yielding them in order
+        in_flight = deque()
+        next_page = 2
+        try:
+            while next_page <= total_pages or in_flight:
+                while next_page <= total_pages and len(in_flight) < settings.gitlab_diff_pages_in_flight:
+                    in_flight.append(asyncio.create_task(
+                        self._request_with_retry("GET", url, params={"page": next_page, "per_page": per_page})
+                    ))
+                    next_page += 1
+                for change in await in_flight.popleft():
+                    yield change
+        finally:
+            # Consumer stopped early (or a page failed) - don't leave fetches running,
+            # and collect them so their errors aren't reported as never retrieved
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+    
+    async def iter_compare_diffs(self, project_id: int, from_sha: str, to_sha: str) -> AsyncIterator[Dict]:
+        """
+        Yield file diffs between two commits via the repository compare API
+        
+        Args:
+            project_id: Project holding both commits
+            from_sha: Base commit (e.g. last reviewed head)
+            to_sha: Target commit (e.g. current MR head)
+            
+        Yields:
+            File diff dicts in the same shape as the MR diffs API
+        """
+        url = f"{self.base_url}/api/v4/projects/{project_id}/repository/compare"
+        # straight=true diffs from_sha..to_sha directly instead of from their merge base
+        result = await self._request_with_retry(
+            "GET", url, params={"from": from_sha, "to": to_sha, "straight": "true"}
+        )
+        for change in result.get("diffs", []):
+            yield change
+    
+    async def is_ancestor(self, project_id: int, ancestor_sha: str, sha: str) -> bool:
+        """
+        Check whether a commit is reachable from another (e.g. not lost to a force-push)
+        
+        Args:
+            project_id: Project holding both commits
+            ancestor_sha: Candidate ancestor (e.g. last reviewed head)
+            sha: Descendant commit (e.g. current MR head)
+            
+        Returns:
+            True if ancestor_sha is an ancestor of sha; False if not or a commit is unknown
+        """
+        url = f"{self.base_url}/api/v4/projects/{project_id}/repository/merge_base"
+        try:
+            result = await self._request_with_retry("GET", url, params={"refs[]": [ancestor_sha, sha]})
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in (400, 404):
+                raise
+            return False
+        return result.get("id") == ancestor_sha
+    
     async def post_merge_request_comment(
         self, 
         project_id: int, 
@@ -75,11 +210,39 @@ class GitLabClient:
         logger.info(f"Posted comment to MR {mr_iid} in project {project_id}")
         return result
     
+    async def update_merge_request_comment(
+        self,
+        project_id: int,
+        mr_iid: int,
+        note_id: int,
+        comment: str
+    ) -> Dict:
+        """
+        Replace the body of an existing merge request comment
+        
+        Args:
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            note_id: Comment (note) ID returned when it was posted
+            comment: New comment text (markdown supported)
+            
+        Returns:
+            Updated comment details
+        """
+        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/notes/{note_id}"
+        return await self._request_with_retry("PUT", url, json_data={"body": comment})
+    
+    async def delete_merge_request_comment(self, project_id: int, mr_iid: int, note_id: int) -> None:
+        """Delete a merge request comment (e.g. an unfinished progress note)"""
+        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/notes/{note_id}"
+        await self._send_with_retry("DELETE", url)
+    
     async def _request_with_retry(
         self, 
         method: str, 
         url: str, 
-        json_data: Optional[Dict] = None
+        json_data: Optional[Dict] = None,
+        params: Optional[Dict] = None
     ) -> Dict:
         """
         Make HTTP request with retry logic and exponential backoff
@@ -88,28 +251,51 @@ class GitLabClient:
             method: HTTP method (GET, POST, etc.)
             url: Request URL
             json_data: Optional JSON payload for POST requests
+            params: Optional query parameters
             
         Returns:
             Response JSON
         """
+        response = await self._send_with_retry(method, url, json_data=json_data, params=params)
+        return response.json()
+    
+    async def _send_with_retry(
+        self, 
+        method: str, 
+        url: str, 
+        json_data: Optional[Dict] = None,
+        params: Optional[Dict] = None
+    ) -> httpx.Response:
+        """
+        Send HTTP request with retry logic and exponential backoff
+        
+        Args:
+            method: HTTP method (GET, POST, etc.)
+            url: Request URL
+            json_data: Optional JSON payload for POST requests
+            params: Optional query parameters
+            
+        Returns:
+            Successful response (headers are needed for pagination)
+        """
+        client = await self._get_client()
+        
         for attempt in range(settings.max_retries):
             try:
-                async with httpx.AsyncClient() as client:
-                    if method == "GET":
-                        response = await client.get(url, headers=self.headers, timeout=30.0)
-                    elif method == "POST":
-                        response = await client.post(
-                            url, 
-                            headers=self.headers, 
-                            json=json_data,
-                            timeout=30.0
-                        )
-                    else:
-                        raise ValueError(f"Unsupported HTTP method: {method}")
-                    
-                    response.raise_for_status()
-                    return response.json()
-                    
+                if method == "GET":
+                    response = await client.get(url, params=params)
+                elif method == "POST":
+                    response = await client.post(url, json=json_data, params=params)
+                elif method == "PUT":
+                    response = await client.put(url, json=json_data, params=params)
+                elif method == "DELETE":
+                    response = await client.delete(url, params=params)
+                else:
+                    raise ValueError(f"Unsupported HTTP method: {method}")
+                
+                response.raise_for_status()
+                return response
+                
             except httpx.HTTPStatusError as e:
                 logger.error(f"GitLab API error (attempt {attempt + 1}/{settings.max_retries}): {e.response.status_code} - {e.response.text}")
                 if attempt < settings.max_retries - 1 and e.response.status_code >= 500:
@@ -143,23 +329,22 @@ class GitLabClient:
         delay = settings.retry_initial_delay * (settings.retry_backoff_factor ** attempt)
         return min(delay, settings.retry_max_delay)
     
-    def format_diff_for_review(self, changes: Dict) -> str:
+    def format_file_diff(self, change: Dict) -> str:
         """
-        Format MR changes into readable diff for Claude
+        Format a single file diff for Claude
         
         Args:
-            changes: MR changes from GitLab API
+            change: File diff from the /changes or /diffs API
             
         Returns:
-            Formatted diff text
+            Formatted diff text, or "" if the file has no diff
         """
-        diff_parts = []
+        if settings.diff_compaction_enabled:
+            return format_compact_file_diff(change, settings.diff_context_radius)
         
-        for change in changes.get("changes", []):
-            file_path = change.get("new_path") or change.get("old_path")
-            diff = change.get("diff", "")
-            
-            if diff:
-                diff_parts.append(f"## File: {file_path}\n```diff\n{diff}\n```\n")
+        file_path = change.get("new_path") or change.get("old_path")
+        diff = change.get("diff", "")
         
-        return "\n".join(diff_parts)
+        if not diff:
+            return ""
+        return f"## File: {file_path}\n```diff\n{diff}\n```\n"
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP connection pools
+Long-lived httpx clients with keep-alive (and optional HTTP/2)
+"""
+import httpx
+import logging
+import importlib.util
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    """Check whether the optional h2 package is installed"""
+    return importlib.util.find_spec("h2") is not None
+
+
+def create_http_client(
+    name: str,
+    headers: Dict[str, str],
+    timeout: float,
+    max_connections: int,
+    max_keepalive_connections: int,
+    keepalive_expiry: float,
+    http2: bool = False
+) -> httpx.AsyncClient:
+    """
+    Create a pooled AsyncClient meant to live for the whole application
+
+    Args:
+        name: Pool name for log messages
+        headers: Default headers sent with every request
+        timeout: Default request timeout in seconds
+        max_connections: Maximum open connections
+        max_keepalive_connections: Maximum idle connections kept alive
+        keepalive_expiry: Seconds an idle connection is kept open
+        http2: Use HTTP/2 if the h2 package is installed
+
+    Returns:
+        Configured httpx.AsyncClient
+    """
+    if http2 and not http2_available():
+        logger.warning(f"HTTP/2 requested for {name} but 'h2' is not installed - using HTTP/1.1")
+        http2 = False
+
+    client = httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        ),
+        http2=http2
+    )
+    logger.info(
+        f"Opened {name} connection pool "
+        f"(max={max_connections}, keepalive={max_keepalive_connections}, http2={http2})"
+    )
+    return client
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Message Batches for low-priority reviews
+Collects prepared review requests, submits them as Anthropic Message Batches and polls for results
+"""
+import json
+import uuid
+import sqlite3
+import asyncio
+import threading
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import logging
+
+from src.config import settings
+from src.claude_reviewer import reviewer
+from src.shared_state import shared_state, enable_wal
+
+logger = logging.getLogger(__name__)
+
+# Batch reservations outlive normal ones: collection wait plus up to 24 hours of processing
+BATCH_RESERVATION_TTL = 26 * 3600.0
+
+
+@dataclass
+class BatchRequest:
+    """A review prepared for a Message Batch, with what's needed to post its result"""
+    custom_id: str
+    project_id: int
+    mr_iid: int
+    head_sha: Optional[str]
+    project_name: str
+    username: str
+    params: Dict                  # Messages API request body
+    raw_estimate: int             # Uncalibrated prompt estimate (for usage records)
+    payload: Dict                 # Job payload, re-queued if the batch fails
+    scope_note: Optional[str] = None
+    filter_note: Optional[str] = None
+    cache_key: Optional[str] = None
+    note_id: Optional[int] = None  # "Queued for batch review" note, replaced by the review
+    reservation_id: Optional[int] = None  # Budget held until the result is handled
+    reserved_tokens: int = 0
+    reservation_owner: Optional[str] = None  # PROCESS_ID that made the reservation
+    created_at: str = ""
+
+    @staticmethod
+    def new_custom_id(project_id: int, mr_iid: int) -> str:
+        """Unique custom_id (Anthropic allows 1-64 of [a-zA-Z0-9_-])"""
+        return f"mr-{project_id}-{mr_iid}-{uuid.uuid4().hex[:16]}"
+
+
+# Handles one batch result: (request, message on success, error description on failure)
+BatchResultHandler = Callable[[BatchRequest, Optional[Dict], Optional[str]], Awaitable[None]]
+
+
+class BatchStore:
+    """
+    Persistent batch requests (collecting, then submitted)
+
+    Stored in the review queue's SQLite database (separate table) so
+    submitted batches are still polled after a restart.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = Path(db_path or settings.review_queue_db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            enable_wal(self._conn)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_requests (
+                    custom_id TEXT PRIMARY KEY,
+                    project_id INTEGER NOT NULL,
+                    mr_iid INTEGER NOT NULL,
+                    batch_id TEXT,
+                    request TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    submitted_at TEXT
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_batch_requests_batch ON batch_requests (batch_id, created_at)"
+            )
+
+    async def add(self, request: BatchRequest) -> Optional[BatchRequest]:
+        """
+        Add a request to the next batch, replacing the MR's request if it wasn't submitted yet
+
+        Returns:
+            The replaced request, or None
+        """
+        return await asyncio.to_thread(self._add_sync, request)
+
+    async def pending_summary(self) -> Tuple[int, Optional[str]]:
+        """
+        Requests waiting for the next batch
+
+        Returns:
+            (count, created_at of the oldest)
+        """
+        row = await asyncio.to_thread(
+            self._fetchone,
+            "SELECT COUNT(*) AS count, MIN(created_at) AS oldest FROM batch_requests WHERE batch_id IS NULL",
+            ()
+        )
+        return row["count"], row["oldest"]
+
+    async def take_pending(self, limit: int) -> List[BatchRequest]:
+        """Oldest requests waiting for the next batch"""
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT * FROM batch_requests WHERE batch_id IS NULL ORDER BY created_at LIMIT ?",
+            (limit,)
+        )
+        return [self._to_request(row) for row in rows]
+
+    async def mark_submitted(self, custom_ids: List[str], batch_id: str) -> None:
+        """Record which batch the requests were submitted in"""
+        await asyncio.to_thread(self._mark_submitted_sync, custom_ids, batch_id)
+
+    async def submitted_batches(self) -> List[str]:
+        """IDs of batches with results still to collect"""
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT DISTINCT batch_id FROM batch_requests WHERE batch_id IS NOT NULL",
+            ()
+        )
+        return [row["batch_id"] for row in rows]
+
+    async def batch_requests(self, batch_id: str) -> Dict[str, BatchRequest]:
+        """Requests of a submitted batch keyed on custom_id"""
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT * FROM batch_requests WHERE batch_id = ?",
+            (batch_id,)
+        )
+        return {row["custom_id"]: self._to_request(row) for row in rows}
+
+    async def remove(self, custom_id: str) -> None:
+        """Drop a request once its result has been handled"""
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM batch_requests WHERE custom_id = ?", (custom_id,)
+        )
+
+    async def get_stats(self) -> Dict[str, int]:
+        """
+        Get request counts
+
+        Returns:
+            {'collecting': N, 'submitted': M, 'batches': K}
+        """
+        row = await asyncio.to_thread(
+            self._fetchone,
+            "SELECT SUM(batch_id IS NULL) AS collecting, SUM(batch_id IS NOT NULL) AS submitted, "
+            "COUNT(DISTINCT batch_id) AS batches FROM batch_requests",
+            ()
+        )
+        return {
+            "collecting": row["collecting"] or 0,
+            "submitted": row["submitted"] or 0,
+            "batches": row["batches"] or 0
+        }
+
+    def _add_sync(self, request: BatchRequest) -> Optional[BatchRequest]:
+        request.created_at = request.created_at or datetime.utcnow().isoformat() + "Z"
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM batch_requests WHERE project_id = ? AND mr_iid = ? AND batch_id IS NULL",
+                    (request.project_id, request.mr_iid)
+                ).fetchone()
+                replaced = None
+                if row is not None:
+                    # Newest event wins, the request keeps its place in the batch
+                    replaced = self._to_request(row)
+                    request.created_at = replaced.created_at
+                    self._conn.execute("DELETE FROM batch_requests WHERE custom_id = ?", (replaced.custom_id,))
+                self._conn.execute(
+                    "INSERT INTO batch_requests (custom_id, project_id, mr_iid, request, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (request.custom_id, request.project_id, request.mr_iid,
+                     json.dumps(asdict(request)), request.created_at)
+                )
+                self._conn.execute("COMMIT")
+                return replaced
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _mark_submitted_sync(self, custom_ids: List[str], batch_id: str) -> None:
+        now = datetime.utcnow().isoformat() + "Z"
+        with self._db_lock:
+            self._conn.executemany(
+                "UPDATE batch_requests SET batch_id = ?, submitted_at = ? WHERE custom_id = ?",
+                [(batch_id, now, custom_id) for custom_id in custom_ids]
+            )
+
+    @staticmethod
+    def _to_request(row: sqlite3.Row) -> BatchRequest:
+        return BatchRequest(**json.loads(row["request"]))
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._db_lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def _fetchone(self, sql: str, params: tuple) -> sqlite3.Row:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+
+class BatchProcessor:
+    """
+    Background loop that submits collected requests and collects batch results
+
+    A batch is submitted once BATCH_MAX_REQUESTS reviews are waiting or the
+    oldest has waited BATCH_MAX_WAIT_SECONDS. Ended batches are downloaded and
+    each result is passed to the handler; a request is only removed after its
+    handler returns, so results are handled at least once.
+
+    With several worker processes, only the holder of the 'batch-processor'
+    lease submits and collects, so a batch result is not handled twice.
+    """
+
+    def __init__(self, store: BatchStore, handler: BatchResultHandler):
+        self.store = store
+        self.handler = handler
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Start polling (no-op unless BATCH_REVIEW_ENABLED)"""
+        if settings.batch_review_enabled and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="batch-processor")
+            logger.info("Started Message Batch processor")
+
+    async def stop(self) -> None:
+        """Stop polling (submitted batches are picked up again on next startup)"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            logger.info("Stopped Message Batch processor")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self._is_leader():
+                    await self.submit_pending()
+                    await self.collect_results()
+            except Exception as e:
+                logger.error(f"Message Batch processing failed: {e}", exc_info=True)
+            await asyncio.sleep(settings.batch_poll_interval)
+
+    async def _is_leader(self) -> bool:
+        """Take or renew the batch processor lease (always held by a single process)"""
+        if shared_state is None:
+            return True
+        # Long enough to cover one round of submitting and collecting
+        ttl = max(3 * settings.batch_poll_interval, 300.0)
+        return await asyncio.to_thread(shared_state.acquire_lease, "batch-processor", ttl)
+
+    async def submit_pending(self, force: bool = False) -> Optional[str]:
+        """
+        Submit waiting requests as a batch if it is full or has waited long enough
+
+        Args:
+            force: Submit whatever is waiting
+
+        Returns:
+            Batch ID, or None if nothing was submitted
+        """
+        count, oldest = await self.store.pending_summary()
+        if count == 0:
+            return None
+
+        waited = (datetime.utcnow() - datetime.fromisoformat(oldest.rstrip("Z"))).total_seconds()
+        if not force and count < settings.batch_max_requests and waited < settings.batch_max_wait_seconds:
+            return None
+
+        requests = await self.store.take_pending(settings.batch_max_requests)
+        batch = await reviewer.create_batch(
+            [{"custom_id": request.custom_id, "params": request.params} for request in requests]
+        )
+        await self.store.mark_submitted([request.custom_id for request in requests], batch["id"])
+        logger.info(f"Submitted Message Batch {batch['id']} ({len(requests)} review(s), oldest waited {waited:.0f}s)")
+        return batch["id"]
+
+    async def collect_results(self) -> int:
+        """
+        Handle the results of every submitted batch that has ended
+
+        Returns:
+            Number of results handled
+        """
+        handled = 0
+        for batch_id in await self.store.submitted_batches():
+            batch = await reviewer.get_batch(batch_id)
+            if batch.get("processing_status") != "ended":
+                continue
+
+            requests = await self.store.batch_requests(batch_id)
+            results = await reviewer.get_batch_results(batch["results_url"]) if batch.get("results_url") else []
+            logger.info(f"Message Batch {batch_id} ended: {batch.get('request_counts')}")
+
+            outcomes = {result.get("custom_id"): result.get("result") or {} for result in results}
+            for custom_id, request in requests.items():
+                outcome = outcomes.get(custom_id, {"type": "missing"})
+                if outcome.get("type") == "succeeded":
+                    message, error = outcome.get("message"), None
+                else:
+                    message, error = None, f"{outcome.get('type')}: {outcome.get('error') or 'no result'}"
+                try:
+                    await self.handler(request, message, error)
+                except Exception as e:
+                    # Left in the store; retried on the next poll
+                    logger.error(f"Failed to handle batch result {custom_id}: {e}", exc_info=True)
+                    continue
+                await self.store.remove(custom_id)
+                handled += 1
+        return handled
+
+
+# Global batch store instance
+batch_store = BatchStore()
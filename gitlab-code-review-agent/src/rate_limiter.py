@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Review rate limiting
+Multi-key GCRA (token bucket) limiter with per-key rates and bursts
+"""
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.config import settings
+from src.shared_state import SharedState, shared_state
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RateLimit:
+    """Sustained rate plus burst allowance for one key"""
+    per_hour: float
+    burst: int = 1
+
+    @property
+    def interval(self) -> float:
+        """Seconds between requests at the sustained rate"""
+        return 3600.0 / self.per_hour
+
+    @property
+    def tolerance(self) -> float:
+        """How far ahead of schedule a key may run (burst - 1 intervals)"""
+        return self.interval * (max(self.burst, 1) - 1)
+
+
+@dataclass
+class RateDecision:
+    """Outcome of a rate limit check"""
+    allowed: bool
+    retry_after: float = 0.0  # Seconds until the request would be allowed
+    key: Optional[str] = None  # Key that denied it
+
+
+class RateLimiter:
+    """
+    Generic cell rate algorithm (GCRA) over any number of keys
+
+    Each key stores a single "theoretical arrival time", so a check is O(1)
+    per key and needs no list of past timestamps. A request is checked
+    against several keys at once (e.g. global, project, author, MR) and only
+    counts against them if every key allows it.
+
+    With a SharedState the arrival times live in SQLite (wall-clock time),
+    so every worker process draws from the same limits.
+    """
+
+    def __init__(self, clock: Optional[Callable[[], float]] = None, state: Optional[SharedState] = None):
+        self.state = state
+        self.clock = clock or (time.time if state is not None else time.monotonic)
+        self._tat: Dict[str, float] = {}
+        self._prune_at = 1024  # Drop idle keys once the table grows past this
+
+    async def acquire(self, limits: List[Tuple[str, RateLimit]]) -> RateDecision:
+        """Check and consume one request against every key (shared across processes if configured)"""
+        if self.state is None:
+            return self.check(limits)
+        now = self.clock()
+        return await asyncio.to_thread(
+            self.state.rate_check,
+            [key for key, _ in limits],
+            lambda tats: self._evaluate(limits, tats, now),
+            now
+        )
+
+    def check(self, limits: List[Tuple[str, RateLimit]]) -> RateDecision:
+        """
+        Check and consume one request against every key (this process only)
+
+        Args:
+            limits: (key, limit) pairs the request counts against
+
+        Returns:
+            RateDecision; when denied, retry_after is the longest wait of the denying keys
+        """
+        now = self.clock()
+        decision, updates = self._evaluate(limits, self._tat, now)
+        self._tat.update(updates)
+        if len(self._tat) > self._prune_at:
+            self._prune(now)
+        return decision
+
+    @staticmethod
+    def _evaluate(
+        limits: List[Tuple[str, RateLimit]],
+        tats: Dict[str, float],
+        now: float
+    ) -> Tuple[RateDecision, Dict[str, float]]:
+        """Decide a request against the keys' arrival times; returns (decision, arrival times to store)"""
+        decision = RateDecision(allowed=True)
+        updates = {}
+
+        for key, limit in limits:
+            tat = max(tats.get(key, now), now)
+            wait = tat - limit.tolerance - now
+            if wait > 0:
+                if wait > decision.retry_after:
+                    decision = RateDecision(allowed=False, retry_after=wait, key=key)
+                continue
+            updates[key] = tat + limit.interval
+
+        if not decision.allowed:
+            return decision, {}
+        return decision, updates
+
+    def _prune(self, now: float) -> None:
+        """Forget keys that are back to a full burst (same as never seen)"""
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+        self._prune_at = max(1024, 2 * len(self._tat))
+
+
+def review_rate_limits(project_id: int, mr_iid: int, author: Optional[str]) -> List[Tuple[str, RateLimit]]:
+    """
+    Keys and limits a review counts against (levels with a rate of 0 are off)
+
+    Args:
+        project_id: GitLab project ID
+        mr_iid: Merge request IID
+        author: MR author username (author limit skipped if unknown)
+    """
+    levels = [
+        ("global", settings.max_reviews_per_hour, settings.rate_limit_burst),
+        (f"project:{project_id}", settings.rate_limit_project_per_hour, settings.rate_limit_project_burst),
+        (f"author:{author}" if author else None, settings.rate_limit_author_per_hour, settings.rate_limit_author_burst),
+        (f"mr:{project_id}:{mr_iid}", settings.rate_limit_mr_per_hour, settings.rate_limit_mr_burst)
+    ]
+    return [
+        (key, RateLimit(per_hour=per_hour, burst=burst))
+        for key, per_hour, burst in levels
+        if key is not None and per_hour > 0
+    ]
+
+
+# Global rate limiter instance
+rate_limiter = RateLimiter(state=shared_state)
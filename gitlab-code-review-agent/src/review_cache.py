@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed review cache
+Identical diffs (same prompt version, model and max_tokens) reuse the stored review
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Hunk positions change on a rebase even when the content doesn't
+HUNK_POSITIONS = re.compile(r"^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@", re.MULTILINE)
+TRAILING_WHITESPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+
+
+def normalize_diff(diff: str) -> str:
+    """Normalise a formatted diff for cache keys (line endings, trailing whitespace, hunk positions)"""
+    diff = diff.replace("\r\n", "\n")
+    diff = TRAILING_WHITESPACE.sub("", diff)
+    return HUNK_POSITIONS.sub("@@", diff).strip()
+
+
+class ReviewCache:
+    """
+    On-disk review cache keyed on a hash of the review inputs
+
+    Features:
+    - One JSON file per entry (survives restarts)
+    - TTL expiry and least-recently-used eviction above max_entries
+    - Hit/miss/eviction counters
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        ttl_hours: Optional[float] = None,
+        max_entries: Optional[int] = None
+    ):
+        self.cache_dir = Path(cache_dir or settings.review_cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = (ttl_hours or settings.review_cache_ttl_hours) * 3600
+        self.max_entries = max_entries or settings.review_cache_max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> last used (epoch seconds), least recently used first
+        self._index: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def make_key(self, diff: str, prompt_version: str, model: str, max_tokens: int) -> str:
+        """
+        Cache key for a review request
+
+        Args:
+            diff: Formatted diff sent to Claude
+            prompt_version: Prompt template version
+            model: Claude model
+            max_tokens: Max output tokens
+
+        Returns:
+            SHA-256 hex digest
+        """
+        digest = hashlib.sha256()
+        for part in (prompt_version, model, str(max_tokens), normalize_diff(diff)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached review
+
+        Returns:
+            Stored review text, or None on a miss (or expired entry)
+        """
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def put(self, key: str, review: str, model: str) -> None:
+        """Store a review, evicting the least recently used entries if over max_entries"""
+        await asyncio.to_thread(self._put_sync, key, review, model)
+
+    def get_stats(self) -> Dict:
+        """Counters and size for monitoring"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "max_entries": self.max_entries,
+            "ttl_hours": self.ttl_seconds / 3600,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate_percent": (self.hits / lookups) * 100 if lookups > 0 else 0
+        }
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _load_index(self) -> None:
+        """Rebuild the LRU index from the entry files (mtime = last used)"""
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path.stem))
+            except OSError:
+                continue
+        with self._lock:
+            for last_used, key in sorted(entries):
+                self._index[key] = last_used
+        if entries:
+            logger.info(f"Review cache loaded: {len(entries)} entries in {self.cache_dir}")
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+
+            path = self._path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping unreadable review cache entry {key[:12]}: {e}")
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            now = time.time()
+            if now - entry.get("created_at", 0) > self.ttl_seconds:
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            # Mark as recently used (the mtime survives restarts)
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+            self._index[key] = now
+            self._index.move_to_end(key)
+            self.hits += 1
+            return entry.get("review")
+
+    def _put_sync(self, key: str, review: str, model: str) -> None:
+        now = time.time()
+        entry = {"review": review, "model": model, "created_at": now}
+        path = self._path(key)
+
+        with self._lock:
+            # Atomic write (temp file + rename)
+            temp_path = path.with_suffix('.tmp')
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f)
+                temp_path.replace(path)
+            except OSError as e:
+                logger.error(f"Failed to write review cache entry {key[:12]}: {e}")
+                return
+
+            self._index[key] = now
+            self._index.move_to_end(key)
+
+            while len(self._index) > self.max_entries:
+                oldest = next(iter(self._index))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        """Drop an entry from the index and disk (caller holds the lock)"""
+        self._index.pop(key, None)
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to delete review cache entry {key[:12]}: {e}")
+
+
+# Global review cache instances (whole review / per-file findings)
+review_cache = ReviewCache()
+file_review_cache = ReviewCache(
+    cache_dir=str(Path(settings.review_cache_dir) / "files"),
+    max_entries=settings.file_review_cache_max_entries
+)
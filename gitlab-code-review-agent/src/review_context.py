@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Review context for a merge request
+Built from the webhook payload so reviews avoid extra GitLab round trips
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from src.config import settings
+
+
+@dataclass
+class ReviewContext:
+    """Merge request metadata needed to review and account for a review"""
+    project_id: int
+    mr_iid: int
+    project_name: str
+    mr_title: str
+    mr_description: str
+    username: Optional[str]
+    head_sha: Optional[str]
+    source_project_id: Optional[int] = None
+    labels: List[str] = field(default_factory=list)
+    draft: bool = False
+    batch_failed: bool = False  # Set when a batched review failed and fell back to the queue
+
+    @classmethod
+    def from_payload(cls, project_id: int, mr_iid: int, payload: Optional[Dict]) -> "ReviewContext":
+        """
+        Build context from a (trimmed) merge request webhook payload
+
+        Args:
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            payload: Webhook payload stored with the review job (may be empty)
+
+        Returns:
+            ReviewContext (username is None when the payload can't tell us the author)
+        """
+        payload = payload or {}
+        attrs = payload.get("object_attributes") or {}
+        project = payload.get("project") or {}
+        user = payload.get("user") or {}
+
+        # The payload only names the user who triggered the event; that is the
+        # MR author when the IDs match (the common "author adds label" case)
+        username = None
+        if user.get("id") is not None and user.get("id") == attrs.get("author_id"):
+            username = user.get("username")
+
+        return cls(
+            project_id=project_id,
+            mr_iid=mr_iid,
+            project_name=project.get("path_with_namespace") or str(project_id),
+            mr_title=attrs.get("title", ""),
+            mr_description=attrs.get("description") or "",
+            username=username,
+            head_sha=(attrs.get("last_commit") or {}).get("id"),
+            source_project_id=attrs.get("source_project_id"),
+            labels=[label.get("title") for label in payload.get("labels") or []],
+            draft=bool(attrs.get("draft") or attrs.get("work_in_progress")),
+            batch_failed=bool(payload.get("batch_failed"))
+        )
+
+    def update_from_merge_request(self, mr: Dict) -> None:
+        """
+        Fill gaps from a GitLab merge request object (MR details or /changes response)
+
+        Args:
+            mr: Merge request JSON from the GitLab API
+        """
+        if not self.mr_title:
+            self.mr_title = mr.get("title", "")
+        if not self.mr_description:
+            self.mr_description = mr.get("description") or ""
+        if self.username is None:
+            self.username = (mr.get("author") or {}).get("username")
+        if self.head_sha is None:
+            self.head_sha = mr.get("sha")
+        if self.source_project_id is None:
+            self.source_project_id = mr.get("source_project_id")
+
+    def needs_merge_request_details(self) -> bool:
+        """Check whether the payload left gaps that need a GitLab MR lookup"""
+        return self.username is None or not self.mr_title or self.head_sha is None
+
+    @property
+    def full_review_requested(self) -> bool:
+        """True if the MR carries the label asking for a full (non-incremental) review"""
+        return settings.gitlab_full_review_label in self.labels
+
+    @property
+    def low_priority(self) -> bool:
+        """True if the review can wait for a Message Batch (batch label, or a draft MR)"""
+        if self.batch_failed:
+            return False
+        return settings.gitlab_batch_review_label in self.labels or (settings.batch_review_drafts and self.draft)
+
+    @property
+    def commit_project_id(self) -> int:
+        """Project holding the MR's commits (the fork for cross-project MRs)"""
+        return self.source_project_id or self.project_id
+
+    @property
+    def author(self) -> str:
+        """Username for token tracking ('unknown' if never resolved)"""
+        return self.username or "unknown"
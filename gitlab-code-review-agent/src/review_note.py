@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Progressively updated review note
+Posts a placeholder on the MR right away and edits it as the streamed review arrives
+"""
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from src.gitlab_client import GitLabClient
+
+logger = logging.getLogger(__name__)
+
+IN_PROGRESS_MARKER = "⏳ *Review in progress…*"
+
+
+class ReviewProgressNote:
+    """
+    One MR note that shows the review while Claude is still writing it
+
+    Edits run in the background (at most one in flight, always with the latest
+    text) so a slow GitLab never holds up reading the stream. Edit failures are
+    logged and ignored; the final review is still published.
+    """
+
+    def __init__(
+        self,
+        gitlab: GitLabClient,
+        project_id: int,
+        mr_iid: int,
+        render: Callable[[str], str]
+    ):
+        """
+        Args:
+            gitlab: GitLab client
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            render: Formats review text as the full comment body
+        """
+        self.gitlab = gitlab
+        self.project_id = project_id
+        self.mr_iid = mr_iid
+        self.render = render
+        self.note_id: Optional[int] = None
+        self._pending: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Post the placeholder note (the review still runs if this fails)"""
+        try:
+            note = await self.gitlab.post_merge_request_comment(
+                self.project_id, self.mr_iid, self.render(IN_PROGRESS_MARKER)
+            )
+            self.note_id = note.get("id")
+        except Exception as e:
+            logger.warning(f"Failed to post progress note for MR {self.mr_iid}: {e}")
+
+    async def update(self, partial_review: str) -> None:
+        """Show the review text received so far (non-blocking)"""
+        if self.note_id is None:
+            return
+        self._pending = partial_review
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def publish(self, comment: str) -> None:
+        """Replace the note with the final comment (posts a new one if there is no note)"""
+        await self._stop_updates()
+        if self.note_id is not None:
+            try:
+                await self.gitlab.update_merge_request_comment(
+                    self.project_id, self.mr_iid, self.note_id, comment
+                )
+                return
+            except Exception as e:
+                logger.warning(f"Failed to update progress note for MR {self.mr_iid}, posting a new one: {e}")
+        await self.gitlab.post_merge_request_comment(self.project_id, self.mr_iid, comment)
+
+    async def discard(self) -> None:
+        """Delete the unfinished note (review failed or was cancelled)"""
+        await self._stop_updates()
+        if self.note_id is None:
+            return
+        try:
+            await self.gitlab.delete_merge_request_comment(self.project_id, self.mr_iid, self.note_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete progress note for MR {self.mr_iid}: {e}")
+        self.note_id = None
+
+    async def _flush(self) -> None:
+        """Edit the note until it shows the latest pending text"""
+        while self._pending is not None:
+            text, self._pending = self._pending, None
+            try:
+                await self.gitlab.update_merge_request_comment(
+                    self.project_id, self.mr_iid, self.note_id,
+                    self.render(f"{text}\n\n{IN_PROGRESS_MARKER}")
+                )
+            except Exception as e:
+                logger.warning(f"Failed to update progress note for MR {self.mr_iid}: {e}")
+
+    async def _stop_updates(self) -> None:
+        """Drop pending edits and cancel the one in flight"""
+        self._pending = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
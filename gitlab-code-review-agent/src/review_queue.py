@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""
+Durable review job queue
+SQLite (WAL mode) backed queue so queued reviews survive restarts
+"""
+import json
+import time
+import heapq
+import sqlite3
+import asyncio
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import logging
+
+from src.config import settings
+from src.scheduler import FairScheduler
+from src.shared_state import shared_state, enable_wal
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReviewJob:
+    """A queued code review for a single merge request"""
+    id: int
+    project_id: int
+    mr_iid: int
+    head_sha: Optional[str]
+    payload: Dict
+    attempts: int
+
+
+class ReviewQueue:
+    """
+    Persistent queue of review jobs with at-least-once delivery
+
+    Features:
+    - O(1) append from the webhook handler (single INSERT)
+    - Per-project fair ordering via FairScheduler (FIFO within a project)
+    - At most one pending job per merge request (newer events coalesce into it)
+    - Jobs are only deleted after the review handler finishes
+    - Jobs left 'running' by a crash are re-queued on startup (or marked
+      failed if that was their final attempt)
+    - Running jobs hold a lease; with several worker processes only jobs
+      whose lease ran out (owner died) are re-queued, periodically
+    - Failed jobs are retried up to REVIEW_JOB_MAX_ATTEMPTS times
+    - Deferred jobs (e.g. rate limited) stay pending with a not_before time
+      and are only handed to the scheduler once they are due
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = Path(db_path or settings.review_queue_db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = settings.review_job_max_attempts
+        self.lease_seconds = 60.0  # Running jobs not renewed for this long belong to a dead process
+        self.shared = shared_state is not None  # Other processes claim from the same database
+
+        # One shared connection, serialised by a thread lock (calls run in worker threads)
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._db_lock = threading.Lock()
+        self._init_schema()
+
+        # Decides which project is served next
+        self.scheduler = FairScheduler(concurrency=settings.review_worker_count)
+
+        # Deferred jobs not yet counted by the scheduler: heap of (not_before, project_id)
+        self._deferred: List[Tuple[float, int]] = []
+
+        # Wakes idle workers when a job is enqueued or a slot frees up
+        self._job_available = asyncio.Event()
+
+        logger.info(f"ReviewQueue initialized: {self.db_path}")
+
+    def _init_schema(self) -> None:
+        """Create the jobs table and enable WAL mode"""
+        with self._db_lock:
+            enable_wal(self._conn)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS review_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id INTEGER NOT NULL,
+                    mr_iid INTEGER NOT NULL,
+                    head_sha TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    not_before REAL,
+                    lease_until REAL
+                )
+            """)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(review_jobs)")}
+            for column in ("not_before", "lease_until"):
+                if column not in columns:
+                    # Queue databases created before deferred jobs / leases existed
+                    self._conn.execute(f"ALTER TABLE review_jobs ADD COLUMN {column} REAL")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_review_jobs_status ON review_jobs (status, id)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_review_jobs_project "
+                "ON review_jobs (project_id, status, id)"
+            )
+            self._conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_review_jobs_pending_mr "
+                "ON review_jobs (project_id, mr_iid) WHERE status = 'pending'"
+            )
+
+    async def enqueue(
+        self,
+        project_id: int,
+        mr_iid: int,
+        head_sha: Optional[str],
+        payload: Dict
+    ) -> Tuple[int, bool]:
+        """
+        Append a review job, or coalesce into the MR's existing pending job
+
+        Args:
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            head_sha: MR head commit SHA at the time of the event
+            payload: Trimmed webhook payload for the review
+
+        Returns:
+            (job_id, coalesced)
+        """
+        job_id, coalesced = await asyncio.to_thread(
+            self._enqueue_sync, project_id, mr_iid, head_sha, payload
+        )
+        if coalesced:
+            logger.info(f"Coalesced review for MR {mr_iid} in project {project_id} into job {job_id}")
+        else:
+            self.scheduler.add(project_id)
+            self._job_available.set()
+            logger.info(f"Queued review job {job_id}: MR {mr_iid} in project {project_id}")
+        return job_id, coalesced
+
+    async def claim(self) -> Optional[ReviewJob]:
+        """
+        Claim the next job (fair across projects) and mark it running
+
+        Returns:
+            ReviewJob, or None if no job is eligible to run
+        """
+        self._release_due()
+        project_id = self.scheduler.next_project()
+        if project_id is None:
+            return None
+
+        try:
+            job = await asyncio.to_thread(self._claim_sync, project_id)
+        except Exception:
+            self.scheduler.finish(project_id)
+            self.scheduler.add(project_id)
+            raise
+
+        if job is None:
+            # In-memory count was stale - resync from the database
+            self.scheduler.finish(project_id)
+            await self._resync_scheduler()
+        return job
+
+    async def complete(self, job: ReviewJob) -> None:
+        """Remove a finished job from the queue"""
+        try:
+            await asyncio.to_thread(self._execute, "DELETE FROM review_jobs WHERE id = ?", (job.id,))
+        finally:
+            self.scheduler.finish(job.project_id)
+            self._job_available.set()
+
+    async def fail(self, job: ReviewJob, error: str) -> None:
+        """
+        Record a failed attempt, re-queueing the job if attempts remain
+
+        Args:
+            job: The job that failed
+            error: Error description
+        """
+        retry = job.attempts < self.max_attempts
+        status = await asyncio.to_thread(self._fail_sync, job, error, retry)
+        self.scheduler.finish(job.project_id)
+        self._job_available.set()
+        if status == "pending":
+            self.scheduler.add(job.project_id)
+            logger.warning(f"Review job {job.id} failed (attempt {job.attempts}/{self.max_attempts}), re-queued")
+        elif status == "superseded":
+            logger.warning(f"Review job {job.id} failed; a newer job for MR {job.mr_iid} is already queued")
+        else:
+            logger.error(f"Review job {job.id} failed permanently after {job.attempts} attempts: {error}")
+
+    async def defer(self, job: ReviewJob, delay: float) -> None:
+        """
+        Put a claimed job back in the queue to run no earlier than delay seconds from now
+
+        A deferral is not a failed attempt (the attempt counter is restored).
+
+        Args:
+            job: The job to reschedule
+            delay: Seconds to wait
+        """
+        not_before = time.time() + delay
+        status = await asyncio.to_thread(self._defer_sync, job, not_before)
+        self.scheduler.finish(job.project_id)
+        if status == "deferred":
+            heapq.heappush(self._deferred, (not_before, job.project_id))
+            logger.info(f"Review job {job.id} for MR {job.mr_iid} deferred by {delay:.0f}s")
+        else:
+            logger.info(f"Review job {job.id} deferred; a newer job for MR {job.mr_iid} is already queued")
+        # Idle workers re-arm their wait with the new due time
+        self._job_available.set()
+
+    async def renew(self, job_ids: List[int]) -> None:
+        """Extend the leases of running jobs (held by this process)"""
+        if not job_ids:
+            return
+        await asyncio.to_thread(
+            self._execute,
+            f"UPDATE review_jobs SET lease_until = ? WHERE status = 'running' "
+            f"AND id IN ({', '.join('?' for _ in job_ids)})",
+            (time.time() + self.lease_seconds, *job_ids)
+        )
+
+    async def is_running(self, project_id: int, mr_iid: int, head_sha: Optional[str]) -> bool:
+        """Check whether any process is reviewing this exact MR head"""
+        if head_sha is None:
+            return False
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT 1 FROM review_jobs WHERE project_id = ? AND mr_iid = ? AND status = 'running' "
+            "AND head_sha = ? AND lease_until >= ? LIMIT 1",
+            (project_id, mr_iid, head_sha, time.time())
+        )
+        return bool(rows)
+
+    async def pending_heads(self, jobs: List[ReviewJob]) -> Dict[Tuple[int, int], str]:
+        """
+        Head SHAs of pending jobs queued behind running ones (events received by any process)
+
+        Returns:
+            {(project_id, mr_iid): head_sha} for the jobs' MRs that have a pending job
+        """
+        if not jobs:
+            return {}
+        conditions = " OR ".join("(project_id = ? AND mr_iid = ?)" for _ in jobs)
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            f"SELECT project_id, mr_iid, head_sha FROM review_jobs "
+            f"WHERE status = 'pending' AND head_sha IS NOT NULL AND ({conditions})",
+            tuple(value for job in jobs for value in (job.project_id, job.mr_iid))
+        )
+        return {(row["project_id"], row["mr_iid"]): row["head_sha"] for row in rows}
+
+    async def recover(self) -> int:
+        """
+        Re-queue jobs left 'running' by a previous process (crash recovery)
+
+        With several worker processes, only jobs whose lease expired are
+        re-queued; this also picks up jobs other processes enqueued. Jobs
+        interrupted on their final attempt are marked failed instead.
+
+        Returns:
+            Number of jobs recovered
+        """
+        recovered, failed = await asyncio.to_thread(self._recover_sync)
+        if recovered:
+            logger.info(f"Recovered {recovered} interrupted review job(s)")
+        if failed:
+            logger.error(f"{failed} interrupted review job(s) had no attempts left and were marked failed")
+        await self._resync_scheduler()
+        self._job_available.set()
+        return recovered
+
+    async def wait_for_job(self, timeout: float) -> None:
+        """Block until a job may be available, a deferred job is due, or the timeout expires"""
+        if self._deferred:
+            timeout = max(0.0, min(timeout, self._deferred[0][0] - time.time()))
+        try:
+            await asyncio.wait_for(self._job_available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._job_available.clear()
+
+    async def get_stats(self) -> Dict[str, int]:
+        """
+        Get job counts by status
+
+        Returns:
+            {'pending': N, 'running': M, 'failed': K, 'deferred': D}
+            (deferred jobs are also counted as pending)
+        """
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT status, COUNT(*) AS count, SUM(not_before > ?) AS deferred "
+            "FROM review_jobs GROUP BY status",
+            (time.time(),)
+        )
+        stats = {"pending": 0, "running": 0, "failed": 0, "deferred": 0}
+        stats.update({row["status"]: row["count"] for row in rows})
+        stats["deferred"] = sum(row["deferred"] or 0 for row in rows if row["status"] == "pending")
+        return stats
+
+    def get_project_depths(self) -> Dict[int, Dict]:
+        """Get per-project pending/in-flight counts and weights"""
+        return self.scheduler.get_depths()
+
+    async def _resync_scheduler(self) -> None:
+        """Rebuild the scheduler's pending counts (due jobs) and the deferred heap from the database"""
+        now = time.time()
+        rows = await asyncio.to_thread(
+            self._fetchall,
+            "SELECT project_id, not_before FROM review_jobs WHERE status = 'pending'",
+            ()
+        )
+        due: Dict[int, int] = {}
+        deferred = []
+        for row in rows:
+            if row["not_before"] is not None and row["not_before"] > now:
+                deferred.append((row["not_before"], row["project_id"]))
+            else:
+                due[row["project_id"]] = due.get(row["project_id"], 0) + 1
+        heapq.heapify(deferred)
+        self._deferred = deferred
+        self.scheduler.reset(due)
+
+    def _release_due(self) -> None:
+        """Hand deferred jobs that are now due to the scheduler"""
+        now = time.time()
+        while self._deferred and self._deferred[0][0] <= now:
+            _, project_id = heapq.heappop(self._deferred)
+            self.scheduler.add(project_id)
+
+    def _enqueue_sync(
+        self,
+        project_id: int,
+        mr_iid: int,
+        head_sha: Optional[str],
+        payload: Dict
+    ) -> Tuple[int, bool]:
+        now = self._now()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM review_jobs WHERE project_id = ? AND mr_iid = ? AND status = 'pending'",
+                    (project_id, mr_iid)
+                ).fetchone()
+                if row is not None:
+                    # Newest event wins, the job keeps its place in the queue
+                    self._conn.execute(
+                        "UPDATE review_jobs SET head_sha = ?, payload = ?, updated_at = ? WHERE id = ?",
+                        (head_sha, json.dumps(payload), now, row["id"])
+                    )
+                    result = (row["id"], True)
+                else:
+                    cursor = self._conn.execute(
+                        "INSERT INTO review_jobs (project_id, mr_iid, head_sha, payload, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (project_id, mr_iid, head_sha, json.dumps(payload), now, now)
+                    )
+                    result = (cursor.lastrowid, False)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _fail_sync(self, job: ReviewJob, error: str, retry: bool) -> str:
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if retry and self._has_pending_sibling(job.project_id, job.mr_iid):
+                    # A newer job for the same MR is already waiting - drop this one
+                    self._conn.execute("DELETE FROM review_jobs WHERE id = ?", (job.id,))
+                    status = "superseded"
+                else:
+                    status = "pending" if retry else "failed"
+                    self._conn.execute(
+                        "UPDATE review_jobs SET status = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (status, error, self._now(), job.id)
+                    )
+                self._conn.execute("COMMIT")
+                return status
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _defer_sync(self, job: ReviewJob, not_before: float) -> str:
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._has_pending_sibling(job.project_id, job.mr_iid):
+                    # A newer job for the same MR is already waiting - it will be checked when it runs
+                    self._conn.execute("DELETE FROM review_jobs WHERE id = ?", (job.id,))
+                    status = "superseded"
+                else:
+                    self._conn.execute(
+                        "UPDATE review_jobs SET status = 'pending', attempts = attempts - 1, "
+                        "not_before = ?, updated_at = ? WHERE id = ?",
+                        (not_before, self._now(), job.id)
+                    )
+                    status = "deferred"
+                self._conn.execute("COMMIT")
+                return status
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _recover_sync(self) -> Tuple[int, int]:
+        with self._db_lock:
+            # A single process owns every running job; otherwise only expired leases are orphaned
+            cutoff = time.time() if self.shared else float("inf")
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Interrupted jobs that already have a newer pending job are obsolete
+                self._conn.execute("""
+                    DELETE FROM review_jobs
+                    WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?) AND EXISTS (
+                        SELECT 1 FROM review_jobs AS newer
+                        WHERE newer.project_id = review_jobs.project_id
+                          AND newer.mr_iid = review_jobs.mr_iid
+                          AND (newer.status = 'pending'
+                               OR (newer.status = 'running' AND newer.id > review_jobs.id))
+                    )
+                """, (cutoff,))
+                # Jobs that already used every attempt (e.g. one that keeps crashing the process)
+                failed = self._conn.execute(
+                    "UPDATE review_jobs SET status = 'failed', lease_until = NULL, last_error = ?, updated_at = ? "
+                    "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?) AND attempts >= ?",
+                    ("Interrupted on its final attempt", self._now(), cutoff, self.max_attempts)
+                ).rowcount
+                recovered = self._conn.execute(
+                    "UPDATE review_jobs SET status = 'pending', lease_until = NULL, updated_at = ? "
+                    "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+                    (self._now(), cutoff)
+                ).rowcount
+                self._conn.execute("COMMIT")
+                return recovered, failed
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _has_pending_sibling(self, project_id: int, mr_iid: int) -> bool:
+        return self._conn.execute(
+            "SELECT 1 FROM review_jobs WHERE project_id = ? AND mr_iid = ? AND status = 'pending'",
+            (project_id, mr_iid)
+        ).fetchone() is not None
+
+    def _claim_sync(self, project_id: int) -> Optional[ReviewJob]:
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM review_jobs WHERE status = 'pending' AND project_id = ? "
+                    "AND (not_before IS NULL OR not_before <= ?) ORDER BY id LIMIT 1",
+                    (project_id, time.time())
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE review_jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    (time.time() + self.lease_seconds, self._now(), row["id"])
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return ReviewJob(
+            id=row["id"],
+            project_id=row["project_id"],
+            mr_iid=row["mr_iid"],
+            head_sha=row["head_sha"],
+            payload=json.loads(row["payload"]),
+            attempts=row["attempts"] + 1
+        )
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._db_lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.utcnow().isoformat() + "Z"
+
+
+# Global queue instance
+review_queue = ReviewQueue()
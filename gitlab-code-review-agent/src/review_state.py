@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Review state per merge request
+Remembers the last reviewed head SHA so later reviews can be incremental
+"""
+import sqlite3
+import asyncio
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+import logging
+
+from src.config import settings
+from src.shared_state import enable_wal
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewStateStore:
+    """
+    Last reviewed head SHA for each (project_id, mr_iid)
+
+    Stored in the review queue's SQLite database (separate table) so it
+    shares the same persistent volume.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = Path(db_path or settings.review_queue_db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            enable_wal(self._conn)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS reviewed_heads (
+                    project_id INTEGER NOT NULL,
+                    mr_iid INTEGER NOT NULL,
+                    head_sha TEXT NOT NULL,
+                    reviewed_at TEXT NOT NULL,
+                    PRIMARY KEY (project_id, mr_iid)
+                )
+            """)
+
+    async def get_last_reviewed(self, project_id: int, mr_iid: int) -> Optional[str]:
+        """
+        Get the head SHA covered by the last successful review
+
+        Returns:
+            Head SHA, or None if the MR was never reviewed
+        """
+        return await asyncio.to_thread(self._get_sync, project_id, mr_iid)
+
+    async def mark_reviewed(self, project_id: int, mr_iid: int, head_sha: Optional[str]) -> None:
+        """Record that the MR has been reviewed up to head_sha"""
+        if not head_sha:
+            return
+        await asyncio.to_thread(self._mark_sync, project_id, mr_iid, head_sha)
+
+    def _get_sync(self, project_id: int, mr_iid: int) -> Optional[str]:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT head_sha FROM reviewed_heads WHERE project_id = ? AND mr_iid = ?",
+                (project_id, mr_iid)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _mark_sync(self, project_id: int, mr_iid: int, head_sha: str) -> None:
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT INTO reviewed_heads (project_id, mr_iid, head_sha, reviewed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (project_id, mr_iid) DO UPDATE SET "
+                "head_sha = excluded.head_sha, reviewed_at = excluded.reviewed_at",
+                (project_id, mr_iid, head_sha, datetime.utcnow().isoformat() + "Z")
+            )
+
+
+# Global review state instance
+review_state = ReviewStateStore()
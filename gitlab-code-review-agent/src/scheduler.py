@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Per-project fair scheduling for review jobs
+Weighted deficit round-robin keyed on GitLab project ID
+"""
+import math
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+    Decide which project the next free worker should serve
+
+    Features:
+    - Deficit round-robin: each project earns its weight in credit per round
+    - Share cap: a project never holds more than its weighted share of workers
+      while other projects are waiting (work-conserving when it is alone)
+    - O(1) bookkeeping per enqueue/finish and per share check (the total weight
+      of projects with work is kept up to date rather than summed); a claim
+      walks the ring of pending projects, skipping those that are capped or
+      short of credit (all in memory)
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        weights: Optional[Dict[int, float]] = None,
+        default_weight: Optional[float] = None
+    ):
+        self.concurrency = concurrency
+        self.weights = weights if weights is not None else settings.review_project_weights
+        self.default_weight = default_weight or settings.review_default_project_weight
+
+        self._pending: Dict[int, int] = {}
+        self._in_flight: Dict[int, int] = {}
+        self._deficit: Dict[int, float] = {}
+        self._ring: deque = deque()  # Projects with pending jobs, in service order
+        self._active_weight = 0.0  # Total weight of projects with pending or in-flight jobs
+
+    def weight(self, project_id: int) -> float:
+        """Get the scheduling weight for a project"""
+        return self.weights.get(project_id, self.default_weight)
+
+    def add(self, project_id: int, count: int = 1) -> None:
+        """Register newly pending job(s) for a project"""
+        if self._pending.get(project_id, 0) == 0:
+            if project_id not in self._in_flight:
+                self._active_weight += self.weight(project_id)
+            self._ring.append(project_id)
+        self._pending[project_id] = self._pending.get(project_id, 0) + count
+
+    def next_project(self) -> Optional[int]:
+        """
+        Pick the project whose job should run next and mark one job in flight
+
+        Returns:
+            Project ID, or None if nothing is eligible to run
+        """
+        # Enough rounds for the smallest weight to earn one job's credit
+        min_weight = min((self.weight(p) for p in self._ring), default=1.0)
+        max_rounds = len(self._ring) * (math.ceil(1.0 / max(min_weight, 0.01)) + 1)
+
+        for _ in range(max_rounds):
+            if not self._ring:
+                return None
+
+            project_id = self._ring[0]
+            if self._in_flight.get(project_id, 0) >= self._share(project_id):
+                self._ring.rotate(-1)
+                continue
+
+            deficit = self._deficit.get(project_id, 0.0)
+            if deficit < 1.0:
+                deficit += self.weight(project_id)
+            if deficit < 1.0:
+                self._deficit[project_id] = deficit
+                self._ring.rotate(-1)
+                continue
+
+            # Serve one job from this project
+            self._deficit[project_id] = deficit - 1.0
+            self._pending[project_id] -= 1
+            self._in_flight[project_id] = self._in_flight.get(project_id, 0) + 1
+
+            if self._pending[project_id] == 0:
+                self._ring.popleft()
+                del self._pending[project_id]
+                self._deficit.pop(project_id, None)
+            elif self._deficit[project_id] < 1.0:
+                self._ring.rotate(-1)
+
+            return project_id
+
+        return None
+
+    def finish(self, project_id: int) -> None:
+        """Mark one in-flight job for a project as finished"""
+        remaining = self._in_flight.get(project_id, 0) - 1
+        if remaining > 0:
+            self._in_flight[project_id] = remaining
+        elif self._in_flight.pop(project_id, None) is not None and project_id not in self._pending:
+            self._deactivate(project_id)
+
+    def reset(self, pending_counts: Dict[int, int]) -> None:
+        """Rebuild pending state from the persistent queue"""
+        self._pending.clear()
+        self._deficit.clear()
+        self._ring.clear()
+        self._active_weight = sum(self.weight(p) for p in self._in_flight)
+        for project_id, count in pending_counts.items():
+            if count > 0:
+                self.add(project_id, count)
+
+    def get_depths(self) -> Dict[int, Dict]:
+        """
+        Get per-project queue depths for tuning weights
+
+        Returns:
+            {project_id: {'pending': N, 'in_flight': M, 'weight': W, 'max_in_flight': S}}
+        """
+        projects = set(self._pending) | set(self._in_flight)
+        return {
+            project_id: {
+                "pending": self._pending.get(project_id, 0),
+                "in_flight": self._in_flight.get(project_id, 0),
+                "weight": self.weight(project_id),
+                "max_in_flight": self._share(project_id)
+            }
+            for project_id in sorted(projects)
+        }
+
+    def _share(self, project_id: int) -> int:
+        """Maximum concurrent jobs for a project given who else has work"""
+        total_weight = self._active_weight
+        if project_id not in self._pending and project_id not in self._in_flight:
+            total_weight += self.weight(project_id)
+        if total_weight <= 0:
+            return self.concurrency
+        return max(1, math.ceil(self.concurrency * self.weight(project_id) / total_weight))
+
+    def _deactivate(self, project_id: int) -> None:
+        """Drop a project without pending or in-flight jobs from the active weight"""
+        if not self._pending and not self._in_flight:
+            self._active_weight = 0.0  # Reset float drift whenever the scheduler is idle
+        else:
+            self._active_weight -= self.weight(project_id)
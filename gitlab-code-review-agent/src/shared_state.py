@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-process shared state
+Budget counters, rate limiter state and leases shared by every worker process (SQLite)
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process as the owner of leases and running jobs
+PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Reservations left behind by a process that died are dropped after this long
+RESERVATION_TTL = 3600.0
+
+# Rate limiter keys back at a full burst are pruned once every this many checks (per process)
+RATE_PRUNE_EVERY = 1024
+
+# Columns counted per budget key and day
+BUDGET_COLUMNS = [
+    'total_tokens', 'input_tokens', 'output_tokens',
+    'cache_creation_input_tokens', 'cache_read_input_tokens', 'request_count'
+]
+
+
+def enable_wal(conn: sqlite3.Connection, timeout: float = 30.0) -> None:
+    """
+    Switch a database to WAL mode, waiting for other processes doing the same
+
+    Changing the journal mode of a new database needs an exclusive lock and
+    does not wait on the busy timeout, so processes that start together and
+    open the same database retry instead of failing with "database is locked".
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class SharedState:
+    """
+    State that must be shared when the app runs as several processes (uvicorn --workers N)
+
+    Stored in the review queue's SQLite database (separate tables). Every
+    operation is a single BEGIN IMMEDIATE transaction, which SQLite
+    serialises across processes, so a check and its update can't interleave
+    with another process's:
+    - Budget usage per day and key (global, group, project, user) and
+      in-flight reservations, so quotas hold across processes
+    - GCRA theoretical arrival times for the rate limiter (wall-clock time)
+    - Named leases, so process-wide singletons (e.g. the batch processor)
+      run in one process at a time
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = Path(db_path or settings.review_queue_db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30.0  # Other processes hold the write lock for a few ms at a time
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._db_lock = threading.Lock()
+        self._rate_checks = 0
+        self._init_schema()
+
+        logger.info(f"SharedState initialized: {self.db_path} (process {PROCESS_ID})")
+
+    def _init_schema(self) -> None:
+        with self._db_lock:
+            enable_wal(self._conn)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS budget_usage (
+                    day TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    {", ".join(f"{column} INTEGER NOT NULL DEFAULT 0" for column in BUDGET_COLUMNS)},
+                    PRIMARY KEY (day, key)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS budget_reservations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tokens INTEGER NOT NULL,
+                    keys TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_budget_reservations_expires ON budget_reservations (expires_at)"
+            )
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS budget_reserved (
+                    key TEXT PRIMARY KEY,
+                    tokens INTEGER NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit_state (
+                    key TEXT PRIMARY KEY,
+                    tat REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limit_state_tat ON rate_limit_state (tat)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    # ===== Token budget =====
+
+    def budget_snapshot(self, day: str) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+        """
+        Usage counted on a day and tokens currently reserved
+
+        Returns:
+            ({key: {'total_tokens': ..., ..., 'request_count': N}}, {key: reserved tokens})
+        """
+        with self._db_lock:
+            usage = self._conn.execute("SELECT * FROM budget_usage WHERE day = ?", (day,)).fetchall()
+            reserved = self._conn.execute("SELECT key, tokens FROM budget_reserved").fetchall()
+        return (
+            {row["key"]: {column: row[column] for column in BUDGET_COLUMNS} for row in usage},
+            {row["key"]: row["tokens"] for row in reserved}
+        )
+
+    def reserve(
+        self,
+        day: str,
+        tokens: int,
+        limits: List[Tuple[str, int]],
+        ttl: float = RESERVATION_TTL
+    ) -> Tuple[Optional[int], Dict[str, Tuple[int, int]]]:
+        """
+        Reserve tokens against several keys if every limit can cover them
+
+        Args:
+            day: Day the usage counts against (ISO date)
+            tokens: Tokens to hold
+            limits: (key, daily limit) pairs, checked in order
+            ttl: Seconds before an unreleased reservation is dropped
+
+        Returns:
+            (reservation ID or None if a limit can't cover it,
+             {key: (used, reserved)} as seen before reserving)
+        """
+        now = time.time()
+        keys = [key for key, _ in limits]
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire_reservations(now)
+                counters = self._budget_counters(day, keys)
+                if any(sum(counters[key]) >= limit or sum(counters[key]) + tokens > limit for key, limit in limits):
+                    self._conn.execute("COMMIT")
+                    return None, counters
+
+                cursor = self._conn.execute(
+                    "INSERT INTO budget_reservations (tokens, keys, owner, expires_at) VALUES (?, ?, ?, ?)",
+                    (tokens, json.dumps(keys), PROCESS_ID, now + ttl)
+                )
+                self._add_reserved(keys, tokens)
+                self._conn.execute("COMMIT")
+                return cursor.lastrowid, counters
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, reservation_id: int) -> None:
+        """Return a reservation's tokens (no-op if it was already released or expired)"""
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._release(reservation_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_usage(
+        self,
+        day: str,
+        keys: List[str],
+        totals: Dict[str, int],
+        reservation_id: Optional[int] = None
+    ) -> None:
+        """
+        Count usage against several keys, swapping out its reservation in the same transaction
+
+        Args:
+            day: Day of the usage (ISO date)
+            keys: Keys the usage counts against
+            totals: Values of BUDGET_COLUMNS (missing columns count as 0)
+            reservation_id: Reservation to release
+        """
+        values = [totals.get(column, 0) for column in BUDGET_COLUMNS]
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if reservation_id is not None:
+                    self._release(reservation_id)
+                self._conn.executemany(
+                    "INSERT INTO budget_usage (day, key, " + ", ".join(BUDGET_COLUMNS) + ") "
+                    f"VALUES (?, ?, {', '.join('?' for _ in BUDGET_COLUMNS)}) "
+                    "ON CONFLICT (day, key) DO UPDATE SET "
+                    + ", ".join(f"{column} = {column} + excluded.{column}" for column in BUDGET_COLUMNS),
+                    [[day, key] + values for key in keys]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def seed_usage(self, day: str, counters: Dict[str, Dict[str, int]]) -> bool:
+        """
+        Start a day's usage counters from existing totals unless the day already has any
+
+        Used when SHARED_STATE_BACKEND is switched on mid-day, so usage counted
+        by the single-process tracker earlier that day still counts. Processes
+        starting together seed at most once.
+
+        Args:
+            day: Day of the usage (ISO date)
+            counters: {key: values of BUDGET_COLUMNS} (missing columns count as 0)
+
+        Returns:
+            True if the counters were seeded
+        """
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM budget_usage WHERE day = ? LIMIT 1", (day,)).fetchone():
+                    self._conn.execute("COMMIT")
+                    return False
+                self._conn.executemany(
+                    "INSERT INTO budget_usage (day, key, " + ", ".join(BUDGET_COLUMNS) + ") "
+                    f"VALUES (?, ?, {', '.join('?' for _ in BUDGET_COLUMNS)})",
+                    [[day, key] + [totals.get(column, 0) for column in BUDGET_COLUMNS] for key, totals in counters.items()]
+                )
+                self._conn.execute("COMMIT")
+                return True
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def cleanup(self, cutoff: str) -> int:
+        """
+        Delete budget usage of days before the cutoff (ISO date)
+
+        Returns:
+            Number of counters deleted
+        """
+        with self._db_lock:
+            return self._conn.execute("DELETE FROM budget_usage WHERE day < ?", (cutoff,)).rowcount
+
+    def _budget_counters(self, day: str, keys: List[str]) -> Dict[str, Tuple[int, int]]:
+        placeholders = ", ".join("?" for _ in keys)
+        used = {
+            row["key"]: row["total_tokens"] for row in self._conn.execute(
+                f"SELECT key, total_tokens FROM budget_usage WHERE day = ? AND key IN ({placeholders})",
+                [day] + keys
+            )
+        }
+        reserved = {
+            row["key"]: row["tokens"] for row in self._conn.execute(
+                f"SELECT key, tokens FROM budget_reserved WHERE key IN ({placeholders})", keys
+            )
+        }
+        return {key: (used.get(key, 0), reserved.get(key, 0)) for key in keys}
+
+    def _add_reserved(self, keys: List[str], tokens: int) -> None:
+        self._conn.executemany(
+            "INSERT INTO budget_reserved (key, tokens) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET tokens = tokens + excluded.tokens",
+            [(key, tokens) for key in keys]
+        )
+        if tokens < 0:
+            self._conn.execute("DELETE FROM budget_reserved WHERE tokens <= 0")
+
+    def _release(self, reservation_id: int) -> None:
+        row = self._conn.execute(
+            "SELECT tokens, keys FROM budget_reservations WHERE id = ?", (reservation_id,)
+        ).fetchone()
+        if row is None:
+            return
+        self._conn.execute("DELETE FROM budget_reservations WHERE id = ?", (reservation_id,))
+        self._add_reserved(json.loads(row["keys"]), -row["tokens"])
+
+    def _expire_reservations(self, now: float) -> None:
+        expired = self._conn.execute(
+            "SELECT id, owner FROM budget_reservations WHERE expires_at < ?", (now,)
+        ).fetchall()
+        for row in expired:
+            logger.warning(f"Dropping expired token reservation {row['id']} of process {row['owner']}")
+            self._release(row["id"])
+
+    # ===== Rate limiter =====
+
+    def rate_check(
+        self,
+        keys: List[str],
+        evaluate: Callable[[Dict[str, float]], Tuple[Any, Dict[str, float]]],
+        now: float
+    ) -> Any:
+        """
+        Read-modify-write the rate limiter state of several keys atomically
+
+        Args:
+            keys: Keys the request counts against
+            evaluate: Called with {key: theoretical arrival time} (known keys only),
+                returns (decision, {key: new arrival time})
+            now: Current wall-clock time (keys back at a full burst are pruned
+                every RATE_PRUNE_EVERY checks; until then they read as back at a full burst anyway)
+
+        Returns:
+            The decision returned by evaluate
+        """
+        placeholders = ", ".join("?" for _ in keys)
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tats = {
+                    row["key"]: row["tat"] for row in self._conn.execute(
+                        f"SELECT key, tat FROM rate_limit_state WHERE key IN ({placeholders})", keys
+                    )
+                }
+                decision, updates = evaluate(tats)
+                self._conn.executemany(
+                    "INSERT INTO rate_limit_state (key, tat) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET tat = excluded.tat",
+                    list(updates.items())
+                )
+                self._rate_checks += 1
+                if self._rate_checks % RATE_PRUNE_EVERY == 0:
+                    # Index range scan over the expired rows only
+                    self._conn.execute("DELETE FROM rate_limit_state WHERE tat <= ?", (now,))
+                self._conn.execute("COMMIT")
+                return decision
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ===== Leases =====
+
+    def acquire_lease(self, name: str, ttl: float, owner: str = PROCESS_ID) -> bool:
+        """
+        Take or renew a named lease
+
+        Args:
+            name: Lease name (e.g. 'batch-processor')
+            ttl: Seconds the lease is held unless renewed
+            owner: Lease holder (this process by default)
+
+        Returns:
+            True if the owner holds the lease
+        """
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+                held = row is None or row["owner"] == owner or row["expires_at"] < now
+                if held:
+                    self._conn.execute(
+                        "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                        (name, owner, now + ttl)
+                    )
+                    if row is None or row["owner"] != owner:
+                        logger.info(f"Process {owner} took the '{name}' lease")
+                self._conn.execute("COMMIT")
+                return held
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+def create_shared_state() -> Optional[SharedState]:
+    """Shared state selected by SHARED_STATE_BACKEND ('memory' = single process, or 'sqlite')"""
+    backend = settings.shared_state_backend.lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        return SharedState()
+    raise ValueError(f"Unknown SHARED_STATE_BACKEND: {settings.shared_state_backend!r}")
+
+
+# Global shared state instance (None when running as a single process)
+shared_state = create_shared_state()
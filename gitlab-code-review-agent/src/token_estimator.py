@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Offline token estimation
+Predicts prompt size before calling Claude, calibrated against logged usage
+"""
+import re
+import csv
+import math
+import logging
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# One match ≈ one BPE token: short letter runs, digit groups, single symbols,
+# newlines, indentation runs and non-ASCII characters. Single spaces merge
+# into the next token.
+TOKEN_PATTERN = re.compile(r"[A-Za-z]{1,6}|\d{1,3}|[^\w\s]|\n|[ \t]{2,}|[^\x00-\x7f]")
+
+
+class TokenEstimator:
+    """
+    Fast, offline token estimator for prompt sizing and budget pre-flight
+
+    Features:
+    - Single regex pass, no tokenizer download or API call
+    - Scale factor calibrated from the monthly CSV logs (estimated vs actual
+      input tokens) on startup, then refined after every response
+    """
+
+    def __init__(self):
+        self.scale = 1.0
+        self._smoothing = 0.1  # Weight of each new observation
+
+    def count_raw(self, text: str) -> int:
+        """Uncalibrated token count (this is what gets logged for calibration)"""
+        return len(TOKEN_PATTERN.findall(text))
+
+    def estimate(self, text: str) -> int:
+        """Calibrated token estimate for a piece of text"""
+        return self.scale_raw(self.count_raw(text))
+
+    def scale_raw(self, raw_count: int) -> int:
+        """Apply the calibration factor to a raw count"""
+        return math.ceil(raw_count * self.scale)
+
+    def observe(self, raw_estimate: int, actual_tokens: int) -> None:
+        """
+        Refine the scale factor from a completed request
+
+        Args:
+            raw_estimate: count_raw() of the prompt that was sent
+            actual_tokens: input_tokens reported by the API
+        """
+        if raw_estimate <= 0 or actual_tokens <= 0:
+            return
+        ratio = actual_tokens / raw_estimate
+        self.scale = (1 - self._smoothing) * self.scale + self._smoothing * ratio
+
+    def calibrate_from_logs(self, log_dir: Path, max_files: int = 2) -> Optional[float]:
+        """
+        Set the scale factor from the most recent monthly CSV logs
+
+        Uses rows that carry both estimated_input_tokens and input_tokens.
+
+        Args:
+            log_dir: token-logs directory (YYYY-MM.csv files)
+            max_files: Number of most recent months to read
+
+        Returns:
+            New scale factor, or None if there was nothing to calibrate from
+        """
+        estimated_total = 0
+        actual_total = 0
+
+        for csv_path in sorted(Path(log_dir).glob("*.csv"))[-max_files:]:
+            try:
+                with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+                    for row in csv.DictReader(f):
+                        estimated = int(row.get("estimated_input_tokens") or 0)
+                        # Whole prompt: uncached input plus prompt-cache writes and reads
+                        actual = sum(
+                            int(row.get(column) or 0)
+                            for column in (
+                                "input_tokens",
+                                "cache_creation_input_tokens",
+                                "cache_read_input_tokens"
+                            )
+                        )
+                        if estimated > 0 and actual > 0:
+                            estimated_total += estimated
+                            actual_total += actual
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to read {csv_path.name} for token calibration: {e}")
+
+        if estimated_total == 0:
+            return None
+
+        self.scale = actual_total / estimated_total
+        logger.info(f"Token estimator calibrated from logs: scale={self.scale:.3f}")
+        return self.scale
+
+
+# Global estimator instance
+estimator = TokenEstimator()
@@ -1,34 +1,44 @@
 # -*- coding: utf-8 -*-
 """
 Token usage tracking and budget enforcement
-Excel-friendly CSV logging with monthly rotation
+Indexed usage store (SQLite) with Excel-friendly monthly CSV export
 """
-import csv
 import json
 import asyncio
+import itertools
+import threading
 from datetime import datetime, date, timedelta
 from pathlib import Path
-from typing import Dict, Optional
-from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from dataclasses import dataclass, field, asdict
 import logging
 
 from src.config import settings
+from src.usage_store import TOTAL_COLUMNS, TokenUsage, UsageEvent, create_usage_store
+from src.shared_state import shared_state, PROCESS_ID, RESERVATION_TTL
+from src.exceptions import ReviewDeferred
 
 logger = logging.getLogger(__name__)
 
+# Counter key of the global budget in the shared state
+GLOBAL_QUOTA_KEY = "global"
+
+
+@dataclass
+class TokenReservation:
+    """Tokens held against today's budget while a Claude request is in flight"""
+    id: int
+    tokens: int
+    quota_keys: List[str] = field(default_factory=list)  # Group/project/user quotas also charged
+
 
 @dataclass
-class TokenUsage:
-    """Token usage for a single successful review request"""
-    project_id: int
-    project_name: str
-    mr_iid: int
-    username: str
-    input_tokens: int
-    output_tokens: int
-    total_tokens: int
-    model: str
-    duration_ms: int
+class Quota:
+    """One level of the quota hierarchy a request counts against"""
+    level: str            # global, group, project or user
+    key: Optional[str]    # Counter key in the daily summary (None for global)
+    label: str            # Shown in budget messages
+    limit: int
 
 
 class TokenTracker:
@@ -36,22 +46,34 @@ class TokenTracker:
     Track and enforce daily token budgets with Excel-friendly logging
     
     Features:
-    - Fast daily budget checks (<10ms)
+    - Fast daily budget checks (O(1), in memory)
+    - Two-phase reservations (reserve → commit/release) so concurrent
+      reviews cannot overshoot the daily limit
+    - Hierarchical quotas (global → group → project → user), checked
+      against in-memory per-day counters
+    - In-memory daily summaries are authoritative; each usage event is
+      appended to a write-ahead journal and written to the usage store by
+      a background flush (every TOKEN_FLUSH_INTERVAL seconds or
+      TOKEN_FLUSH_MAX_EVENTS events)
+    - Unflushed events are replayed from the journal on startup
+    - Pluggable usage store (TOKEN_STORE_BACKEND): indexed SQLite by
+      default, or the original CSV/JSON files
     - Excel-friendly monthly CSV logs
+    - Several worker processes (SHARED_STATE_BACKEND=sqlite): usage counters
+      and reservations live in the shared state, so every check and
+      reservation sees all processes; each usage event is written to the
+      store directly instead of the per-process journal
     - Hard limit enforcement
-    - Automatic cleanup of old files
+    - Automatic cleanup of old usage
     - Only logs successful Claude API responses
     """
     
     def __init__(self):
-        # Directory structure
+        # Usage store (events, daily summaries, CSV logs)
         self.data_dir = Path(settings.token_data_dir)
-        self.daily_summaries_dir = self.data_dir / "daily-summaries"
-        self.token_logs_dir = self.data_dir / "token-logs"
-        
-        # Create directories
-        self.daily_summaries_dir.mkdir(parents=True, exist_ok=True)
-        self.token_logs_dir.mkdir(parents=True, exist_ok=True)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.store = create_usage_store(self.data_dir)
+        self.token_logs_dir = self.data_dir / "token-logs"  # Monthly CSV logs (kept by every backend)
         
         # Budget settings
         self.daily_limit = settings.token_daily_limit
@@ -59,54 +81,296 @@ class TokenTracker:
         self.summary_retention_days = settings.token_summary_retention_days
         self.log_retention_days = settings.token_log_retention_days
         
-        # In-memory cache for fast budget checks
-        self._today_total = None
-        self._last_check = None
-        self._cache_ttl_seconds = 60  # Cache for 1 minute
+        # Write-ahead journal of usage events not yet flushed to CSV/summaries
+        self.journal_path = self.data_dir / "usage-journal.jsonl"
+        self._journal_lock = threading.Lock()
+        
+        # In-memory state: daily summaries by ISO date (authoritative), events awaiting flush
+        self._summaries: Dict[str, Dict] = {}
+        self._unflushed: List[UsageEvent] = []
+        self._seq = 0  # Journal sequence number of the latest event
+        self._reservations: Dict[int, TokenReservation] = {}
+        self._reserved_total = 0
+        self._reserved_by_quota: Dict[str, int] = {}
+        self._reservation_ids = itertools.count(1)
+        self.shared = shared_state  # None when running as a single process
+        self._releases: Set[asyncio.Task] = set()
         self._lock = asyncio.Lock()
+        self._flush_wanted: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        
+        self._replay_journal()
+        if self.shared is not None:
+            self._seed_shared()
         
         logger.info(f"TokenTracker initialized: limit={self.daily_limit:,} tokens/day")
     
-    async def check_budget(self) -> tuple[bool, int, str]:
+    async def start(self) -> None:
+        """Start the background flush (app startup)"""
+        if self._flush_task is None:
+            self._flush_wanted = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop(), name="token-flush")
+    
+    async def close(self) -> None:
+        """Stop the background flush and write out everything pending (app shutdown)"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await asyncio.gather(*self._releases, return_exceptions=True)
+        await self.flush()
+    
+    async def reserve(
+        self,
+        tokens: int,
+        project_id: Optional[int] = None,
+        project_name: Optional[str] = None,
+        username: Optional[str] = None,
+        ttl: Optional[float] = None
+    ) -> Tuple[Optional[TokenReservation], int, str, Optional[str]]:
         """
-        Check if we're within daily budget (FAST - cached)
+        Reserve tokens for a Claude request before sending it
+        
+        The check and the reservation happen without yielding to the event
+        loop, so concurrent reviews can't all pass against the same total.
+        With several worker processes they are one shared-state transaction.
+        The tokens are held against the global budget and every group,
+        project and user quota the request falls under.
+        Every reservation must end in commit() or release().
         
+        Args:
+            tokens: Worst-case tokens for the request (estimated input + max output)
+            project_id: Project the request is for (selects project/user quotas)
+            project_name: Project path (selects the group quota)
+            username: MR author (selects the user quota)
+            ttl: Seconds the shared state holds the reservation if it is never
+                released (default RESERVATION_TTL; longer for Message Batches)
+            
         Returns:
-            (allowed, tokens_used_today, message)
+            (reservation or None if a quota can't cover it, tokens_used_today, message,
+             level of the quota that blocked it or None)
+            tokens_used_today includes tokens reserved by requests in flight.
+            
+        Raises:
+            ReviewDeferred: If only tokens reserved by requests in flight stand in
+                the way (they may be released or cost less once those finish)
         """
         if not settings.token_budget_enabled:
-            return (True, 0, "Budget tracking disabled")
+            return (TokenReservation(id=0, tokens=0), 0, "Budget tracking disabled", None)
+        
+        quotas = self._quotas(project_id, project_name, username)
+        if self.shared is not None:
+            return await self._reserve_shared(tokens, quotas, ttl)
+        
+        summary = await self._today_summary()
+        
+        # No awaits from here on - check and reserve atomically
+        denial = self._denial(
+            quotas,
+            {quota.key: (self._quota_used(summary, quota), self._quota_reserved(quota)) for quota in quotas},
+            tokens
+        )
+        if denial is not None:
+            self._defer_if_only_reserved(quotas, {quota.key: self._quota_used(summary, quota) for quota in quotas}, tokens)
+            return (None, self._global_used(summary), *denial)
+        
+        reservation = TokenReservation(
+            id=next(self._reservation_ids),
+            tokens=tokens,
+            quota_keys=[quota.key for quota in quotas if quota.key is not None]
+        )
+        self._reservations[reservation.id] = reservation
+        self._reserved_total += tokens
+        for key in reservation.quota_keys:
+            self._reserved_by_quota[key] = self._reserved_by_quota.get(key, 0) + tokens
+        tokens_used = self._global_used(summary)
+        return (reservation, tokens_used, self._reserved_message(tokens, tokens_used), None)
+    
+    async def _reserve_shared(
+        self,
+        tokens: int,
+        quotas: List[Quota],
+        ttl: Optional[float] = None
+    ) -> Tuple[Optional[TokenReservation], int, str, Optional[str]]:
+        """reserve() against the shared state (check and reservation in one transaction)"""
+        reservation_id, counters = await asyncio.to_thread(
+            self.shared.reserve,
+            datetime.utcnow().date().isoformat(),
+            tokens,
+            [(quota.key or GLOBAL_QUOTA_KEY, quota.limit) for quota in quotas],
+            ttl or RESERVATION_TTL
+        )
+        counters = {quota.key: counters[quota.key or GLOBAL_QUOTA_KEY] for quota in quotas}
+        tokens_used = sum(counters[None])
+        if reservation_id is None:
+            self._defer_if_only_reserved(quotas, {key: used for key, (used, _) in counters.items()}, tokens)
+            return (None, tokens_used, *self._denial(quotas, counters, tokens))
+        
+        reservation = TokenReservation(id=reservation_id, tokens=tokens)
+        self._reservations[reservation.id] = reservation
+        tokens_used += tokens
+        return (reservation, tokens_used, self._reserved_message(tokens, tokens_used), None)
+    
+    def _denial(
+        self,
+        quotas: List[Quota],
+        counters: Dict[Optional[str], Tuple[int, int]],
+        tokens: int
+    ) -> Optional[Tuple[str, str]]:
+        """
+        First quota that can't cover a request
         
-        tokens_used = await self._get_today_total()
-        remaining = self.daily_limit - tokens_used
+        Args:
+            quotas: Quotas the request counts against
+            counters: (used, reserved) per quota key
+            tokens: Tokens the request needs
+            
+        Returns:
+            (message, quota level), or None if every quota can cover it
+        """
+        for quota in quotas:
+            used, reserved = counters[quota.key]
+            remaining = quota.limit - used - reserved
+            
+            if used + reserved >= quota.limit:
+                return (self._exhausted_message(quota, used + reserved), quota.level)
+            
+            if tokens > remaining:
+                scope = "today's budget" if quota.key is None else f"the {quota.label}"
+                return (
+                    f"❌ This review needs ~{tokens:,} tokens but only {remaining:,} remain "
+                    f"in {scope} ({used:,} used, {reserved:,} reserved "
+                    f"by reviews in progress, limit {quota.limit:,}). "
+                    f"AI code reviews will resume tomorrow.",
+                    quota.level
+                )
+        return None
+    
+    def _defer_if_only_reserved(self, quotas: List[Quota], used: Dict[Optional[str], int], tokens: int) -> None:
+        """
+        Raise ReviewDeferred if every quota could cover the request without the in-flight reservations
         
-        # Hard limit - reject if exhausted
-        if tokens_used >= self.daily_limit:
-            return (
-                False, 
-                tokens_used,
-                f"❌ Daily token budget exhausted ({tokens_used:,}/{self.daily_limit:,} tokens used). "
-                f"AI code reviews will resume tomorrow."
-            )
+        Reservations are worst-case estimates that are released or swapped for
+        the (usually smaller) actual usage, so the review should be retried
+        rather than told the budget is exhausted.
         
-        # Warning threshold
-        if tokens_used >= self.warning_threshold:
-            pct_used = (tokens_used / self.daily_limit) * 100
-            return (
-                True,
-                tokens_used,
-                f"⚠️ Warning: {pct_used:.1f}% of daily budget used "
-                f"({tokens_used:,}/{self.daily_limit:,} tokens). "
-                f"{remaining:,} tokens remaining."
+        Args:
+            quotas: Quotas the request counts against
+            used: Committed tokens per quota key
+            tokens: Tokens the request needs
+        """
+        if all(used[quota.key] + tokens <= quota.limit for quota in quotas):
+            raise ReviewDeferred(
+                float(settings.review_timeout),
+                "token budget held by reviews in progress"
             )
+    
+    def _reserved_message(self, tokens: int, tokens_used: int) -> str:
+        """Message for a successful reservation (tokens_used includes reservations)"""
+        pct_used = (tokens_used / self.daily_limit) * 100
+        return f"Reserved {tokens:,} tokens ({pct_used:.1f}% of daily budget used or reserved)"
+    
+    def resume(self, reservation_id: int, tokens: int, owner: str) -> Optional[TokenReservation]:
+        """
+        Reservation made earlier for a request that completes later (e.g. a Message Batch)
+        
+        With the shared state any process can commit or release it. A
+        single-process reservation only lives as long as the process that
+        made it.
         
-        return (True, tokens_used, f"✅ Budget OK ({remaining:,} tokens remaining)")
+        Args:
+            reservation_id: ID of the reservation returned by reserve()
+            tokens: Tokens it holds
+            owner: PROCESS_ID of the process that made it
+            
+        Returns:
+            The reservation to commit() or release(), or None if it was lost in a restart
+        """
+        if self.shared is None:
+            return self._reservations.get(reservation_id) if owner == PROCESS_ID else None
+        return self._reservations.setdefault(reservation_id, TokenReservation(id=reservation_id, tokens=tokens))
+    
+    def release(self, reservation: Optional[TokenReservation]) -> None:
+        """
+        Return a reservation's tokens to the budget (request failed or was cancelled)
+        
+        Safe to call more than once, and after commit().
+        """
+        if reservation is None:
+            return
+        held = self._reservations.pop(reservation.id, None)
+        if held is None:
+            return
+        if self.shared is not None:
+            # Returned in the background (the shared state expires it if this process dies first)
+            task = asyncio.create_task(self._release_shared(held.id))
+            self._releases.add(task)
+            task.add_done_callback(self._releases.discard)
+            return
+        self._reserved_total -= held.tokens
+        for key in held.quota_keys:
+            self._reserved_by_quota[key] -= held.tokens
+            if not self._reserved_by_quota[key]:
+                del self._reserved_by_quota[key]
+    
+    async def commit(self, reservation: Optional[TokenReservation], usage: TokenUsage) -> None:
+        """
+        Reconcile a reservation to the actual usage of a SUCCESSFUL request
+        
+        The reservation is swapped for the actual total in one step (no window
+        where neither is counted), then the usage is journaled.
+        
+        Args:
+            reservation: Reservation returned by reserve()
+            usage: Token usage details from Claude API response
+        """
+        if not settings.token_budget_enabled:
+            self.release(reservation)
+            return
+        
+        if self.shared is None:
+            await self._record_local(usage, reservation)
+            return
+        
+        held = self._reservations.pop(reservation.id, None) if reservation is not None else None
+        await self._record_shared(usage, held.id if held is not None else None)
+    
+    async def _release_shared(self, reservation_id: int) -> None:
+        """Return a reservation to the shared state"""
+        try:
+            await asyncio.to_thread(self.shared.release, reservation_id)
+        except Exception as e:
+            logger.error(f"Failed to release token reservation {reservation_id}: {e}", exc_info=True)
+    
+    async def _record_shared(self, usage: TokenUsage, reservation_id: Optional[int]) -> None:
+        """
+        Count usage in the shared state (swapping out its reservation) and write it to the store
+        
+        With several processes there is no journal: the event is durable once this returns.
+        """
+        now = datetime.utcnow()
+        keys = [GLOBAL_QUOTA_KEY] + self._usage_quota_keys(usage.project_id, usage.project_name, usage.username)
+        totals = {column: getattr(usage, column) for column in TOTAL_COLUMNS}
+        totals["request_count"] = 1
+        try:
+            await asyncio.to_thread(self.shared.add_usage, now.date().isoformat(), keys, totals, reservation_id)
+            await asyncio.to_thread(self.store.write, [(None, now, usage)], {})
+        except Exception as e:
+            logger.error(f"Failed to record token usage: {e}", exc_info=True)
+            return
+        
+        logger.info(
+            f"Recorded token usage: MR {usage.mr_iid} in project {usage.project_id} "
+            f"({usage.total_tokens:,} tokens)"
+        )
     
     async def record_usage(self, usage: TokenUsage) -> None:
         """
         Record token usage from a SUCCESSFUL Claude API response
         
         This is called AFTER successful review completion, not for errors.
+        The usage counts against the budget immediately and is durable once
+        the journal append returns; CSV and summary files follow on the next flush.
         
         Args:
             usage: Token usage details from Claude API response
@@ -114,128 +378,293 @@ class TokenTracker:
         if not settings.token_budget_enabled:
             return
         
+        if self.shared is not None:
+            await self._record_shared(usage, None)
+            return
+        
+        await self._record_local(usage, None)
+    
+    async def _record_local(self, usage: TokenUsage, reservation: Optional[TokenReservation]) -> None:
+        """
+        Count usage in memory (swapping out its reservation) and journal it (single process)
+        
+        The day's summary is loaded first, so the reservation is released and
+        the usage counted without an await in between.
+        """
+        now = datetime.utcnow()
+        if now.date().isoformat() not in self._summaries:
+            await self._today_summary()
+        
+        # Count the usage in memory right away (no await until it is queued for flush)
+        self.release(reservation)
+        self._seq += 1
+        seq = self._seq
+        self._apply(seq, now, usage)
+        self._unflushed.append((seq, now, usage))
+        
+        try:
+            await asyncio.to_thread(self._append_to_journal, seq, now, usage)
+        except Exception as e:
+            # Still flushed from memory; only lost if the process dies first
+            logger.error(f"Failed to journal token usage: {e}", exc_info=True)
+        
+        logger.info(
+            f"Recorded token usage: MR {usage.mr_iid} in project {usage.project_id} "
+            f"({usage.total_tokens:,} tokens)"
+        )
+        
+        if self._flush_wanted is not None and len(self._unflushed) >= settings.token_flush_max_events:
+            self._flush_wanted.set()
+    
+    async def flush(self) -> None:
+        """Write pending usage events and daily summaries to the usage store, then trim the journal"""
         async with self._lock:
+            if not self._unflushed:
+                return
+            
+            # Snapshot events and the summaries they touched (consistent: no await in between)
+            events, self._unflushed = self._unflushed, []
+            summaries = {
+                day: dict(self._summaries[day])
+                for day in {timestamp.date().isoformat() for _, timestamp, _ in events}
+            } if self.shared is None else {}  # Shared summaries are built from the shared counters
+            
             try:
-                # Get current timestamp
-                now = datetime.utcnow()
-                
-                # 1. Append to monthly CSV log
-                await self._append_to_monthly_csv(usage, now)
-                
-                # 2. Update daily summary JSON
-                await self._update_daily_summary(usage, now)
-                
-                # 3. Invalidate cache
-                self._today_total = None
-                
-                logger.info(
-                    f"Recorded token usage: MR {usage.mr_iid} in project {usage.project_id} "
-                    f"({usage.total_tokens:,} tokens)"
-                )
-                
+                await asyncio.to_thread(self._flush_sync, events, summaries)
             except Exception as e:
-                logger.error(f"Failed to record token usage: {e}", exc_info=True)
-                # Don't fail the review if logging fails
+                logger.error(f"Failed to flush token usage ({len(events)} events), will retry: {e}", exc_info=True)
+                self._unflushed = events + self._unflushed
+                return
+            
+            # Keep only today's summary in memory
+            today = datetime.utcnow().date().isoformat()
+            for day in list(self._summaries):
+                if day != today and not any(ts.date().isoformat() == day for _, ts, _ in self._unflushed):
+                    del self._summaries[day]
+            
+            logger.debug(f"Flushed {len(events)} token usage event(s)")
+    
+    async def _flush_loop(self) -> None:
+        """Flush on a timer, or sooner when enough events have accumulated"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), settings.token_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            await self.flush()
     
-    async def _get_today_total(self) -> int:
+    def _flush_sync(self, events: List[UsageEvent], summaries: Dict[str, Dict]) -> None:
+        """Write events and summaries (with their journal position) to the store, drop flushed journal lines"""
+        self.store.write(events, summaries)
+        
+        flushed_seq = max(seq for seq, _, _ in events)
+        with self._journal_lock:
+            if not self.journal_path.exists():
+                return
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                remaining = [line for line in f if line.strip() and json.loads(line)["seq"] > flushed_seq]
+            temp_path = self.journal_path.with_suffix('.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.writelines(remaining)
+            temp_path.replace(self.journal_path)
+    
+    def _append_to_journal(self, seq: int, timestamp: datetime, usage: TokenUsage) -> None:
+        """Append one usage event to the write-ahead journal"""
+        line = json.dumps({"seq": seq, "timestamp": timestamp.isoformat(), "usage": asdict(usage)})
+        with self._journal_lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+                f.flush()
+    
+    def _replay_journal(self) -> None:
         """
-        Get today's token total with 1-minute caching
+        Rebuild in-memory state after a restart or crash (startup, before the event loop runs)
         
-        Returns:
-            Total tokens used today
+        Journal events newer than their day's summary (journal_seq) were never
+        flushed; they are re-applied and queued for the next flush.
         """
-        now = datetime.utcnow()
+        today = datetime.utcnow()
+        self._summaries[today.date().isoformat()] = self._load_daily_summary(today)
         
-        # Cache hit (within 1 minute)
-        if self._today_total is not None and self._last_check is not None:
-            if (now - self._last_check).total_seconds() < self._cache_ttl_seconds:
-                return self._today_total
+        # Continue the sequence from the store
+        self._seq = self.store.latest_journal_seq()
         
-        # Cache miss - read from file
-        async with self._lock:
-            summary = await self._read_daily_summary()
-            self._today_total = summary.get("total_tokens", 0)
-            self._last_check = now
-            return self._today_total
-    
-    async def _append_to_monthly_csv(self, usage: TokenUsage, timestamp: datetime) -> None:
-        """
-        Append usage to monthly CSV log (Excel-friendly format)
-        
-        File format: token-logs/YYYY-MM.csv
-        Columns: year,month,day,time,project_id,project_name,mr_iid,username,
-                 input_tokens,output_tokens,total_tokens,model,duration_ms
-        """
-        csv_path = self._get_monthly_csv_path(timestamp)
-        
-        # Create with headers if doesn't exist
-        if not csv_path.exists():
-            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    'year', 'month', 'day', 'time',
-                    'project_id', 'project_name', 'mr_iid', 'username',
-                    'input_tokens', 'output_tokens', 'total_tokens',
-                    'model', 'duration_ms'
-                ])
-            logger.info(f"Created new monthly log: {csv_path.name}")
-        
-        # Append usage (Excel-friendly format)
-        with open(csv_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                timestamp.year,
-                timestamp.month,
-                timestamp.day,
-                timestamp.strftime('%H:%M:%S'),  # Time only (HH:MM:SS)
-                usage.project_id,
-                usage.project_name,
-                usage.mr_iid,
-                usage.username,
-                usage.input_tokens,
-                usage.output_tokens,
-                usage.total_tokens,
-                usage.model,
-                usage.duration_ms
-            ])
-    
-    async def _update_daily_summary(self, usage: TokenUsage, timestamp: datetime) -> None:
-        """
-        Update daily summary JSON (atomic write)
-        
-        File format: daily-summaries/YYYY-MM-DD.json
-        """
-        summary_path = self._get_daily_summary_path(timestamp)
-        
-        # Read current summary
-        summary = await self._read_daily_summary(timestamp)
+        if not self.journal_path.exists():
+            return
         
-        # Update totals
+        replayed = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    seq = event["seq"]
+                    timestamp = datetime.fromisoformat(event["timestamp"])
+                    usage = TokenUsage(**event["usage"])
+                except (ValueError, KeyError, TypeError) as e:
+                    # A torn last line from a crash mid-write
+                    logger.warning(f"Skipping unreadable token journal line: {e}")
+                    continue
+                
+                self._seq = max(self._seq, seq)
+                day = timestamp.date().isoformat()
+                if day not in self._summaries:
+                    self._summaries[day] = self._load_daily_summary(timestamp)
+                if seq <= self._summaries[day].get("journal_seq", 0):
+                    continue  # Already in the summary
+                self._apply(seq, timestamp, usage)
+                self._unflushed.append((seq, timestamp, usage))
+                replayed += 1
+        
+        if replayed:
+            logger.info(f"Replayed {replayed} unflushed token usage event(s) from the journal")
+    
+    def _seed_shared(self) -> None:
+        """
+        Carry today's single-process usage into the shared counters (startup)
+        
+        When SHARED_STATE_BACKEND is switched on mid-day the shared counters
+        start empty; without this, usage from earlier that day would not count.
+        Does nothing once the shared state has counters for today.
+        """
+        today = datetime.utcnow().date().isoformat()
+        summary = self._summaries.get(today)
+        if not summary or not summary.get("request_count"):
+            return
+        counters = {GLOBAL_QUOTA_KEY: {column: summary.get(column, 0) for column in TOTAL_COLUMNS + ["request_count"]}}
+        for key, tokens in summary.get("quota_tokens", {}).items():
+            counters[key] = {"total_tokens": tokens}
+        if self.shared.seed_usage(today, counters):
+            logger.info(f"Seeded today's shared budget counters from the usage store ({summary['total_tokens']:,} tokens)")
+    
+    def _apply(self, seq: int, timestamp: datetime, usage: TokenUsage) -> None:
+        """Add a usage event to its day's in-memory summary"""
+        day = timestamp.date().isoformat()
+        summary = self._summaries.setdefault(day, self._empty_summary(timestamp))
         summary["total_tokens"] += usage.total_tokens
         summary["input_tokens"] += usage.input_tokens
         summary["output_tokens"] += usage.output_tokens
+        summary["cache_creation_input_tokens"] = (
+            summary.get("cache_creation_input_tokens", 0) + usage.cache_creation_input_tokens
+        )
+        summary["cache_read_input_tokens"] = (
+            summary.get("cache_read_input_tokens", 0) + usage.cache_read_input_tokens
+        )
         summary["request_count"] += 1
+        quota_tokens = summary.setdefault("quota_tokens", {})
+        for key in self._usage_quota_keys(usage.project_id, usage.project_name, usage.username):
+            quota_tokens[key] = quota_tokens.get(key, 0) + usage.total_tokens
         summary["last_updated"] = timestamp.isoformat() + "Z"
         summary["budget_remaining"] = self.daily_limit - summary["total_tokens"]
         summary["budget_exhausted"] = summary["total_tokens"] >= self.daily_limit
-        
-        # Atomic write (temp file + rename)
-        temp_path = summary_path.with_suffix('.tmp')
-        with open(temp_path, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, indent=2)
-        try:
-            temp_path.replace(summary_path)
-        except Exception as e:
-            logger.error(f"Failed to atomically replace {summary_path} with {temp_path}: {e}", exc_info=True)
-            # Optionally, try to clean up the temp file
-            try:
-                if temp_path.exists():
-                    temp_path.unlink()
-            except Exception as cleanup_exc:
-                logger.error(f"Failed to clean up temp file {temp_path}: {cleanup_exc}", exc_info=True)
+        summary["journal_seq"] = max(summary.get("journal_seq", 0), seq)
+    
+    async def _today_summary(self) -> Dict:
+        """Today's in-memory summary (loaded from the store on the first read of the day)"""
+        now = datetime.utcnow()
+        today = now.date().isoformat()
+        if self.shared is not None:
+            # Refresh from the shared counters (reservations included) on every read
+            summary, reserved = await asyncio.to_thread(self._load_shared_summary, now)
+            self._summaries[today] = summary
+            self._reserved_total = reserved.pop(GLOBAL_QUOTA_KEY, 0)
+            self._reserved_by_quota = reserved
+            return summary
+        if today not in self._summaries:
+            # First check of the day - load from the daily summary (normally absent)
+            summary = await asyncio.to_thread(self._load_daily_summary, now)
+            self._summaries.setdefault(today, summary)
+        return self._summaries[today]
+    
+    def _exhausted_message(self, quota: Quota, tokens_used: int) -> str:
+        """Budget/quota-exhausted message shown on the MR"""
+        if quota.key is None:
+            return (
+                f"❌ Daily token budget exhausted ({tokens_used:,}/{self.daily_limit:,} tokens used). "
+                f"AI code reviews will resume tomorrow."
+            )
+        return (
+            f"❌ The {quota.label} is exhausted ({tokens_used:,}/{quota.limit:,} tokens used). "
+            f"Other reviews are not affected; reviews under this quota will resume tomorrow."
+        )
+    
+    def _quotas(
+        self,
+        project_id: Optional[int],
+        project_name: Optional[str],
+        username: Optional[str]
+    ) -> List[Quota]:
+        """Quotas a request counts against, from the global budget down to the user"""
+        quotas = [Quota("global", None, "daily token budget", self.daily_limit)]
+        if project_id is None:
+            return quotas
+        
+        project_label = project_name or f"project {project_id}"
+        group = self._group_for(project_name)
+        if group is not None:
+            quotas.append(Quota(
+                "group", f"group:{group}", f"daily token quota for group {group}",
+                settings.token_group_daily_limits[group]
+            ))
+        
+        project_limit = settings.token_project_daily_limits.get(
+            project_id, settings.token_default_project_daily_limit
+        )
+        if project_limit > 0:
+            quotas.append(Quota(
+                "project", f"project:{project_id}", f"daily token quota for {project_label}", project_limit
+            ))
+        
+        user_limit = settings.token_project_user_daily_limits.get(
+            project_id, settings.token_default_user_daily_limit
+        )
+        if username and user_limit > 0:
+            quotas.append(Quota(
+                "user", f"user:{project_id}:{username}",
+                f"daily token quota for @{username} in {project_label}", user_limit
+            ))
+        return quotas
+    
+    def _usage_quota_keys(self, project_id: int, project_name: str, username: str) -> List[str]:
+        """Summary counters a usage event adds to (projects and users always, groups if configured)"""
+        keys = [f"project:{project_id}", f"user:{project_id}:{username}"]
+        group = self._group_for(project_name)
+        if group is not None:
+            keys.append(f"group:{group}")
+        return keys
+    
+    @staticmethod
+    def _group_for(project_name: Optional[str]) -> Optional[str]:
+        """Most specific configured group containing the project (path_with_namespace)"""
+        if not project_name or not settings.token_group_daily_limits:
+            return None
+        namespace = project_name.rsplit("/", 1)[0] if "/" in project_name else ""
+        while namespace:
+            if namespace in settings.token_group_daily_limits:
+                return namespace
+            namespace = namespace.rsplit("/", 1)[0] if "/" in namespace else ""
+        return None
+    
+    def _global_used(self, summary: Dict) -> int:
+        """Committed plus reserved tokens"""
+        return summary["total_tokens"] + self._reserved_total
+    
+    @staticmethod
+    def _quota_used(summary: Dict, quota: Quota) -> int:
+        """Tokens committed against a quota on the summary's day"""
+        if quota.key is None:
+            return summary["total_tokens"]
+        return summary.get("quota_tokens", {}).get(quota.key, 0)
+    
+    def _quota_reserved(self, quota: Quota) -> int:
+        """Tokens reserved against a quota by requests in flight"""
+        if quota.key is None:
+            return self._reserved_total
+        return self._reserved_by_quota.get(quota.key, 0)
+    
     async def _read_daily_summary(self, timestamp: Optional[datetime] = None) -> Dict:
         """
-        Read daily summary JSON
+        Read daily summary (in memory for today and unflushed days, else from the store)
         
         Args:
             timestamp: Date to read (defaults to today)
@@ -246,33 +675,50 @@ class TokenTracker:
         if timestamp is None:
             timestamp = datetime.utcnow()
         
-        summary_path = self._get_daily_summary_path(timestamp)
-        
-        if not summary_path.exists():
-            return {
-                "date": timestamp.date().isoformat(),
-                "total_tokens": 0,
-                "input_tokens": 0,
-                "output_tokens": 0,
-                "request_count": 0,
-                "last_updated": timestamp.isoformat() + "Z",
-                "budget_limit": self.daily_limit,
-                "budget_remaining": self.daily_limit,
-                "budget_exhausted": False
-            }
+        if self.shared is not None:
+            summary, _ = await asyncio.to_thread(self._load_shared_summary, timestamp)
+            return summary
         
-        with open(summary_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        summary = self._summaries.get(timestamp.date().isoformat())
+        if summary is not None:
+            return dict(summary)
+        return await asyncio.to_thread(self._load_daily_summary, timestamp)
     
-    def _get_monthly_csv_path(self, timestamp: datetime) -> Path:
-        """Get path to monthly CSV file (YYYY-MM.csv)"""
-        month_str = timestamp.strftime('%Y-%m')
-        return self.token_logs_dir / f"{month_str}.csv"
+    def _load_daily_summary(self, timestamp: datetime) -> Dict:
+        """Load a daily summary from the store (empty summary if there is none)"""
+        return self.store.load_summary(timestamp.date().isoformat()) or self._empty_summary(timestamp)
     
-    def _get_daily_summary_path(self, timestamp: datetime) -> Path:
-        """Get path to daily summary JSON (YYYY-MM-DD.json)"""
-        date_str = timestamp.date().isoformat()
-        return self.daily_summaries_dir / f"{date_str}.json"
+    def _load_shared_summary(self, timestamp: datetime) -> Tuple[Dict, Dict[str, int]]:
+        """
+        Build a day's summary from the shared counters
+        
+        Returns:
+            (summary, {quota key or GLOBAL_QUOTA_KEY: tokens reserved})
+        """
+        usage, reserved = self.shared.budget_snapshot(timestamp.date().isoformat())
+        summary = self._empty_summary(timestamp)
+        summary.update(usage.pop(GLOBAL_QUOTA_KEY, {}))
+        summary["quota_tokens"] = {key: totals["total_tokens"] for key, totals in usage.items()}
+        summary["budget_remaining"] = self.daily_limit - summary["total_tokens"]
+        summary["budget_exhausted"] = summary["total_tokens"] >= self.daily_limit
+        return summary, reserved
+    
+    def _empty_summary(self, timestamp: datetime) -> Dict:
+        """Summary for a day without usage"""
+        return {
+            "date": timestamp.date().isoformat(),
+            "total_tokens": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "request_count": 0,
+            "last_updated": timestamp.isoformat() + "Z",
+            "budget_limit": self.daily_limit,
+            "budget_remaining": self.daily_limit,
+            "budget_exhausted": False,
+            "journal_seq": 0
+        }
     
     async def get_daily_stats(self, target_date: Optional[date] = None) -> Dict:
         """
@@ -295,6 +741,8 @@ class TokenTracker:
             "total_tokens": summary["total_tokens"],
             "input_tokens": summary["input_tokens"],
             "output_tokens": summary["output_tokens"],
+            "cache_creation_input_tokens": summary.get("cache_creation_input_tokens", 0),
+            "cache_read_input_tokens": summary.get("cache_read_input_tokens", 0),
             "request_count": summary["request_count"],
             "budget_limit": self.daily_limit,
             "budget_used_percent": (
@@ -310,67 +758,181 @@ class TokenTracker:
             "last_updated": summary["last_updated"]
         }
     
-    async def cleanup_old_files(self) -> Dict[str, int]:
+    async def query_usage(
+        self,
+        start: date,
+        end: date,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> Dict[str, int]:
         """
-        Delete files older than retention period
+        Sum usage over a date range, optionally for one project, user or model
+        
+        Pending events are flushed first so the totals include them.
         
+        Args:
+            start: First day (inclusive)
+            end: Last day (inclusive)
+            project_id: Only this project
+            username: Only this user
+            model: Only this model
+            
         Returns:
-            {'summaries_deleted': N, 'logs_deleted': M}
+            {'total_tokens': ..., 'input_tokens': ..., ..., 'request_count': N}
         """
-        summaries_deleted = 0
-        logs_deleted = 0
+        await self.flush()
+        return await asyncio.to_thread(self.store.query_totals, start, end, project_id, username, model)
+    
+    async def get_quota_status(
+        self,
+        project_id: Optional[int] = None,
+        project_name: Optional[str] = None,
+        username: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Today's usage and remaining tokens for each quota level
         
-        try:
-            # Cleanup daily summaries (90 days default)
-            summary_cutoff = date.today() - timedelta(days=self.summary_retention_days)
-            for file in self.daily_summaries_dir.glob("*.json"):
-                try:
-                    # Extract date from filename (YYYY-MM-DD.json)
-                    file_date_str = file.stem
-                    file_date = date.fromisoformat(file_date_str)
-                    
-                    if file_date < summary_cutoff:
-                        file.unlink()
-                        summaries_deleted += 1
-                        logger.debug(f"Deleted old summary: {file.name}")
-                except (ValueError, OSError) as e:
-                    logger.warning(f"Failed to process summary file {file.name}: {e}")
+        Without a project, every group/project quota that is configured or
+        has usage today is listed; with a project (and user), the chain of
+        quotas a review of it counts against.
+        
+        Returns:
+            [{'level', 'key', 'label', 'limit', 'used', 'reserved', 'remaining'}, ...]
+            (limit is None for projects/users without a quota)
+        """
+        summary = await self._today_summary()
+        
+        if project_id is not None:
+            quotas = self._quotas(project_id, project_name, username)
+            # Show the project and user even without a quota (usage only)
+            keys = {quota.key for quota in quotas}
+            for level, key, label in (
+                ("project", f"project:{project_id}", f"usage of {project_name or f'project {project_id}'}"),
+                ("user", f"user:{project_id}:{username}", f"usage of @{username}")
+            ):
+                if key not in keys and (level == "project" or username):
+                    quotas.append(Quota(level, key, label, 0))
+        else:
+            quotas = self._quotas(None, None, None)
+            for group, limit in settings.token_group_daily_limits.items():
+                quotas.append(Quota("group", f"group:{group}", f"daily token quota for group {group}", limit))
+            project_ids = set(settings.token_project_daily_limits) | {
+                int(key.split(":")[1]) for key in summary.get("quota_tokens", {}) if key.startswith("project:")
+            }
+            for pid in sorted(project_ids):
+                limit = settings.token_project_daily_limits.get(pid, settings.token_default_project_daily_limit)
+                quotas.append(Quota("project", f"project:{pid}", f"daily token quota for project {pid}", limit))
+        
+        status = []
+        for quota in quotas:
+            used = self._quota_used(summary, quota)
+            reserved = self._quota_reserved(quota)
+            status.append({
+                "level": quota.level,
+                "key": quota.key,
+                "label": quota.label,
+                "limit": quota.limit or None,
+                "used": used,
+                "reserved": reserved,
+                "remaining": max(quota.limit - used - reserved, 0) if quota.limit else None
+            })
+        return status
+    
+    async def usage_history(
+        self,
+        start: date,
+        end: date,
+        granularity: str = "day",
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Usage totals per day or month, optionally for one project, user or model
+        
+        Args:
+            start: First day (inclusive)
+            end: Last day (inclusive)
+            granularity: 'day' or 'month'
+            project_id: Only this project
+            username: Only this user
+            model: Only this model
             
-            # Cleanup monthly logs (90 days or 1 year default)
-            log_cutoff = date.today() - timedelta(days=self.log_retention_days)
-            for file in self.token_logs_dir.glob("*.csv"):
-                try:
-                    # Extract date from filename (YYYY-MM.csv)
-                    # Use last day of that month for comparison
-                    year_month_str = file.stem
-                    year, month = map(int, year_month_str.split('-'))
-                    
-                    # Last day of the month
-                    if month == 12:
-                        file_date = date(year, month, 31)
-                    else:
-                        file_date = date(year, month + 1, 1) - timedelta(days=1)
-                    
-                    if file_date < log_cutoff:
-                        file.unlink()
-                        logs_deleted += 1
-                        logger.debug(f"Deleted old log: {file.name}")
-                except (ValueError, OSError) as e:
-                    logger.warning(f"Failed to process log file {file.name}: {e}")
+        Returns:
+            One dict per bucket with usage ('bucket' plus totals), oldest first
+        """
+        await self.flush()
+        return await asyncio.to_thread(
+            self.store.usage_history, start, end, granularity, project_id, username, model
+        )
+    
+    async def usage_breakdown(
+        self,
+        start: date,
+        end: date,
+        group_by: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Usage totals per project, user or model over a date range
+        
+        Args:
+            start: First day (inclusive)
+            end: Last day (inclusive)
+            group_by: 'project', 'user' or 'model'
+            project_id: Only this project
+            username: Only this user
+            model: Only this model
             
-            if summaries_deleted > 0 or logs_deleted > 0:
-                logger.info(
-                    f"Cleanup completed: {summaries_deleted} summaries, "
-                    f"{logs_deleted} logs deleted"
-                )
+        Returns:
+            One dict per group (group key plus totals), largest first
+        """
+        await self.flush()
+        return await asyncio.to_thread(
+            self.store.usage_breakdown, start, end, group_by, project_id, username, model
+        )
+    
+    async def export_csv(self, month: str) -> Optional[str]:
+        """
+        Monthly usage log in the Excel-friendly CSV format
+        
+        Args:
+            month: Month to export (YYYY-MM)
             
+        Returns:
+            CSV text, or None if the month has no usage
+        """
+        await self.flush()
+        return await asyncio.to_thread(self.store.export_csv, month)
+    
+    async def cleanup_old_files(self) -> Dict[str, int]:
+        """
+        Delete usage older than the retention period
+        
+        Returns:
+            {'summaries_deleted': N, 'logs_deleted': M}
+        """
+        # Daily summaries (90 days default), usage logs (1 year default)
+        summary_cutoff = date.today() - timedelta(days=self.summary_retention_days)
+        log_cutoff = date.today() - timedelta(days=self.log_retention_days)
+        
+        try:
+            deleted = await asyncio.to_thread(self.store.cleanup, summary_cutoff, log_cutoff)
+            if self.shared is not None:
+                await asyncio.to_thread(self.shared.cleanup, summary_cutoff.isoformat())
         except Exception as e:
             logger.error(f"Error during cleanup: {e}", exc_info=True)
+            return {"summaries_deleted": 0, "logs_deleted": 0}
         
-        return {
-            "summaries_deleted": summaries_deleted,
-            "logs_deleted": logs_deleted
-        }
+        if deleted["summaries_deleted"] > 0 or deleted["logs_deleted"] > 0:
+            logger.info(
+                f"Cleanup completed: {deleted['summaries_deleted']} summaries, "
+                f"{deleted['logs_deleted']} logs deleted"
+            )
+        return deleted
 
 
 # Global tracker instance
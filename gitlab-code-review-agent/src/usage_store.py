@@ -0,0 +1,860 @@
+# -*- coding: utf-8 -*-
+"""
+Token usage storage backends
+Where TokenTracker persists usage events and daily summaries (SQLite or CSV/JSON files)
+"""
+import io
+import csv
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+
+from src.config import settings
+from src.shared_state import enable_wal
+
+# Cross-process file locks (not available on Windows, where only one process is supported)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TokenUsage:
+    """Token usage for a single successful review request"""
+    project_id: int
+    project_name: str
+    mr_iid: int
+    username: str
+    input_tokens: int
+    output_tokens: int
+    total_tokens: int
+    model: str
+    duration_ms: int
+    estimated_input_tokens: int = 0  # Raw local estimate (for estimator calibration)
+    cache_creation_input_tokens: int = 0  # Prompt-cache writes (not in input_tokens)
+    cache_read_input_tokens: int = 0  # Prompt-cache reads (not in input_tokens)
+    time_to_first_token_ms: int = 0  # Streaming only: request sent to first text delta
+    output_tokens_per_second: float = 0.0  # Streaming only: output rate after the first token
+    pricing_tier: str = "standard"  # "batch" for Message Batches (billed at a discount)
+
+
+# (journal sequence number, UTC timestamp, usage)
+UsageEvent = Tuple[int, datetime, TokenUsage]
+
+USAGE_FIELDS = [f.name for f in fields(TokenUsage)]
+
+CSV_HEADER = [
+    'year', 'month', 'day', 'time',
+    'project_id', 'project_name', 'mr_iid', 'username',
+    'input_tokens', 'output_tokens', 'total_tokens',
+    'model', 'duration_ms', 'estimated_input_tokens',
+    'cache_creation_input_tokens', 'cache_read_input_tokens',
+    'time_to_first_token_ms', 'output_tokens_per_second', 'pricing_tier'
+]
+
+# Totals summed by usage queries
+TOTAL_COLUMNS = [
+    'total_tokens', 'input_tokens', 'output_tokens',
+    'cache_creation_input_tokens', 'cache_read_input_tokens'
+]
+
+# Usage breakdown dimensions (group_by value → usage column)
+GROUP_BY_COLUMNS = {"project": "project_id", "user": "username", "model": "model"}
+
+HISTORY_GRANULARITIES = ("day", "month")
+
+
+def _next_month(day: date) -> date:
+    """First day of the month after the given day"""
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def rollup_spans(start: date, end: date) -> List[Tuple[str, str, str]]:
+    """
+    Cover a date range (inclusive) with as few rollup buckets as possible
+
+    Whole months come from the monthly rollups; the days before the first and
+    after the last whole month come from the daily rollups.
+
+    Returns:
+        [(period, first bucket, last bucket), ...] with period 'day' or 'month'
+    """
+    first_month = start if start.day == 1 else _next_month(start)
+    after_months = (end + timedelta(days=1)).replace(day=1)
+    if first_month >= after_months:
+        return [("day", start.isoformat(), end.isoformat())]
+
+    spans = [("month", first_month.strftime('%Y-%m'), (after_months - timedelta(days=1)).strftime('%Y-%m'))]
+    if start < first_month:
+        spans.append(("day", start.isoformat(), (first_month - timedelta(days=1)).isoformat()))
+    if end >= after_months:
+        spans.append(("day", after_months.isoformat(), end.isoformat()))
+    return spans
+
+
+def csv_row(usage: TokenUsage, timestamp: datetime) -> List:
+    """One monthly CSV row (Excel-friendly: split date, time only)"""
+    return [
+        timestamp.year,
+        timestamp.month,
+        timestamp.day,
+        timestamp.strftime('%H:%M:%S'),  # Time only (HH:MM:SS)
+        usage.project_id,
+        usage.project_name,
+        usage.mr_iid,
+        usage.username,
+        usage.input_tokens,
+        usage.output_tokens,
+        usage.total_tokens,
+        usage.model,
+        usage.duration_ms,
+        usage.estimated_input_tokens,
+        usage.cache_creation_input_tokens,
+        usage.cache_read_input_tokens,
+        usage.time_to_first_token_ms,
+        round(usage.output_tokens_per_second, 1),
+        usage.pricing_tier
+    ]
+
+
+class UsageStore(ABC):
+    """
+    Storage backend interface for TokenTracker
+
+    Methods are synchronous; the tracker calls them from worker threads.
+    A backend missing one of them fails when it is constructed.
+    """
+
+    @abstractmethod
+    def write(self, events: List[UsageEvent], summaries: Dict[str, Dict]) -> None:
+        """Persist flushed usage events and the daily summaries they updated"""
+
+    @abstractmethod
+    def load_summary(self, day: str) -> Optional[Dict]:
+        """Daily summary for an ISO date, or None if there was no usage"""
+
+    @abstractmethod
+    def latest_journal_seq(self) -> int:
+        """Highest journal sequence number persisted so far"""
+
+    @abstractmethod
+    def query_totals(
+        self,
+        start: date,
+        end: date,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> Dict[str, int]:
+        """
+        Sum usage over a date range (inclusive), optionally for one project, user or model
+
+        Returns:
+            {'total_tokens': ..., 'input_tokens': ..., ..., 'request_count': N}
+        """
+
+    @abstractmethod
+    def usage_history(
+        self,
+        start: date,
+        end: date,
+        granularity: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Usage totals per day or month over a date range (inclusive)
+
+        Returns:
+            [{'bucket': 'YYYY-MM-DD' or 'YYYY-MM', 'total_tokens': ..., 'request_count': N}, ...]
+            in bucket order, only buckets with usage
+        """
+
+    @abstractmethod
+    def usage_breakdown(
+        self,
+        start: date,
+        end: date,
+        group_by: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Usage totals per project, user or model over a date range (inclusive)
+
+        Returns:
+            [{'project_id'/'username'/'model': ..., 'total_tokens': ..., 'request_count': N}, ...]
+            largest first (project groups also carry 'project_name')
+        """
+
+    @abstractmethod
+    def export_csv(self, month: str) -> Optional[str]:
+        """Monthly CSV log (YYYY-MM) as text, or None if the month has no usage"""
+
+    @abstractmethod
+    def cleanup(self, summary_cutoff: date, log_cutoff: date) -> Dict[str, int]:
+        """
+        Delete summaries and usage older than the cutoffs
+
+        Returns:
+            {'summaries_deleted': N, 'logs_deleted': M}
+        """
+
+
+class FileUsageStore(UsageStore):
+    """
+    Monthly CSV logs plus one JSON summary per day
+
+    File format: token-logs/YYYY-MM.csv, daily-summaries/YYYY-MM-DD.json.
+    Range queries scan the CSV files.
+    """
+
+    def __init__(self, data_dir: Path):
+        self.daily_summaries_dir = data_dir / "daily-summaries"
+        self.token_logs_dir = data_dir / "token-logs"
+        self.daily_summaries_dir.mkdir(parents=True, exist_ok=True)
+        self.token_logs_dir.mkdir(parents=True, exist_ok=True)
+        self._current_logs = set()  # Logs known to have the current CSV_HEADER
+        self.migrate_csv_headers()
+
+    def write(self, events: List[UsageEvent], summaries: Dict[str, Dict]) -> None:
+        self.append_csv(events)
+        for summary in summaries.values():
+            self._write_summary(summary)
+
+    def append_csv(self, events: List[UsageEvent]) -> None:
+        """Append usage rows to their monthly CSV logs (created with headers)"""
+        by_month: Dict[Path, List[List]] = {}
+        for _, timestamp, usage in events:
+            by_month.setdefault(self._csv_path(timestamp.strftime('%Y-%m')), []).append(csv_row(usage, timestamp))
+
+        # Locked across processes so two can't both create a log (duplicate header) or interleave rows
+        with self._csv_lock():
+            for csv_path, rows in by_month.items():
+                if not csv_path.exists():
+                    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+                        csv.writer(f).writerow(CSV_HEADER)
+                    logger.info(f"Created new monthly log: {csv_path.name}")
+                elif csv_path not in self._current_logs:
+                    self._migrate_header(csv_path)
+                self._current_logs.add(csv_path)
+                with open(csv_path, 'a', newline='', encoding='utf-8') as f:
+                    csv.writer(f).writerows(rows)
+
+    def migrate_csv_headers(self) -> None:
+        """Bring every monthly log up to the current CSV_HEADER (logs written before columns were added)"""
+        with self._csv_lock():
+            for csv_path in sorted(self.token_logs_dir.glob("*.csv")):
+                try:
+                    self._migrate_header(csv_path)
+                except (OSError, csv.Error) as e:
+                    logger.error(f"Failed to migrate the header of {csv_path.name}: {e}")
+                    continue
+                self._current_logs.add(csv_path)
+
+    def _migrate_header(self, csv_path: Path) -> None:
+        """
+        Rewrite a log whose header differs from CSV_HEADER, keeping every value
+
+        Columns were only ever appended, so rows longer than the old header
+        (appended after an upgrade) are read with the current layout. The
+        caller holds the CSV lock.
+        """
+        with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header == CSV_HEADER:
+                return
+            rows = list(reader)
+
+        header = header or CSV_HEADER
+        migrated = []
+        for row in rows:
+            names = CSV_HEADER if len(row) > len(header) else header
+            values = dict(zip(names, row))
+            migrated.append([values.get(column, "") for column in CSV_HEADER])
+
+        temp_path = csv_path.with_suffix('.tmp')
+        with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(migrated)
+        temp_path.replace(csv_path)
+        logger.info(f"Migrated {csv_path.name} to the current CSV header ({len(migrated)} rows)")
+
+    @contextmanager
+    def _csv_lock(self) -> Iterator[None]:
+        """Exclusive lock on the CSV logs shared by every process using this data directory"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.token_logs_dir / ".lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_summary(self, day: str) -> Optional[Dict]:
+        summary_path = self.daily_summaries_dir / f"{day}.json"
+        if not summary_path.exists():
+            return None
+        with open(summary_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def latest_journal_seq(self) -> int:
+        # Sequence numbers only grow, so the newest summary has the highest
+        summary_files = sorted(self.daily_summaries_dir.glob("*.json"))
+        if not summary_files:
+            return 0
+        try:
+            with open(summary_files[-1], 'r', encoding='utf-8') as f:
+                return json.load(f).get("journal_seq", 0)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read {summary_files[-1].name}: {e}")
+            return 0
+
+    def query_totals(
+        self,
+        start: date,
+        end: date,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> Dict[str, int]:
+        totals = self._empty_totals()
+        for _, row in self._matching_rows(start, end, project_id, username, model):
+            self._add_row(totals, row)
+        return totals
+
+    def usage_history(
+        self,
+        start: date,
+        end: date,
+        granularity: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        # No rollups in this backend: scans the CSV logs
+        bucket_format = '%Y-%m-%d' if granularity == "day" else '%Y-%m'
+        buckets: Dict[str, Dict] = {}
+        for timestamp, row in self._matching_rows(start, end, project_id, username, model):
+            bucket = timestamp.strftime(bucket_format)
+            self._add_row(buckets.setdefault(bucket, {"bucket": bucket, **self._empty_totals()}), row)
+        return [buckets[bucket] for bucket in sorted(buckets)]
+
+    def usage_breakdown(
+        self,
+        start: date,
+        end: date,
+        group_by: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        column = GROUP_BY_COLUMNS[group_by]
+        groups: Dict[str, Dict] = {}
+        for _, row in self._matching_rows(start, end, project_id, username, model):
+            key = int(row[column]) if column == "project_id" else row[column]
+            group = groups.setdefault(key, {column: key, **self._empty_totals()})
+            if column == "project_id":
+                group["project_name"] = row["project_name"]
+            self._add_row(group, row)
+        return sorted(groups.values(), key=lambda group: group["total_tokens"], reverse=True)
+
+    def _matching_rows(
+        self,
+        start: date,
+        end: date,
+        project_id: Optional[int],
+        username: Optional[str],
+        model: Optional[str]
+    ) -> Iterator[Tuple[datetime, Dict]]:
+        for timestamp, row in self.iter_csv_rows(start, end):
+            if project_id is not None and int(row["project_id"]) != project_id:
+                continue
+            if username is not None and row["username"] != username:
+                continue
+            if model is not None and row["model"] != model:
+                continue
+            yield timestamp, row
+
+    @staticmethod
+    def _empty_totals() -> Dict[str, int]:
+        return {**dict.fromkeys(TOTAL_COLUMNS, 0), "request_count": 0}
+
+    @staticmethod
+    def _add_row(totals: Dict, row: Dict) -> None:
+        for column in TOTAL_COLUMNS:
+            totals[column] += int(row.get(column) or 0)
+        totals["request_count"] += 1
+
+    def iter_csv_rows(self, start: date, end: date) -> Iterator[Tuple[datetime, Dict]]:
+        """Rows of the monthly CSV logs within a date range (inclusive)"""
+        for csv_path in sorted(self.token_logs_dir.glob("*.csv")):
+            if not (start.strftime('%Y-%m') <= csv_path.stem <= end.strftime('%Y-%m')):
+                continue
+            with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        timestamp = datetime.strptime(
+                            f"{row['year']}-{row['month']}-{row['day']} {row['time']}", "%Y-%m-%d %H:%M:%S"
+                        )
+                    except (KeyError, ValueError):
+                        continue
+                    if start <= timestamp.date() <= end:
+                        yield timestamp, row
+
+    def export_csv(self, month: str) -> Optional[str]:
+        csv_path = self._csv_path(month)
+        if not csv_path.exists():
+            return None
+        return csv_path.read_text(encoding='utf-8')
+
+    def cleanup(self, summary_cutoff: date, log_cutoff: date) -> Dict[str, int]:
+        summaries_deleted = 0
+        logs_deleted = 0
+
+        for file in self.daily_summaries_dir.glob("*.json"):
+            try:
+                # Extract date from filename (YYYY-MM-DD.json)
+                if date.fromisoformat(file.stem) < summary_cutoff:
+                    file.unlink()
+                    summaries_deleted += 1
+                    logger.debug(f"Deleted old summary: {file.name}")
+            except (ValueError, OSError) as e:
+                logger.warning(f"Failed to process summary file {file.name}: {e}")
+
+        for file in self.token_logs_dir.glob("*.csv"):
+            try:
+                # Extract date from filename (YYYY-MM.csv), compare the month's last day
+                year, month = map(int, file.stem.split('-'))
+                if month == 12:
+                    file_date = date(year, month, 31)
+                else:
+                    file_date = date(year, month + 1, 1) - timedelta(days=1)
+
+                if file_date < log_cutoff:
+                    file.unlink()
+                    logs_deleted += 1
+                    logger.debug(f"Deleted old log: {file.name}")
+            except (ValueError, OSError) as e:
+                logger.warning(f"Failed to process log file {file.name}: {e}")
+
+        return {"summaries_deleted": summaries_deleted, "logs_deleted": logs_deleted}
+
+    def _csv_path(self, month: str) -> Path:
+        """Path to a monthly CSV file (YYYY-MM.csv)"""
+        return self.token_logs_dir / f"{month}.csv"
+
+    def _write_summary(self, summary: Dict) -> None:
+        """Write a daily summary JSON (atomic: temp file + rename)"""
+        summary_path = self.daily_summaries_dir / f"{summary['date']}.json"
+        temp_path = summary_path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        try:
+            temp_path.replace(summary_path)
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+
+class SQLiteUsageStore(UsageStore):
+    """
+    Usage events and daily summaries in SQLite (WAL mode)
+
+    Features:
+    - One row per usage event, indexed on (day, project_id), (day, username)
+      and model, so per-project/per-user range queries don't scan everything
+    - Each flush is one transaction; events are keyed on their journal
+      sequence number, so a replayed event is never stored twice
+    - Daily and monthly rollups per (project, user, model) are updated in
+      the same transaction, so history/breakdown queries read one row per
+      bucket and group instead of every usage event
+    - Monthly CSV logs are kept as a derived view (appended after each
+      commit, regenerated on demand by export_csv)
+    - Existing CSV logs and summaries are imported on first start
+    """
+
+    def __init__(self, db_path: Path, data_dir: Path):
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.files = FileUsageStore(data_dir)
+
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._db_lock = threading.Lock()
+        self._init_schema()
+        self._import_files()
+        self._backfill_rollups()
+
+    def _init_schema(self) -> None:
+        with self._db_lock:
+            enable_wal(self._conn)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    seq INTEGER UNIQUE,
+                    timestamp TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    project_id INTEGER NOT NULL,
+                    project_name TEXT NOT NULL,
+                    mr_iid INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    total_tokens INTEGER NOT NULL,
+                    model TEXT NOT NULL,
+                    duration_ms INTEGER NOT NULL,
+                    estimated_input_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_creation_input_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_read_input_tokens INTEGER NOT NULL DEFAULT 0,
+                    time_to_first_token_ms INTEGER NOT NULL DEFAULT 0,
+                    output_tokens_per_second REAL NOT NULL DEFAULT 0,
+                    pricing_tier TEXT NOT NULL DEFAULT 'standard'
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_usage_day_project ON usage_events (day, project_id)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_usage_day_username ON usage_events (day, username)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_model ON usage_events (model)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollups (
+                    period TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    project_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    project_name TEXT NOT NULL,
+                    total_tokens INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_creation_input_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_read_input_tokens INTEGER NOT NULL DEFAULT 0,
+                    request_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (period, bucket, project_id, username, model)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_summaries (
+                    day TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL
+                )
+            """)
+
+    def write(self, events: List[UsageEvent], summaries: Dict[str, Dict]) -> None:
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = self._insert_events(events)
+                self._conn.executemany(
+                    "INSERT INTO daily_summaries (day, summary) VALUES (?, ?) "
+                    "ON CONFLICT (day) DO UPDATE SET summary = excluded.summary",
+                    [(day, json.dumps(summary)) for day, summary in summaries.items()]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        # Derived CSV view; a crash here loses rows from the file only (export_csv rebuilds it)
+        try:
+            self.files.append_csv([event for event in events if event[0] in inserted])
+        except OSError as e:
+            logger.error(f"Failed to append usage to the CSV log: {e}")
+
+    def load_summary(self, day: str) -> Optional[Dict]:
+        row = self._fetchone("SELECT summary FROM daily_summaries WHERE day = ?", (day,))
+        return json.loads(row["summary"]) if row else None
+
+    def latest_journal_seq(self) -> int:
+        # Summaries too: cleanup may have deleted every event
+        row = self._fetchone("SELECT MAX(seq) AS seq FROM usage_events", ())
+        summary = self._fetchone("SELECT summary FROM daily_summaries ORDER BY day DESC LIMIT 1", ())
+        summary_seq = json.loads(summary["summary"]).get("journal_seq", 0) if summary else 0
+        return max(row["seq"] or 0, summary_seq)
+
+    def query_totals(
+        self,
+        start: date,
+        end: date,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> Dict[str, int]:
+        sql = (
+            "SELECT " + ", ".join(f"COALESCE(SUM({column}), 0) AS {column}" for column in TOTAL_COLUMNS)
+            + ", COUNT(*) AS request_count FROM usage_events WHERE day BETWEEN ? AND ?"
+        )
+        params: List = [start.isoformat(), end.isoformat()]
+        if project_id is not None:
+            sql += " AND project_id = ?"
+            params.append(project_id)
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        if model is not None:
+            sql += " AND model = ?"
+            params.append(model)
+        return dict(self._fetchone(sql, tuple(params)))
+
+    def usage_history(
+        self,
+        start: date,
+        end: date,
+        granularity: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        if granularity == "day":
+            spans, bucket = [("day", start.isoformat(), end.isoformat())], "bucket"
+        else:
+            # Partial months at either end are summed from their daily rollups
+            spans, bucket = rollup_spans(start, end), "substr(bucket, 1, 7)"
+        rows = self._query_rollups(
+            f"{bucket} AS bucket", bucket, "bucket", spans, project_id, username, model
+        )
+        return [dict(row) for row in rows]
+
+    def usage_breakdown(
+        self,
+        start: date,
+        end: date,
+        group_by: str,
+        project_id: Optional[int] = None,
+        username: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> List[Dict]:
+        column = GROUP_BY_COLUMNS[group_by]
+        select = f"{column}, MAX(project_name) AS project_name" if column == "project_id" else column
+        rows = self._query_rollups(
+            select, column, "total_tokens DESC", rollup_spans(start, end), project_id, username, model
+        )
+        return [dict(row) for row in rows]
+
+    def _query_rollups(
+        self,
+        select: str,
+        group_by: str,
+        order_by: str,
+        spans: List[Tuple[str, str, str]],
+        project_id: Optional[int],
+        username: Optional[str],
+        model: Optional[str]
+    ) -> list:
+        """Sum rollup rows within the spans, grouped (select/group_by/order_by are trusted SQL)"""
+        sql = (
+            f"SELECT {select}, "
+            + ", ".join(f"SUM({column}) AS {column}" for column in TOTAL_COLUMNS + ["request_count"])
+            + " FROM usage_rollups WHERE ("
+            + " OR ".join("(period = ? AND bucket BETWEEN ? AND ?)" for _ in spans)
+            + ")"
+        )
+        params: List = [value for span in spans for value in span]
+        if project_id is not None:
+            sql += " AND project_id = ?"
+            params.append(project_id)
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        if model is not None:
+            sql += " AND model = ?"
+            params.append(model)
+        sql += f" GROUP BY {group_by} ORDER BY {order_by}"
+        return self._fetchall(sql, tuple(params))
+
+    def export_csv(self, month: str) -> Optional[str]:
+        """Regenerate a monthly CSV log from the database"""
+        rows = self._fetchall(
+            "SELECT * FROM usage_events WHERE day LIKE ? ORDER BY timestamp, id", (f"{month}-%",)
+        )
+        if not rows:
+            return None
+
+        lines = [CSV_HEADER]
+        for row in rows:
+            usage = TokenUsage(**{name: row[name] for name in USAGE_FIELDS})
+            lines.append(csv_row(usage, datetime.fromisoformat(row["timestamp"])))
+
+        output = io.StringIO()
+        csv.writer(output).writerows(lines)
+        return output.getvalue()
+
+    def cleanup(self, summary_cutoff: date, log_cutoff: date) -> Dict[str, int]:
+        with self._db_lock:
+            summaries_deleted = self._conn.execute(
+                "DELETE FROM daily_summaries WHERE day < ?", (summary_cutoff.isoformat(),)
+            ).rowcount
+            events_deleted = self._conn.execute(
+                "DELETE FROM usage_events WHERE day < ?", (log_cutoff.isoformat(),)
+            ).rowcount
+            # Monthly rollups are kept (a few rows per month) for long-range history
+            self._conn.execute(
+                "DELETE FROM usage_rollups WHERE period = 'day' AND bucket < ?", (log_cutoff.isoformat(),)
+            )
+        if events_deleted:
+            logger.info(f"Deleted {events_deleted:,} usage events older than {log_cutoff}")
+
+        deleted = self.files.cleanup(summary_cutoff, log_cutoff)
+        deleted["summaries_deleted"] += summaries_deleted
+        return deleted
+
+    def _insert_events(self, events: List[UsageEvent]) -> set:
+        """
+        Insert events not stored yet and add them to their rollups
+
+        The caller holds the lock and a transaction.
+
+        Returns:
+            Journal sequence numbers of the inserted events
+        """
+        inserted = set()
+        columns = ["seq", "timestamp", "day"] + USAGE_FIELDS
+        sql = (
+            f"INSERT OR IGNORE INTO usage_events ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})"
+        )
+        for seq, timestamp, usage in events:
+            values = asdict(usage)
+            day = timestamp.date().isoformat()
+            cursor = self._conn.execute(
+                sql,
+                [seq, timestamp.isoformat(), day] + [values[name] for name in USAGE_FIELDS]
+            )
+            if cursor.rowcount:
+                inserted.add(seq)
+                for period, bucket in (("day", day), ("month", day[:7])):
+                    self._add_to_rollup(period, bucket, usage)
+        return inserted
+
+    def _add_to_rollup(self, period: str, bucket: str, usage: TokenUsage) -> None:
+        totals = [getattr(usage, column) for column in TOTAL_COLUMNS]
+        self._conn.execute(
+            "INSERT INTO usage_rollups (period, bucket, project_id, username, model, project_name, "
+            + ", ".join(TOTAL_COLUMNS) + ", request_count) "
+            f"VALUES (?, ?, ?, ?, ?, ?, {', '.join('?' * len(TOTAL_COLUMNS))}, 1) "
+            "ON CONFLICT (period, bucket, project_id, username, model) DO UPDATE SET "
+            "project_name = excluded.project_name, "
+            + ", ".join(f"{column} = {column} + excluded.{column}" for column in TOTAL_COLUMNS)
+            + ", request_count = request_count + 1",
+            [period, bucket, usage.project_id, usage.username, usage.model, usage.project_name] + totals
+        )
+
+    def _backfill_rollups(self) -> None:
+        """Build the rollups from stored events (databases created before rollups existed)"""
+        if self._fetchone("SELECT 1 FROM usage_rollups LIMIT 1", ()) is not None:
+            return
+        if self._fetchone("SELECT 1 FROM usage_events LIMIT 1", ()) is None:
+            return
+
+        sums = ", ".join(f"SUM({column})" for column in TOTAL_COLUMNS)
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM usage_rollups LIMIT 1").fetchone() is not None:
+                    # Built by another process starting at the same time
+                    self._conn.execute("COMMIT")
+                    return
+                for period, bucket in (("day", "day"), ("month", "substr(day, 1, 7)")):
+                    self._conn.execute(
+                        "INSERT INTO usage_rollups (period, bucket, project_id, username, model, project_name, "
+                        + ", ".join(TOTAL_COLUMNS) + ", request_count) "
+                        f"SELECT '{period}', {bucket}, project_id, username, model, MAX(project_name), "
+                        f"{sums}, COUNT(*) FROM usage_events "
+                        f"GROUP BY {bucket}, project_id, username, model"
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info("Built usage rollups from stored usage events")
+
+    def _import_files(self) -> None:
+        """One-time import of the CSV logs and JSON summaries written by FileUsageStore"""
+        if self._fetchone("SELECT 1 FROM usage_events LIMIT 1", ()) is not None:
+            return
+        if self._fetchone("SELECT 1 FROM daily_summaries LIMIT 1", ()) is not None:
+            return
+
+        events = []
+        for timestamp, row in self.files.iter_csv_rows(date.min, date.max):
+            try:
+                usage = TokenUsage(**{
+                    name: field.type(row[name]) if row.get(name) not in (None, "") else field.default
+                    for name, field in ((f.name, f) for f in fields(TokenUsage))
+                })
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Skipping unreadable CSV usage row: {e}")
+                continue
+            events.append((None, timestamp, usage))
+
+        summaries = {}
+        for summary_path in self.files.daily_summaries_dir.glob("*.json"):
+            try:
+                with open(summary_path, 'r', encoding='utf-8') as f:
+                    summaries[summary_path.stem] = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable summary {summary_path.name}: {e}")
+
+        if not events and not summaries:
+            return
+
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if (self._conn.execute("SELECT 1 FROM usage_events LIMIT 1").fetchone() is not None
+                        or self._conn.execute("SELECT 1 FROM daily_summaries LIMIT 1").fetchone() is not None):
+                    # Imported by another process starting at the same time
+                    self._conn.execute("COMMIT")
+                    return
+                self._insert_events(events)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO daily_summaries (day, summary) VALUES (?, ?)",
+                    [(day, json.dumps(summary)) for day, summary in summaries.items()]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Imported {len(events):,} usage rows and {len(summaries)} daily summaries into {self.db_path}")
+
+    def _fetchone(self, sql: str, params: tuple) -> Optional[sqlite3.Row]:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+
+def create_usage_store(data_dir: Path) -> UsageStore:
+    """Usage store selected by TOKEN_STORE_BACKEND ('sqlite' or 'files')"""
+    backend = settings.token_store_backend.lower()
+    if backend == "files":
+        return FileUsageStore(data_dir)
+    if backend == "sqlite":
+        return SQLiteUsageStore(Path(settings.token_db_path or data_dir / "usage.db"), data_dir)
+    raise ValueError(f"Unknown TOKEN_STORE_BACKEND: {settings.token_store_backend!r}")
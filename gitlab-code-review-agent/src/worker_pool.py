@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Review worker pool
+Drains the durable review queue with a fixed number of concurrent workers
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from src.config import settings
+from src.review_queue import ReviewQueue, ReviewJob
+from src.exceptions import ReviewDeferred
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewWorkerPool:
+    """
+    Fixed-size pool of asyncio workers processing queued review jobs
+
+    The pool size is the global review concurrency; which project each free
+    worker serves is decided by the queue's FairScheduler.
+
+    A job is removed from the queue only after its handler returns, so a
+    crash or shutdown mid-review leaves it to be recovered on next startup.
+
+    An in-flight review is cancelled when a newer head SHA arrives for the
+    same merge request; the coalesced pending job then reviews the new head.
+    A Claude request it already sent is billed, so the reviewer lets that
+    request finish and records its usage before discarding the result.
+
+    A handler raising ReviewDeferred (e.g. rate limited) puts its job back in
+    the queue to run once the wait is over.
+
+    With several worker processes sharing the queue, a heartbeat renews the
+    leases of this process's running jobs, cancels those superseded by
+    events another process received, and recovers jobs of dead processes.
+    """
+
+    def __init__(
+        self,
+        queue: ReviewQueue,
+        handler: Callable[[ReviewJob], Awaitable[None]],
+        worker_count: int = None
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.worker_count = worker_count or settings.review_worker_count
+        self._poll_interval = 5.0  # Safety net in case a wake-up is missed
+        self._tasks: List[asyncio.Task] = []
+
+        # In-flight reviews keyed on (project_id, mr_iid)
+        self._running: Dict[Tuple[int, int], Tuple[ReviewJob, asyncio.Task]] = {}
+        self._superseded: Set[int] = set()
+
+    async def start(self) -> None:
+        """Recover interrupted jobs and start the workers"""
+        await self.queue.recover()
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"review-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        if self.queue.shared:
+            self._tasks.append(asyncio.create_task(self._heartbeat(), name="review-heartbeat"))
+        logger.info(f"Started {self.worker_count} review workers")
+
+    async def stop(self) -> None:
+        """Stop all workers (in-flight jobs are recovered on next startup)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Stopped review workers")
+
+    async def is_reviewing(self, project_id: int, mr_iid: int, head_sha: Optional[str]) -> bool:
+        """Check whether this exact MR head is already being reviewed (by any process)"""
+        entry = self._running.get((project_id, mr_iid))
+        if entry is not None and head_sha is not None and entry[0].head_sha == head_sha:
+            return True
+        return self.queue.shared and await self.queue.is_running(project_id, mr_iid, head_sha)
+
+    def supersede(self, project_id: int, mr_iid: int, head_sha: Optional[str]) -> bool:
+        """
+        Cancel the in-flight review of an MR if a newer head SHA has arrived
+
+        Args:
+            project_id: GitLab project ID
+            mr_iid: Merge request IID
+            head_sha: Head SHA from the newest event
+
+        Returns:
+            True if an in-flight review was cancelled
+        """
+        entry = self._running.get((project_id, mr_iid))
+        if entry is None or head_sha is None:
+            return False
+
+        job, task = entry
+        if job.head_sha == head_sha:
+            return False
+
+        self._superseded.add(job.id)
+        task.cancel()
+        logger.info(
+            f"Cancelling review job {job.id} for MR {mr_iid}: "
+            f"head moved {(job.head_sha or 'unknown')[:8]} → {head_sha[:8]}"
+        )
+        return True
+
+    async def _heartbeat(self) -> None:
+        """Renew leases, cancel superseded reviews and recover orphaned jobs (several processes)"""
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                jobs = [job for job, _ in self._running.values()]
+                await self.queue.renew([job.id for job in jobs])
+                for (project_id, mr_iid), head_sha in (await self.queue.pending_heads(jobs)).items():
+                    self.supersede(project_id, mr_iid, head_sha)
+                await self.queue.recover()
+            except Exception as e:
+                logger.error(f"Review job heartbeat failed: {e}", exc_info=True)
+
+    async def _worker(self, worker_id: int) -> None:
+        """Claim and process jobs until cancelled"""
+        while True:
+            try:
+                job = await self.queue.claim()
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed to claim job: {e}", exc_info=True)
+                await asyncio.sleep(self._poll_interval)
+                continue
+
+            if job is None:
+                await self.queue.wait_for_job(self._poll_interval)
+                continue
+
+            logger.info(f"Worker {worker_id} processing job {job.id} (MR {job.mr_iid}, attempt {job.attempts})")
+            key = (job.project_id, job.mr_iid)
+            task = asyncio.create_task(self.handler(job))
+            self._running[key] = (job, task)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if job.id not in self._superseded:
+                    # The worker itself is being stopped
+                    task.cancel()
+                    raise
+                logger.info(f"Review job {job.id} superseded by a newer push to MR {job.mr_iid}")
+            except ReviewDeferred as e:
+                logger.info(f"Review job {job.id} deferred: {e}")
+                await self.queue.defer(job, e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Review job {job.id} raised: {e}", exc_info=True)
+                await self.queue.fail(job, str(e))
+                continue
+            finally:
+                if self._running.get(key, (None, None))[0] is job:
+                    del self._running[key]
+                self._superseded.discard(job.id)
+
+            await self.queue.complete(job)
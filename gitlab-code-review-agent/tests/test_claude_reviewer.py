@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+ClaudeReviewer request tests
+Requests go to a stubbed Messages API (httpx.MockTransport) so their bodies can be inspected
+"""
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+_data_dir = tempfile.mkdtemp()
+for _name, _value in {
+    "GITLAB_URL": "http://gitlab.test",
+    "GITLAB_TOKEN": "test",
+    "ANTHROPIC_API_KEY": "test",
+    "TOKEN_DATA_DIR": os.path.join(_data_dir, "tokens"),
+    "REVIEW_QUEUE_DB_PATH": os.path.join(_data_dir, "queue", "review-queue.db")
+}.items():
+    os.environ.setdefault(_name, _value)
+
+import httpx
+
+from src.config import settings
+from src.claude_reviewer import reviewer, REVIEW_SYSTEM_PROMPT
+from src.diff_chunker import DiffChunk
+from src.exceptions import ReviewDeferred
+from src.token_tracker import tracker
+
+
+class PromptCachingTest(unittest.IsolatedAsyncioTestCase):
+    """Placement of the cache_control breakpoint in Messages API requests"""
+
+    async def asyncSetUp(self):
+        self.requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(json.loads(request.content))
+            return httpx.Response(200, json={
+                "content": [{"type": "text", "text": "Looks good."}],
+                "usage": {"input_tokens": 100, "output_tokens": 20}
+            })
+
+        reviewer._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await reviewer.close()
+
+    async def _review(self):
+        with mock.patch.object(settings, "token_budget_enabled", False):
+            await reviewer.review_code("+new = 2", "Add x", "", 7, "team/app", 1, "alice")
+        self.assertEqual(len(self.requests), 1)
+        return self.requests[0]
+
+    async def test_breakpoint_on_system_prompt_when_enabled(self):
+        with mock.patch.object(settings, "anthropic_prompt_caching", True):
+            payload = await self._review()
+
+        self.assertEqual(payload["system"], [
+            {"type": "text", "text": REVIEW_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+        ])
+        # Per-MR content stays after the breakpoint, uncached
+        self.assertEqual(len(payload["messages"]), 1)
+        self.assertIsInstance(payload["messages"][0]["content"], str)
+        self.assertIn("+new = 2", payload["messages"][0]["content"])
+
+    async def test_no_breakpoint_when_disabled(self):
+        with mock.patch.object(settings, "anthropic_prompt_caching", False):
+            payload = await self._review()
+
+        self.assertEqual(payload["system"], [{"type": "text", "text": REVIEW_SYSTEM_PROMPT}])
+        self.assertNotIn("cache_control", json.dumps(payload))
+
+    def test_disabled_by_default(self):
+        # The built-in instructions are below Anthropic's 1024-token cache minimum
+        self.assertFalse(type(settings).model_fields["anthropic_prompt_caching"].default)
+
+
+class CancelledReviewTest(unittest.IsolatedAsyncioTestCase):
+    """A cancelled review (superseded by a newer push) still records the request it sent"""
+
+    async def asyncSetUp(self):
+        self.received = asyncio.Event()
+        self.respond = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            self.received.set()
+            await self.respond.wait()
+            return httpx.Response(200, json={
+                "content": [{"type": "text", "text": "Looks good."}],
+                "usage": {"input_tokens": 100, "output_tokens": 20}
+            })
+
+        reviewer._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await reviewer.close()
+
+    async def test_usage_recorded_after_cancel(self):
+        with mock.patch.object(tracker, "commit", new=mock.AsyncMock()) as commit:
+            review = asyncio.create_task(
+                reviewer.review_code("+new = 2", "Add x", "", 7, "team/app", 1, "alice")
+            )
+            await self.received.wait()
+            review.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await review
+
+            # The request is still in flight; its usage is committed once it completes
+            commit.assert_not_awaited()
+            self.respond.set()
+            await reviewer.close()
+
+        commit.assert_awaited_once()
+        usage = commit.await_args.args[1]
+        self.assertEqual((usage.input_tokens, usage.output_tokens), (100, 20))
+        self.assertFalse(reviewer._abandoned)
+
+
+class ChunkedReviewTest(unittest.IsolatedAsyncioTestCase):
+    """Which chunk errors make a partial review and which fail the whole review"""
+
+    CHUNKS = [DiffChunk(f"+line {i}", [f"src/f{i}.py"]) for i in range(3)]
+
+    async def _review_chunks(self, failure: BaseException):
+        async def review_code(diff, *args, **kwargs):
+            if diff == "+line 1":
+                raise failure
+            return f"Review of {diff}"
+
+        with mock.patch.object(reviewer, "review_code", new=review_code), \
+                mock.patch.object(reviewer, "_send_prompt", new=mock.AsyncMock(return_value="Merged")):
+            return await reviewer.review_chunks(self.CHUNKS, "Add x", "", 7, "team/app", 1, "alice")
+
+    async def test_api_error_gives_partial_review(self):
+        request = httpx.Request("POST", "http://anthropic.test/v1/messages")
+        error = httpx.HTTPStatusError("overloaded", request=request, response=httpx.Response(529, request=request))
+
+        review, complete = await self._review_chunks(error)
+
+        self.assertFalse(complete)
+        self.assertIn("Partial review", review)
+        self.assertIn("`src/f1.py`", review)
+
+    async def test_deferred_chunk_defers_the_review(self):
+        with self.assertRaises(ReviewDeferred):
+            await self._review_chunks(ReviewDeferred(60, "token budget held by reviews in progress"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Generated-file detection tests
+"""
+import os
+import tempfile
+import unittest
+
+_data_dir = tempfile.mkdtemp()
+for _name, _value in {
+    "GITLAB_URL": "http://gitlab.test",
+    "GITLAB_TOKEN": "test",
+    "ANTHROPIC_API_KEY": "test",
+    "TOKEN_DATA_DIR": os.path.join(_data_dir, "tokens"),
+    "REVIEW_QUEUE_DB_PATH": os.path.join(_data_dir, "queue", "review-queue.db")
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from src.diff_filter import DiffFilter
+
+
+def _new_file(*lines):
+    """Diff of a new file with the given lines"""
+    return {
+        "new_path": "src/module.py",
+        "diff": f"@@ -0,0 +1,{len(lines)} @@\n" + "\n".join(f"+{line}" for line in lines) + "\n"
+    }
+
+
+class GeneratedMarkerTest(unittest.TestCase):
+    """Only tool-written header comments mark a file as generated"""
+
+    def setUp(self):
+        self.filter = DiffFilter(exclude=[], project_exclude={}, detect_generated=True)
+
+    def test_header_comments_are_generated(self):
+        for header in (
+            "// Code generated by protoc-gen-go. DO NOT EDIT.",
+            "# @generated by pip-compile",
+            "/* @generated */",
+            " * @generated SignedSource<<abc>>"
+        ):
+            with self.subTest(header=header):
+                reason = self.filter.check(_new_file(header, "x = 1"))
+                self.assertIsNotNone(reason)
+                self.assertTrue(reason.startswith("generated"), reason)
+
+    def test_prose_is_not_generated(self):
+        for line in (
+            "# Do not edit the config below by hand",
+            '"""Helpers for auto-generated reports"""',
+            "message = 'DO NOT EDIT'",
+            "# Code generated by hand, feel free to edit",
+            "// @Generated is not the marker"
+        ):
+            with self.subTest(line=line):
+                self.assertIsNone(self.filter.check(_new_file(line, "x = 1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
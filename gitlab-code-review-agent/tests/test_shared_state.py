@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process tests for SHARED_STATE_BACKEND=sqlite
+Several processes share one queue database; budgets, rate limits and dedup must hold across all of them
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+PROCESSES = 4
+
+
+def _configure(env):
+    """Apply the test settings in a child process (before src is imported)"""
+    os.environ.update(env)
+    os.chdir(PROJECT_ROOT)
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+
+def _budget_worker(env, start, results, attempts):
+    _configure(env)
+    from src.token_tracker import tracker
+    from src.usage_store import TokenUsage
+    from src.exceptions import ReviewDeferred
+
+    async def reserve():
+        while True:
+            try:
+                return (await tracker.reserve(1000, 7, "team/app", "alice"))[0]
+            except ReviewDeferred:
+                # Another process holds the rest of the budget; see whether it commits or releases it
+                await asyncio.sleep(0.01)
+
+    async def run():
+        granted = 0
+        start.wait()
+        for _ in range(attempts):
+            reservation = await reserve()
+            if reservation is not None:
+                granted += 1
+                await tracker.commit(reservation, TokenUsage(7, "team/app", 1, "alice", 600, 400, 1000, "m", 10))
+        await tracker.close()
+        return granted
+
+    results.put(asyncio.run(run()))
+
+
+def _rate_worker(env, start, results, attempts):
+    _configure(env)
+    from src.rate_limiter import rate_limiter, review_rate_limits
+
+    async def run():
+        start.wait()
+        allowed = 0
+        for _ in range(attempts):
+            decision = await rate_limiter.acquire(review_rate_limits(7, 1, "alice"))
+            allowed += decision.allowed
+        return allowed
+
+    results.put(asyncio.run(run()))
+
+
+def _webhook_worker(env, start, results, posted, payload):
+    _configure(env)
+    from fastapi.testclient import TestClient
+    from src.app import app
+
+    with TestClient(app) as client:
+        start.wait()
+        response = client.post(
+            "/webhook/gitlab",
+            json=payload,
+            headers={"X-Gitlab-Token": env["GITLAB_WEBHOOK_SECRET"], "X-Gitlab-Event": "Merge Request Hook"}
+        )
+        posted.wait()
+
+        # Both events are in; wait until every process is done with the queue
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            jobs = client.get("/queue/status").json()["jobs"]
+            if not jobs.get("pending") and not jobs.get("running"):
+                break
+            time.sleep(0.2)
+        time.sleep(1)  # Let the other process finish its current step
+    results.put(response.json()["status"])
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """GitLab and Anthropic API stand-in counting Claude calls and keeping MR notes"""
+
+    calls = {"messages": 0}
+    notes = {}
+    lock = threading.Lock()
+    diff = [{
+        "old_path": "src/app.py", "new_path": "src/app.py",
+        "diff": "@@ -1,2 +1,2 @@\n ctx\n-old = 1\n+new = 2\n",
+        "new_file": False, "renamed_file": False, "deleted_file": False
+    }]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, status=200, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if "/diffs" in self.path:
+            self._reply(self.diff, headers={"X-Total-Pages": "1"})
+        else:
+            self._reply({"iid": 1, "title": "T", "description": "", "author": {"username": "alice"}, "sha": "abc"})
+
+    def do_POST(self):
+        body = self._body()
+        with self.lock:
+            if self.path.startswith("/v1/messages"):
+                self.calls["messages"] += 1
+                self._reply({
+                    "content": [{"type": "text", "text": "Looks good."}],
+                    "usage": {"input_tokens": 100, "output_tokens": 20}
+                })
+                return
+            note_id = len(self.notes) + 1
+            self.notes[note_id] = body.get("body", "")
+        self._reply({"id": note_id})
+
+    def do_PUT(self):
+        note_id = int(self.path.rsplit("/", 1)[1])
+        self.notes[note_id] = self._body().get("body", "")
+        self._reply({"id": note_id})
+
+    def do_DELETE(self):
+        self.send_response(204)
+        self.end_headers()
+
+
+class SharedStateProcessTest(unittest.TestCase):
+    """Run several processes against one SHARED_STATE database"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.ctx = multiprocessing.get_context("spawn")
+        self.env = {
+            "GITLAB_URL": "http://127.0.0.1:9",
+            "GITLAB_TOKEN": "test",
+            "GITLAB_WEBHOOK_SECRET": "secret",
+            "ANTHROPIC_API_KEY": "test",
+            "SHARED_STATE_BACKEND": "sqlite",
+            "REVIEW_QUEUE_DB_PATH": os.path.join(self._tmp.name, "queue", "review-queue.db"),
+            "TOKEN_DATA_DIR": os.path.join(self._tmp.name, "tokens"),
+            "REVIEW_CACHE_DIR": os.path.join(self._tmp.name, "review-cache"),
+            "LOG_LEVEL": "WARNING"
+        }
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _run(self, target, *args, count=PROCESSES):
+        """Start count processes released together, return their results"""
+        start = self.ctx.Barrier(count, timeout=60)
+        results = self.ctx.Queue()
+        processes = [self.ctx.Process(target=target, args=(self.env, start, results) + args) for _ in range(count)]
+        for process in processes:
+            process.start()
+        try:
+            outcomes = [results.get(timeout=120) for _ in processes]
+        finally:
+            for process in processes:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        for process in processes:
+            self.assertEqual(process.exitcode, 0)
+        return outcomes
+
+    def test_budget_is_enforced_across_processes(self):
+        self.env.update({"TOKEN_DAILY_LIMIT": "10000", "TOKEN_WARNING_THRESHOLD": "8000"})
+
+        granted = self._run(_budget_worker, 6)
+
+        # 4 processes x 6 attempts at 1,000 tokens against a 10,000 budget
+        self.assertEqual(sum(granted), 10)
+
+    def test_rate_limit_is_enforced_across_processes(self):
+        self.env.update({"RATE_LIMIT_BURST": "5", "MAX_REVIEWS_PER_HOUR": "1"})
+
+        allowed = self._run(_rate_worker, 5)
+
+        self.assertEqual(sum(allowed), 5)
+
+    def test_duplicate_webhook_is_reviewed_once(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+        self.env.update({
+            "GITLAB_URL": stub_url,
+            "ANTHROPIC_BASE_URL": stub_url,
+            "ANTHROPIC_STREAMING": "false",
+            "ANTHROPIC_HTTP2": "false",
+            "ANTHROPIC_PREWARM_CONNECTIONS": "0",
+            "FILE_REVIEW_CACHE_ENABLED": "false",
+            "REVIEW_CACHE_ENABLED": "false"
+        })
+        payload = {
+            "object_kind": "merge_request",
+            "user": {"id": 7, "username": "alice"},
+            "object_attributes": {
+                "iid": 1, "title": "Add x", "description": "", "author_id": 7,
+                "source_project_id": 5, "last_commit": {"id": "a" * 40}
+            },
+            "project": {"id": 5, "path_with_namespace": "team/app"},
+            "labels": [{"title": "ai-review"}]
+        }
+
+        posted = self.ctx.Barrier(2, timeout=60)
+        statuses = self._run(_webhook_worker, posted, payload, count=2)
+
+        self.assertTrue(all(status in ("accepted", "skipped") for status in statuses), statuses)
+        self.assertEqual(_StubHandler.calls["messages"], 1)
+        reviews = [body for body in _StubHandler.notes.values() if body.startswith("## 🤖 AI Code Review")]
+        self.assertEqual(len(reviews), 1, _StubHandler.notes)
+
+
+if __name__ == "__main__":
+    unittest.main()
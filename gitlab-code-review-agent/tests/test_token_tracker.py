@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+TokenTracker reservation tests (single process)
+"""
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+_data_dir = tempfile.mkdtemp()
+for _name, _value in {
+    "GITLAB_URL": "http://gitlab.test",
+    "GITLAB_TOKEN": "test",
+    "ANTHROPIC_API_KEY": "test",
+    "TOKEN_DATA_DIR": os.path.join(_data_dir, "tokens"),
+    "REVIEW_QUEUE_DB_PATH": os.path.join(_data_dir, "queue", "review-queue.db")
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from src.token_tracker import tracker
+from src.usage_store import TokenUsage
+
+
+class CommitTest(unittest.IsolatedAsyncioTestCase):
+    """A reservation is swapped for its usage with no window where neither counts"""
+
+    async def test_reservation_held_while_first_summary_of_day_loads(self):
+        if tracker.shared is not None:
+            self.skipTest("single-process path")
+        reservation, _, _, _ = await tracker.reserve(6000, 7, "team/app", "alice")
+        self.assertIsNotNone(reservation)
+        held_during_load = []
+        load = tracker._load_daily_summary
+        stored = load(datetime.utcnow())["total_tokens"]
+
+        def slow_load(timestamp):
+            held_during_load.append(tracker._reserved_total)
+            return load(timestamp)
+
+        # First event of a new day: commit() must load the summary before releasing
+        tracker._summaries.clear()
+        with mock.patch.object(tracker, "_load_daily_summary", new=slow_load):
+            await tracker.commit(reservation, TokenUsage(7, "team/app", 1, "alice", 4000, 1000, 5000, "m", 10))
+
+        self.assertEqual(held_during_load, [6000])
+        self.assertEqual(tracker._reserved_total, 0)
+        self.assertEqual((await tracker._today_summary())["total_tokens"], stored + 5000)
+
+    async def asyncTearDown(self):
+        await tracker.flush()
+
+
+if __name__ == "__main__":
+    unittest.main()
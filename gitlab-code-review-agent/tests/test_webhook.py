@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Webhook validation tests
+Malformed merge request events are rejected before anything is queued
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+_data_dir = tempfile.mkdtemp()
+for _name, _value in {
+    "GITLAB_URL": "http://gitlab.test",
+    "GITLAB_TOKEN": "test",
+    "ANTHROPIC_API_KEY": "test",
+    "TOKEN_DATA_DIR": os.path.join(_data_dir, "tokens"),
+    "REVIEW_QUEUE_DB_PATH": os.path.join(_data_dir, "queue", "review-queue.db")
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from fastapi.testclient import TestClient
+
+from src.config import settings
+from src.app import app
+from src.review_queue import review_queue
+
+
+def _event(project, attributes):
+    return {
+        "object_kind": "merge_request",
+        "object_attributes": attributes,
+        "project": project,
+        "labels": [{"title": settings.gitlab_trigger_label}]
+    }
+
+
+class WebhookValidationTest(unittest.TestCase):
+    """Events without usable project/MR IDs get a 400, not a queue insert"""
+
+    def setUp(self):
+        self.client = TestClient(app)
+        patcher = mock.patch.object(settings, "gitlab_webhook_secret", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_or_invalid_ids_are_rejected(self):
+        for project, attributes in (
+            ({}, {"iid": 1}),
+            ({"id": 5}, {}),
+            ({"id": "5"}, {"iid": 1}),
+            ({"id": 5}, {"iid": True}),
+            ({"id": 5}, {"iid": -1}),
+            ([], {"iid": 1})
+        ):
+            with self.subTest(project=project, attributes=attributes):
+                with mock.patch.object(review_queue, "enqueue", new=mock.AsyncMock()) as enqueue:
+                    response = self.client.post("/webhook/gitlab", json=_event(project, attributes))
+
+                self.assertEqual(response.status_code, 400, response.text)
+                enqueue.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()